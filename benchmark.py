@@ -0,0 +1,1329 @@
+import argparse
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import random
+import secrets
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+import protocol
+from coalescing import pack_batch
+from compression import compress, decompress, COMPRESS_THRESHOLD
+from election import TermElection, ELECTION_TICK
+from failure_detector import PhiAccrualDetector, HEARTBEAT_INTERVAL
+from loadgen import LoadGenerator, find_leader
+from registry import ServerRegistry
+from server import Server
+from sessions import ClientSession, TimerWheel, CLIENT_IDLE_TIMEOUT, SWEEP_TICK
+
+
+def percentile(values, pct):
+
+    # Nearest-rank percentile of an unsorted list
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def start_local_server(engine, port, discovery_port):
+
+    # Run a Server on loopback in a background thread; throughput scenarios measure the
+    # relay itself, so a fast sender must not be throttled by flood control
+    server = Server(port=port, discovery_port=discovery_port, engine=engine, client_rate=0)
+    threading.Thread(target=server.start_server_system, daemon=True).start()
+    return server
+
+
+def open_fake_clients(count, server_address):
+
+    # Bind one loopback socket per fake client and join the server
+    clients = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.setblocking(False)
+        client_id = str(uuid.uuid4())
+        join = {"type": "join", "id": client_id, "port": sock.getsockname()[1]}
+        sock.sendto(json.dumps(join).encode(), server_address)
+        clients.append((client_id, sock))
+    return clients
+
+
+def drain(clients, deadline, on_datagram):
+
+    # Read from all fake client sockets until the deadline passes
+    selector = selectors.DefaultSelector()
+    for client_id, sock in clients:
+        selector.register(sock, selectors.EVENT_READ)
+    while time.time() < deadline:
+        for key, _ in selector.select(timeout=0.05):
+            while True:
+                try:
+                    data, _ = key.fileobj.recvfrom(65535)
+                except BlockingIOError:
+                    break
+                on_datagram(data)
+    selector.close()
+
+
+def bench_engine(engine, clients, messages, rate, port, discovery_port):
+
+    # Relay throughput and latency of one engine: one sender, many receivers
+    start_local_server(engine, port, discovery_port)
+    time.sleep(0.5)
+    server_address = ('127.0.0.1', port)
+    fake_clients = open_fake_clients(clients, server_address)
+    drain(fake_clients, time.time() + 1.0, lambda data: None)
+
+    latencies = []
+    received = [0]
+    last_delivery = [time.perf_counter()]
+
+    def on_datagram(data):
+        frame = json.loads(data.decode())
+        if frame.get("type") == "message":
+            received[0] += 1
+            last_delivery[0] = time.perf_counter()
+            latencies.append(last_delivery[0] - float(frame["text"]))
+
+    sender_id, sender_sock = fake_clients[0]
+    receivers = fake_clients[1:]
+    reader_done = time.time() + 3.0 + (messages / rate if rate else messages / 1000)
+    reader = threading.Thread(target=drain, args=(receivers, reader_done, on_datagram))
+    reader.start()
+
+    # Pace the sender at the requested rate (0 sends as fast as possible)
+    started = time.perf_counter()
+    for sent in range(messages):
+        if rate:
+            delay = started + sent / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        frame = {"type": "message", "id": sender_id, "text": repr(time.perf_counter())}
+        sender_sock.sendto(json.dumps(frame).encode(), server_address)
+    reader.join()
+    elapsed = max(last_delivery[0] - started, 1e-9)
+
+    expected = messages * len(receivers)
+    return {
+        "engine": engine,
+        "clients": clients,
+        "messages": messages,
+        "delivered": received[0],
+        "loss_rate": 1 - received[0] / expected if expected else 0.0,
+        "deliveries_per_sec": received[0] / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": (statistics.mean(latencies) * 1000) if latencies else 0.0,
+    }
+
+
+def run_engine_benchmark(args):
+
+    # Each engine's server gets its own discovery port: the first one would otherwise
+    # lead and the second, as a follower, redirect our clients to it
+    results = []
+    for offset, engine in enumerate(["threaded", "asyncio"]):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = bench_engine(engine, args.clients, args.messages, args.rate,
+                                  args.port + offset, args.discovery_port + offset)
+        results.append(result)
+        print(f"{engine:>9}: {result['deliveries_per_sec']:10.0f} deliveries/s  "
+              f"p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  "
+              f"loss {result['loss_rate']:.2%}")
+    return results
+
+
+def populate_clients(server, count, address, room_size=None):
+
+    # Register fake clients that all point at one sink address, optionally room_size per room
+    for client_id in list(server.clients):
+        server.remove_client(client_id)
+    for number in range(count):
+        room = f"room-{number // room_size}" if room_size else protocol.DEFAULT_ROOM
+        server.add_client(str(uuid.uuid4()), address[0], address[1], f"Client {number + 1}",
+                          room=room)
+
+
+def legacy_fanout(server, message, exclude):
+
+    # Relay loop before encode-once: one json.dumps per recipient
+    for client_id, info in server.clients.items():
+        if client_id != exclude:
+            server.server_socket.sendto(json.dumps(
+                message).encode(), info.address)
+
+
+def measure_rate(send_one, min_duration):
+
+    # Messages/sec of send_one over at least min_duration seconds
+    count = 0
+    started = time.perf_counter()
+    while True:
+        send_one()
+        count += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_duration:
+            return count / elapsed
+
+
+def run_fanout_benchmark(args):
+
+    # Serialization cost of one relayed message against client count
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    server = Server(port=0, discovery_port=args.discovery_port)
+    message = {"type": "message", "id": "sender", "text": "x" * args.text_size,
+               "sender_name": "Client 0"}
+
+    results = []
+    print(f"{'clients':>8} {'legacy msg/s':>14} {'encode-once msg/s':>18} {'speedup':>8}")
+    for count in args.client_counts:
+        populate_clients(server, count, sink.getsockname())
+        legacy = measure_rate(lambda: legacy_fanout(server, message, None), args.duration)
+        encode_once = measure_rate(lambda: server.broadcast_frame(message), args.duration)
+        results.append({"clients": count, "legacy_msgs_per_sec": legacy,
+                        "encode_once_msgs_per_sec": encode_once})
+        print(f"{count:>8} {legacy:>14.1f} {encode_once:>18.1f} {encode_once / legacy:>7.2f}x")
+    sink.close()
+    return results
+
+
+def run_rooms_benchmark(args):
+
+    # Relay rate into one room against room size, with the total client count fixed
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        server = Server(port=0, discovery_port=args.discovery_port)
+    message = {"type": "message", "id": "sender", "text": "x" * args.text_size,
+               "sender_name": "Client 0", "room": "room-0"}
+
+    results = []
+    print(f"{'clients':>8} {'room size':>10} {'room msg/s':>11} {'everyone msg/s':>15}")
+    for room_size in args.room_sizes:
+        populate_clients(server, args.clients, sink.getsockname(), room_size)
+        room = measure_rate(lambda: server.broadcast_frame(message, room="room-0"), args.duration)
+        everyone = measure_rate(lambda: server.broadcast_frame(message), args.duration)
+        results.append({"clients": args.clients, "room_size": room_size,
+                        "room_msgs_per_sec": room, "everyone_msgs_per_sec": everyone})
+        print(f"{args.clients:>8} {room_size:>10} {room:>11.1f} {everyone:>15.1f}")
+    sink.close()
+    return results
+
+
+def run_registry_benchmark(args):
+
+    # Cost of discovery datagrams and election hops against the number of known servers
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        server = Server(port=0, discovery_port=args.discovery_port)
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink_port = sink.getsockname()[1]
+
+    results = []
+    print(f"{'servers':>8} {'discover/s':>11} {'heartbeat/s':>12} {'election hop/s':>15}")
+    for count in args.server_counts:
+        server.servers = ServerRegistry()
+        server.servers.upsert(server.id, "127.0.0.1", server.port)
+        # Every fake server listens on the sink's port at its own loopback address
+        ips = [f"127.0.{index // 250}.{index % 250 + 1}" for index in range(count - 1)]
+        for ip in ips:
+            server.servers.upsert(f"{ip}:{sink_port}", ip, sink_port)
+        probe = ips[-1]
+        discover = json.dumps({"type": "discover", "id": f"{probe}:{sink_port}",
+                               "port": sink_port, "isLeader": False}).encode()
+        heartbeat = json.dumps({"type": "heartbeat", "id": f"{probe}:{sink_port}", "port": sink_port}).encode()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            discover_rate = measure_rate(
+                lambda: server.handle_discovery_datagram(discover, (probe, 0)), args.duration)
+            heartbeat_rate = measure_rate(
+                lambda: server.handle_discovery_datagram(heartbeat, (probe, 0)), args.duration)
+            server.is_leader = False
+            election_rate = measure_rate(lambda: server.forward_server_token(server.id), args.duration)
+        results.append({"servers": count, "discover_per_sec": discover_rate,
+                        "heartbeat_per_sec": heartbeat_rate, "election_hops_per_sec": election_rate})
+        print(f"{count:>8} {discover_rate:>11.1f} {heartbeat_rate:>12.1f} {election_rate:>15.1f}")
+    sink.close()
+    return results
+
+
+def run_detector_benchmark(args):
+
+    # Detection latency and false suspicions of the phi-accrual detector against
+    # heartbeat jitter, next to the fixed 15 s timeout it replaces
+    rng = random.Random(args.seed)
+    results = []
+    print(f"{'jitter s':>9} {'pause rate':>11} {'detect s':>9} {'false/hour':>11} {'fixed detect s':>15}")
+    for jitter in args.jitter:
+        detector = PhiAccrualDetector()
+        now, false_suspicions = 0.0, 0
+        detector.heartbeat("peer", now)
+        for _ in range(args.beats):
+            interval = max(0.0, rng.gauss(HEARTBEAT_INTERVAL, jitter))
+            if rng.random() < args.pause_rate:
+                interval += rng.uniform(0, args.max_pause)  # busy host or scheduling hiccup
+            deadline = detector.deadline("peer")
+            now += interval
+            if now > deadline:
+                false_suspicions += 1
+            detector.heartbeat("peer", now)
+        detect = detector.timeout("peer")
+        per_hour = false_suspicions * 3600 / now
+        results.append({"jitter_s": jitter, "pause_rate": args.pause_rate, "detect_s": detect,
+                        "false_suspicions_per_hour": per_hour, "fixed_detect_s": 15.0})
+        print(f"{jitter:>9.3f} {args.pause_rate:>11.3f} {detect:>9.2f} {per_hour:>11.2f} {15.0:>15.2f}")
+    return results
+
+
+def simulate_election(node_count, loss, latency, heartbeat_interval, limit, rng):
+
+    # One cluster on a simulated network that drops each datagram with probability
+    # loss, starting when every server has just given up on the old leader. Returns
+    # the simulated seconds until a majority and until all servers follow one leader
+    # (None if not within limit) and the number of terms used.
+    ids = [f"10.0.0.{index}:5001" for index in range(node_count)]
+    nodes = {node_id: TermElection(node_id, random.Random(rng.random())) for node_id in ids}
+    detectors = {node_id: PhiAccrualDetector(first_interval=heartbeat_interval) for node_id in ids}
+    events = []  # (time, order, destination, message); message None = election timer tick
+    order = itertools.count()
+    leaders = {}  # term: the one server that won it
+    majority_at = None
+
+    def send(now, destination, message):
+        if rng.random() >= loss:
+            heapq.heappush(events, (now + rng.uniform(*latency), next(order), destination, message))
+
+    def announce(now, node):
+        leaders.setdefault(node.term, node.node_id)
+        assert leaders[node.term] == node.node_id, "two leaders in one term"
+        for peer in ids:
+            if peer != node.node_id:
+                send(now, peer, {"type": "leader", "term": node.term, "id": node.node_id})
+        heapq.heappush(events, (now + heartbeat_interval, next(order), node.node_id, {"type": "beat"}))
+
+    for node_id, node in nodes.items():
+        node.wait_for_leader(0.0, timeout=0)
+        heapq.heappush(events, (rng.uniform(0, ELECTION_TICK), next(order), node_id, None))
+    while events:
+        now, _, node_id, message = heapq.heappop(events)
+        if now > limit:
+            break
+        node = nodes[node_id]
+        peers = [peer for peer in ids if peer != node_id]
+        was_leader = node.state == "leader"
+        if message is None:
+            if node.due(now):
+                for peer, request in node.stand(now, peers):
+                    send(now, peer, request)
+            heapq.heappush(events, (now + ELECTION_TICK, next(order), node_id, None))
+        elif message["type"] == "vote_request":
+            send(now, message["id"], node.on_vote_request(message, now))
+        elif message["type"] == "vote":
+            for peer, request in node.on_vote(message, now, peers):
+                send(now, peer, request)
+        elif message["type"] == "leader":
+            detectors[node_id].heartbeat(message["id"], now)
+            node.on_leader(message["term"], message["id"], now, detectors[node_id].timeout(message["id"]))
+        elif message["type"] == "beat" and node.state == "leader":
+            announce(now, node)
+        if node.state == "leader" and not was_leader:
+            announce(now, node)
+        if node.leader_id is None or nodes[node.leader_id].state != "leader":
+            continue
+        followers = sum(1 for other in nodes.values() if other.leader_id == node.leader_id)
+        if majority_at is None and followers > node_count // 2:
+            majority_at = now
+        if followers == node_count:
+            return majority_at, now, max(other.term for other in nodes.values())
+    return majority_at, None, max(node.term for node in nodes.values())
+
+
+def run_election_benchmark(args):
+
+    # Time to a leader followed by a majority and by everybody, on a simulated lossy network
+    rng = random.Random(args.seed)
+    results = []
+    print(f"{'servers':>8} {'loss':>6} {'majority p50/p95 s':>19} {'all p50/p95 s':>14} "
+          f"{'max s':>7} {'terms':>6} {'stalled':>8}")
+    for node_count in args.server_counts:
+        for loss in args.loss:
+            majority_times, all_times, terms, stalled = [], [], [], 0
+            for _ in range(args.trials):
+                majority_at, all_at, term = simulate_election(
+                    node_count, loss, (args.latency_min, args.latency_max),
+                    args.heartbeat_interval, args.limit, rng)
+                terms.append(term)
+                if majority_at is not None:
+                    majority_times.append(majority_at)
+                if all_at is None:
+                    stalled += 1
+                else:
+                    all_times.append(all_at)
+            result = {"servers": node_count, "loss": loss, "mean_terms": statistics.mean(terms),
+                      "stalled": stalled}
+            for name, times in (("majority", majority_times), ("all", all_times)):
+                result[f"{name}_p50_s"] = statistics.median(times) if times else None
+                result[f"{name}_p95_s"] = percentile(times, 95) if times else None
+            result["max_s"] = max(all_times) if all_times else None
+            results.append(result)
+
+            def cell(name):
+                if result[f"{name}_p50_s"] is None:
+                    return "-"
+                return f"{result[f'{name}_p50_s']:.2f}/{result[f'{name}_p95_s']:.2f}"
+            worst = "-" if result["max_s"] is None else f"{result['max_s']:.2f}"
+            print(f"{node_count:>8} {loss:>6.2f} {cell('majority'):>19} {cell('all'):>14} "
+                  f"{worst:>7} {result['mean_terms']:>6.1f} {stalled:>8}")
+    return results
+
+
+def wait_for_sharded_leader(discovery_port, shard_count, timeout):
+
+    # Listen to the discovery multicast until a leader reports shard_count live shards
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', discovery_port))
+    mreq = socket.inet_aton('224.1.1.1') + socket.inet_aton('0.0.0.0')
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.settimeout(1.0)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            try:
+                data, address = sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            frame = json.loads(data.decode())
+            is_leader = frame["type"] == "heartbeat" or frame.get("isLeader")
+            if is_leader and len(frame.get("shards", ())) == shard_count:
+                return (address[0], frame["port"])
+    finally:
+        sock.close()
+    return None
+
+
+def bench_shards(server_count, args):
+
+    # Aggregate relay throughput of server_count sharded server processes
+    processes = []
+    with open(os.devnull, "w") as devnull:
+        for offset in range(server_count):
+            processes.append(subprocess.Popen(
+                [sys.executable, "server.py", "--sharded", "--engine", "asyncio", "--client-rate", "0",
+                 "--port", str(args.port + offset), "--discovery-port", str(args.discovery_port)],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull, stderr=devnull))
+    try:
+        leader = wait_for_sharded_leader(args.discovery_port, server_count, timeout=40)
+        if leader is None:
+            raise RuntimeError(f"no leader with {server_count} shards")
+        fake_clients = open_fake_clients(args.clients, leader)
+        owners = await_welcomes(fake_clients)
+        delivered, elapsed = relay_load(fake_clients, owners, args)
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+    expected = args.messages * (args.clients - 1)
+    shard_sizes = {}
+    for address in owners.values():
+        shard_sizes[address[1]] = shard_sizes.get(address[1], 0) + 1
+    return {
+        "servers": server_count,
+        "clients": args.clients,
+        "messages": args.messages,
+        "clients_per_shard": sorted(shard_sizes.values()),
+        "delivered": delivered,
+        "loss_rate": 1 - delivered / expected if expected else 0.0,
+        "deliveries_per_sec": delivered / elapsed,
+    }
+
+
+def await_welcomes(fake_clients):
+
+    # Address each welcome came from: the server (shard) that owns that client
+    owners = {}
+    for client_id, sock in fake_clients:
+        sock.setblocking(True)
+        sock.settimeout(5.0)
+        while True:
+            data, address = sock.recvfrom(65535)
+            if json.loads(data.decode()).get("type") == "welcome":
+                owners[client_id] = address
+                break
+        sock.setblocking(False)
+    return owners
+
+
+def relay_load(fake_clients, owners, args):
+
+    # Senders take turns at the requested total rate, each sending to its own server;
+    # returns (deliveries, seconds until the last one) and closes the fake clients
+    received = [0]
+    last_delivery = [time.perf_counter()]
+
+    def on_datagram(data):
+        if json.loads(data.decode()).get("type") == "message":
+            received[0] += 1
+            last_delivery[0] = time.perf_counter()
+
+    senders = fake_clients[:args.senders]
+    reader_done = time.time() + 3.0 + args.messages / args.rate
+    reader = threading.Thread(target=drain, args=(fake_clients, reader_done, on_datagram))
+    reader.start()
+
+    started = time.perf_counter()
+    for sent in range(args.messages):
+        delay = started + sent / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        client_id, sock = senders[sent % len(senders)]
+        frame = {"type": "message", "id": client_id, "text": "x" * args.text_size}
+        sock.sendto(json.dumps(frame).encode(), owners[client_id])
+    reader.join()
+    for _, sock in fake_clients:
+        sock.close()
+    return received[0], max(last_delivery[0] - started, 1e-9)
+
+
+def bench_workers(worker_count, args):
+
+    # Relay throughput of one server process pre-forking worker_count workers
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(
+            [sys.executable, "server.py", "--workers", str(worker_count), "--engine", "asyncio",
+             "--client-rate", "0", "--port", str(args.port), "--discovery-port", str(args.discovery_port)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull, stderr=devnull)
+    try:
+        time.sleep(2.0)  # time for the workers to bind the shared port
+        fake_clients = open_fake_clients(args.clients, ('127.0.0.1', args.port))
+        owners = await_welcomes(fake_clients)
+        delivered, elapsed = relay_load(fake_clients, owners, args)
+    finally:
+        process.kill()
+        process.wait()
+
+    expected = args.messages * (args.clients - 1)
+    return {
+        "workers": worker_count,
+        "clients": args.clients,
+        "messages": args.messages,
+        "delivered": delivered,
+        "loss_rate": 1 - delivered / expected if expected else 0.0,
+        "deliveries_per_sec": delivered / elapsed,
+    }
+
+
+def run_workers_benchmark(args):
+
+    # Relay throughput against the number of SO_REUSEPORT worker processes
+    results = []
+    print(f"{'workers':>8} {'deliveries/s':>13} {'loss':>7}")
+    for worker_count in args.worker_counts:
+        result = bench_workers(worker_count, args)
+        results.append(result)
+        print(f"{worker_count:>8} {result['deliveries_per_sec']:>13.0f} {result['loss_rate']:>7.2%}")
+    return results
+
+
+def run_shards_benchmark(args):
+
+    # Aggregate throughput against the number of sharded server processes
+    results = []
+    print(f"{'servers':>8} {'deliveries/s':>13} {'loss':>7}  clients per shard")
+    for server_count in args.server_counts:
+        result = bench_shards(server_count, args)
+        results.append(result)
+        print(f"{server_count:>8} {result['deliveries_per_sec']:>13.0f} {result['loss_rate']:>7.2%}  "
+              f"{result['clients_per_shard']}")
+    return results
+
+
+def run_transport_benchmark(args):
+
+    # Syscalls and relay rate per backend against a loopback swarm of fake clients
+    swarm = []
+    for _ in range(args.clients):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        swarm.append(sock)
+
+    results = []
+    print(f"{'backend':>9} {'msg/s':>10} {'syscalls/msg':>13} {'datagrams/syscall':>18}")
+    for offset, backend in enumerate(["portable", "sendmmsg"]):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            server = Server(port=0, discovery_port=args.discovery_port, transport=backend)
+        for number, sock in enumerate(swarm):
+            server.add_client(str(uuid.uuid4()), '127.0.0.1', sock.getsockname()[1],
+                              f"Client {number + 1}")
+        message = {"type": "message", "id": "sender", "text": "x" * args.text_size,
+                   "sender_name": "Client 0"}
+
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            server.broadcast_frame(message)
+        elapsed = time.perf_counter() - started
+
+        transport = server.transport
+        result = {"backend": transport.name, "clients": args.clients, "messages": args.messages,
+                  "msgs_per_sec": args.messages / elapsed,
+                  "syscalls": transport.syscalls, "datagrams": transport.datagrams}
+        results.append(result)
+        print(f"{transport.name:>9} {result['msgs_per_sec']:>10.1f} "
+              f"{transport.syscalls / args.messages:>13.1f} "
+              f"{transport.datagrams / max(transport.syscalls, 1):>18.1f}")
+        server.server_socket.close()
+
+    for sock in swarm:
+        sock.close()
+    return results
+
+
+def run_e2e_benchmark(args):
+
+    # Server processes on loopback against a headless client swarm: relay rate,
+    # latency, loss and, with --failover, how long until messages flow again after
+    # the leader is killed halfway through
+    processes = {}
+    with open(os.devnull, "w") as devnull:
+        for offset in range(args.servers):
+            port = args.port + offset
+            processes[port] = subprocess.Popen(
+                [sys.executable, "server.py", "--engine", args.engine, "--port", str(port),
+                 "--discovery-port", str(args.discovery_port), "--codecs", *args.codecs,
+                 "--client-rate", str(args.client_rate)],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull, stderr=devnull)
+    generator = None
+    try:
+        leader = find_leader(args.discovery_port, args.servers, timeout=30)
+        if leader is None:
+            raise RuntimeError(f"no leader among {args.servers} servers")
+        generator = LoadGenerator(args.clients, leader, args.discovery_port, args.codecs)
+        generator.start()
+        joined = generator.wait_joined(timeout=60)
+        time.sleep(1.0)  # let the followers receive the replicated sessions
+
+        killed_at = None
+        padding = "x" * args.text_size
+        started = time.perf_counter()
+        for sent in range(args.messages):
+            delay = started + sent / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if args.failover and sent == args.messages // 2:
+                processes.pop(leader[1]).kill()
+                killed_at = generator.mark()
+            try:
+                generator.send(sent % args.senders, padding)
+            except OSError:
+                pass  # the server just died under this client
+        sent_for = time.perf_counter() - started
+        time.sleep(3.0)
+        # Late joiners count too: they were sent most of the messages
+        joined = sum(1 for client in generator.clients if client.joined)
+    finally:
+        if generator is not None:
+            generator.stop()
+        for process in processes.values():
+            process.kill()
+            process.wait()
+
+    expected = args.messages * (joined - 1)
+    elapsed = max((generator.last_delivery or started) - started, 1e-9)
+    failover_s = None
+    if killed_at is not None and generator.recovered_at is not None:
+        failover_s = generator.recovered_at - killed_at
+    result = {
+        "engine": args.engine,
+        "servers": args.servers,
+        "clients": args.clients,
+        "joined": joined,
+        "messages": args.messages,
+        "messages_per_sec": args.messages / sent_for,
+        "delivered": generator.delivered,
+        "deliveries_per_sec": generator.delivered / elapsed,
+        "loss_rate": 1 - generator.delivered / expected if expected else 0.0,
+        "p50_ms": percentile(generator.latencies, 50) * 1000,
+        "p99_ms": percentile(generator.latencies, 99) * 1000,
+        "failover_s": failover_s,
+    }
+    print(f"{args.servers} x {args.engine} server, {joined}/{args.clients} clients joined")
+    print(f"  {result['messages_per_sec']:.0f} msg/s sent, {result['deliveries_per_sec']:.0f} deliveries/s, "
+          f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, loss {result['loss_rate']:.2%}")
+    if args.failover:
+        print(f"  failover: {'%.2f s' % failover_s if failover_s is not None else 'no recovery'}")
+    return [result]
+
+
+def bench_flood(limited, port, discovery_port, args):
+
+    # Latency of well-behaved senders while client 0 floods the leader as fast as it can
+    command = [sys.executable, "server.py", "--engine", "asyncio", "--port", str(port),
+               "--discovery-port", str(discovery_port)]
+    if limited:
+        command += ["--client-rate", str(args.client_rate), "--relay-budget", str(args.relay_budget)]
+    else:
+        command += ["--client-rate", "0", "--relay-budget", "0"]
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stdout=devnull, stderr=devnull)
+    generator = None
+    flooding = threading.Event()
+    flooded = [0]
+
+    def flood():
+        while flooding.is_set():
+            try:
+                generator.send(0, "x" * args.text_size, timed=False)
+                flooded[0] += 1
+            except OSError:
+                pass
+
+    try:
+        leader = find_leader(discovery_port, 1, timeout=30)
+        if leader is None:
+            raise RuntimeError("no leader")
+        generator = LoadGenerator(args.clients, leader, discovery_port)
+        generator.start()
+        generator.wait_joined(timeout=30)
+        flooding.set()
+        flooder = threading.Thread(target=flood, daemon=True)
+        flooder.start()
+        padding = "x" * args.text_size
+        started = time.perf_counter()
+        for sent in range(args.messages):
+            delay = started + sent / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            generator.send(1 + sent % args.senders, padding)
+        flooding.clear()
+        flooder.join()
+        elapsed = time.perf_counter() - started
+        time.sleep(2.0)
+    finally:
+        flooding.clear()
+        if generator is not None:
+            generator.stop()
+        process.kill()
+        process.wait()
+
+    expected = args.messages * (args.clients - 1)
+    return {
+        "flood_control": limited,
+        "clients": args.clients,
+        "messages": args.messages,
+        "p50_ms": percentile(generator.latencies, 50) * 1000,
+        "p99_ms": percentile(generator.latencies, 99) * 1000,
+        "loss_rate": 1 - len(generator.latencies) / expected if expected else 0.0,
+        "flood_sent_per_sec": flooded[0] / elapsed,
+        "flood_delivered_per_sec": generator.untimed_delivered / elapsed,
+        "slow_down_notices": generator.slow_downs,
+    }
+
+
+def run_flood_benchmark(args):
+
+    # One abusive client against the rest, without and with flood control
+    results = []
+    print(f"{'flood control':>13} {'p50 ms':>8} {'p99 ms':>8} {'loss':>7} {'flood sent/s':>13} "
+          f"{'flood relayed/s':>16} {'slow-downs':>11}")
+    for offset, limited in enumerate([False, True]):
+        result = bench_flood(limited, args.port + offset, args.discovery_port + offset, args)
+        results.append(result)
+        print(f"{'on' if limited else 'off':>13} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{result['loss_rate']:>7.2%} {result['flood_sent_per_sec']:>13.0f} "
+              f"{result['flood_delivered_per_sec']:>16.0f} {result['slow_down_notices']:>11}")
+    return results
+
+
+# Sample chat lines for the compression benchmark: every message is one of them
+CHAT_LINES = [
+    "hey everyone, what's the plan for today?",
+    "I think we should meet at the office tomorrow morning",
+    "ok",
+    "thanks, see you there!",
+    "lol yeah that was great",
+    "did anyone push the fix for the login page yet?",
+    "not yet, I'm still waiting for the review",
+    "can you send me the link to the document again please",
+    "sure, one sec",
+    "good morning :)",
+    "the build is green again, nice work",
+    "I'll be 10 minutes late, sorry",
+]
+
+
+def process_cpu_seconds(pid):
+
+    # User + system CPU time a process used so far (Linux /proc; 0.0 elsewhere)
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def bench_busy_room(batch_delay_ms, features, texts, port, discovery_port, args, server_args=()):
+
+    # One busy room at a fixed message rate: the datagrams and bytes the clients receive
+    # against the deliveries they carry, the server's CPU time and the latency
+    command = [sys.executable, "server.py", "--engine", "asyncio", "--port", str(port),
+               "--discovery-port", str(discovery_port), "--client-rate", "0",
+               "--batch-delay", str(batch_delay_ms), *server_args]
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stdout=devnull, stderr=devnull)
+    generator = None
+    try:
+        leader = find_leader(discovery_port, 1, timeout=30)
+        if leader is None:
+            raise RuntimeError("no leader")
+        generator = LoadGenerator(args.clients, leader, codecs=args.codecs, features=features)
+        generator.start()
+        joined = generator.wait_joined(timeout=60)
+        time.sleep(1.0)
+        generator.datagrams = 0
+        generator.bytes_received = 0
+        cpu_started = process_cpu_seconds(process.pid)
+        started = time.perf_counter()
+        for sent in range(args.messages):
+            delay = started + sent / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            generator.send(sent % args.senders, texts[sent % len(texts)])
+        sent_for = time.perf_counter() - started
+        time.sleep(2.0)
+        server_cpu = process_cpu_seconds(process.pid) - cpu_started
+    finally:
+        if generator is not None:
+            generator.stop()
+        process.kill()
+        process.wait()
+
+    expected = args.messages * (joined - 1)
+    return {
+        "batch_delay_ms": batch_delay_ms,
+        "features": list(features),
+        "clients": joined,
+        "messages_per_sec": args.messages / sent_for,
+        "delivered": generator.delivered,
+        "datagrams": generator.datagrams,
+        "datagrams_per_sec": generator.datagrams / sent_for,
+        "deliveries_per_datagram": generator.delivered / generator.datagrams if generator.datagrams else 0.0,
+        "bytes_per_sec": generator.bytes_received / sent_for,
+        "bytes_per_delivery": generator.bytes_received / generator.delivered if generator.delivered else 0.0,
+        "server_cpu_seconds": server_cpu,
+        "p50_ms": percentile(generator.latencies, 50) * 1000,
+        "p99_ms": percentile(generator.latencies, 99) * 1000,
+        "loss_rate": 1 - generator.delivered / expected if expected else 0.0,
+    }
+
+
+def run_coalesce_benchmark(args):
+
+    # Packet rate and latency of a busy room without (0) and with per-client batching
+    results = []
+    print(f"{'delay ms':>9} {'msg/s':>7} {'datagrams/s':>12} {'msgs/datagram':>14} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'loss':>7}")
+    texts = ["x" * args.text_size]
+    for offset, batch_delay_ms in enumerate(args.batch_delays):
+        result = bench_busy_room(batch_delay_ms, ("batch",), texts, args.port + offset,
+                                 args.discovery_port + offset, args)
+        results.append(result)
+        print(f"{batch_delay_ms:>9g} {result['messages_per_sec']:>7.0f} {result['datagrams_per_sec']:>12.0f} "
+              f"{result['deliveries_per_datagram']:>14.2f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{result['loss_rate']:>7.2%}")
+    return results
+
+
+def run_compress_benchmark(args):
+
+    # Bytes against CPU of the chat-dictionary compression: per frame by bypass threshold
+    # in-process, then a busy room with and without the "compress" feature. The load generator
+    # inflates for every simulated client: on a machine it saturates, the latency measures that.
+    client_id = str(uuid.uuid4())
+    frames = [{"type": "message", "id": client_id, "text": f"{time.perf_counter()!r} {line}",
+               "sender_name": "Client 42", "seq": 1000 + index, "room": protocol.DEFAULT_ROOM}
+              for index, line in enumerate(CHAT_LINES)]
+    results = []
+    print(f"{'codec':>7} {'threshold':>10} {'compressed':>11} {'bytes':>7} {'saved':>7} {'us/frame':>9} "
+          f"{'batch bytes':>12} {'batch saved':>12}")
+    for codec in protocol.CODECS:
+        payloads = [protocol.encode(frame, codec) for frame in frames]
+        raw = sum(len(payload) for payload in payloads)
+        batch = pack_batch(payloads)
+        for threshold in args.thresholds:
+            packed = [compress(payload, threshold) for payload in payloads]
+            assert [decompress(payload) for payload in packed] == payloads
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                for payload in payloads:
+                    compress(payload, threshold)
+            frame_us = (time.perf_counter() - started) / (args.iterations * len(payloads)) * 1e6
+            size = sum(len(payload) for payload in packed)
+            batch_size = len(compress(batch, threshold))
+            result = {
+                "codec": codec,
+                "threshold": threshold,
+                "compressed_frames": sum(1 for payload, original in zip(packed, payloads) if payload is not original),
+                "frames": len(payloads),
+                "bytes": size,
+                "raw_bytes": raw,
+                "compress_us_per_frame": frame_us,
+                "batch_bytes": batch_size,
+                "raw_batch_bytes": len(batch),
+            }
+            results.append(result)
+            print(f"{codec:>7} {threshold:>10} {result['compressed_frames']:>5}/{len(payloads):<5} {size:>7} "
+                  f"{1 - size / raw:>7.1%} {frame_us:>9.2f} {batch_size:>12} {1 - batch_size / len(batch):>12.1%}")
+
+    print()
+    print(f"{'batch ms':>9} {'compress':>9} {'KB/s':>8} {'B/delivery':>11} {'datagrams/s':>12} {'server cpu':>11} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'loss':>7}")
+    runs = [(0, ()), (0, ("compress",)), (args.batch_delay, ("batch",)), (args.batch_delay, ("batch", "compress"))]
+    server_args = ("--compress-threshold", str(args.threshold))
+    for offset, (batch_delay_ms, features) in enumerate(runs):
+        result = bench_busy_room(batch_delay_ms, features, CHAT_LINES, args.port + offset,
+                                 args.discovery_port + offset, args, server_args)
+        results.append(result)
+        print(f"{batch_delay_ms:>9g} {'compress' in features!s:>9} {result['bytes_per_sec'] / 1024:>8.0f} "
+              f"{result['bytes_per_delivery']:>11.1f} {result['datagrams_per_sec']:>12.0f} "
+              f"{result['server_cpu_seconds']:>10.2f}s {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{result['loss_rate']:>7.2%}")
+    return results
+
+
+def bench_rejoin(resume, port, discovery_port, args):
+
+    # A swarm joins a fresh server, which is then restarted: every client joins again at
+    # once, with or without its resume token. Both runs of the server share a secret.
+    command = [sys.executable, "server.py", "--engine", "asyncio", "--port", str(port),
+               "--discovery-port", str(discovery_port), "--client-rate", "0",
+               "--cluster-secret", secrets.token_hex(16)]
+
+    def launch():
+        with open(os.devnull, "w") as devnull:
+            return subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    stdout=devnull, stderr=devnull)
+
+    process = launch()
+    generator = None
+    try:
+        leader = find_leader(discovery_port, 1, timeout=30)
+        if leader is None:
+            raise RuntimeError("no leader")
+        generator = LoadGenerator(args.clients, leader)
+        started = time.perf_counter()
+        generator.start()
+        joined = generator.wait_joined(timeout=60)
+        join_seconds = time.perf_counter() - started
+        time.sleep(1.0)  # notices held back by coalescing go out
+        join_notices = generator.notices
+        names = {client.id: client.name for client in generator.clients}
+
+        process.kill()
+        process.wait()
+        process = launch()
+        if find_leader(discovery_port, 1, timeout=30) is None:
+            raise RuntimeError("no leader after restart")
+        generator.notices = 0
+        started = time.perf_counter()
+        # In reverse, so a server handing out names in arrival order cannot keep them by chance
+        for client in reversed(generator.clients):
+            if not resume:
+                client.resume_token = None
+            client.join()
+        rejoined = generator.wait_joined(timeout=60)
+        rejoin_seconds = time.perf_counter() - started
+        time.sleep(1.0)
+        rejoin_notices = generator.notices
+        kept = sum(1 for client in generator.clients if client.name == names[client.id])
+    finally:
+        if generator is not None:
+            generator.stop()
+        process.kill()
+        process.wait()
+
+    return {
+        "resume": resume,
+        "clients": args.clients,
+        "joined": joined,
+        "join_seconds": join_seconds,
+        "join_notices": join_notices,
+        "uncoalesced_notices": args.clients * (args.clients - 1) // 2,
+        "rejoined": rejoined,
+        "rejoin_seconds": rejoin_seconds,
+        "rejoin_notices": rejoin_notices,
+        "names_kept": kept,
+    }
+
+
+def run_rejoin_benchmark(args):
+
+    # Join storms: notices delivered (one per join without coalescing) and identities
+    # kept across a server restart, without and with resume tokens
+    results = []
+    print(f"{'resume':>7} {'clients':>8} {'join s':>7} {'notices':>8} {'per-join':>9} "
+          f"{'rejoin s':>9} {'notices':>8} {'names kept':>11}")
+    for offset, resume in enumerate([False, True]):
+        result = bench_rejoin(resume, args.port + offset, args.discovery_port + offset, args)
+        results.append(result)
+        print(f"{'on' if resume else 'off':>7} {result['clients']:>8} {result['join_seconds']:>7.2f} "
+              f"{result['join_notices']:>8} {result['uncoalesced_notices']:>9} "
+              f"{result['rejoin_seconds']:>9.2f} {result['rejoin_notices']:>8} {result['names_kept']:>11}")
+    return results
+
+
+def legacy_render(app, message, sender_name):
+
+    # The chat window's previous rendering: several inserts, a scroll and all eight
+    # tag configurations for every single message
+    chat = app.chat_display
+    chat.config(state='normal')
+    chat.insert("end", "\n", "normal")
+    chat.insert("end", f"{sender_name}\n", "sender_name")
+    chat.insert("end", f"{message}", "other_message")
+    chat.insert("end", " 12:00", "timestamp_other")
+    chat.insert("end", "\n", "normal")
+    chat.see("end")
+    chat.config(state='disabled')
+    app.configure_tags()
+
+
+def run_render_benchmark(args):
+
+    # Messages/sec the chat window renders: per-message Tk calls vs queued batches.
+    # Needs a display (an X server, or e.g. xvfb-run).
+    import tkinter as tk
+    from client import MessagingApp
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"⚠️  Render benchmark needs a display: {e}")
+        return []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        app = MessagingApp(root, discovery_port=args.discovery_port, scrollback=args.scrollback)
+    root.update()
+
+    def clear():
+        app.chat_display.config(state='normal')
+        app.chat_display.delete("1.0", "end")
+        app.chat_display.config(state='disabled')
+        app.rendered.clear()
+        app.archive.clear()
+        root.update()
+
+    results = []
+    print(f"Scrollback: {args.scrollback or 'unbounded'} messages")
+    print(f"{'messages':>9} {'per-message msg/s':>18} {'batched msg/s':>14} {'speedup':>8} {'lines kept':>11}")
+    for count in args.message_counts:
+        text = "x" * args.text_size
+        clear()
+        started = time.perf_counter()
+        for _ in range(count):
+            legacy_render(app, text, "Client 2")
+        root.update()
+        legacy = count / (time.perf_counter() - started)
+
+        clear()
+        started = time.perf_counter()
+        for _ in range(count):
+            app.display_message(text, "other", "Client 2")
+        while not app.render_queue.empty():
+            app.drain_render_queue()
+            root.update()
+        batched = count / (time.perf_counter() - started)
+        lines = int(app.chat_display.index("end-1c").split(".")[0])
+        results.append({"messages": count, "per_message_msgs_per_sec": legacy,
+                        "batched_msgs_per_sec": batched, "lines_kept": lines})
+        print(f"{count:>9} {legacy:>18.0f} {batched:>14.0f} {batched / legacy:>7.2f}x {lines:>11}")
+    root.destroy()
+    return results
+
+
+def legacy_session(client_id, ip, port, name):
+
+    # Client table entry before ClientSession
+    return {"id": client_id, "ip": ip, "port": port, "name": name, "codec": "json",
+            "features": [], "room": protocol.DEFAULT_ROOM}
+
+
+def session_table_bytes(count, make_entry):
+
+    # Memory (bytes) of a client table of count entries, ids and names not counted
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    names = [f"Client {number + 1}" for number in range(count)]
+    tracemalloc.start()
+    table = {client_id: make_entry(client_id, "127.0.0.1", 40000 + number % 20000, names[number])
+             for number, client_id in enumerate(ids)}
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del table
+    return size
+
+
+def run_sessions_benchmark(args):
+
+    # Bytes per client of the session table, and the cost of finding idle sessions
+    # each sweep: a timer wheel against scanning the whole table
+    rng = random.Random(args.seed)
+    results = []
+    print(f"{'clients':>8} {'dict B/client':>14} {'slots B/client':>15} {'scan us/tick':>13} {'wheel us/tick':>14}")
+    for count in args.client_counts:
+        legacy_bytes = session_table_bytes(count, legacy_session) / count
+        session_bytes = session_table_bytes(count, ClientSession) / count
+
+        # Every client is heard from once per keepalive interval, at a random phase
+        sessions = [ClientSession(number, "127.0.0.1", number, "") for number in range(count)]
+        for session in sessions:
+            session.last_seen = rng.uniform(-args.keepalive, 0)
+        wheel = TimerWheel(0.0)
+        for session in sessions:
+            wheel.schedule(session.id, session.last_seen + CLIENT_IDLE_TIMEOUT)
+        scan_time = wheel_time = 0.0
+        for tick in range(1, args.ticks + 1):
+            now = tick * SWEEP_TICK
+            for session in sessions:
+                if session.last_seen + args.keepalive <= now:
+                    session.last_seen += args.keepalive
+            started = time.perf_counter()
+            idle = [session for session in sessions if session.last_seen + CLIENT_IDLE_TIMEOUT <= now]
+            scan_time += time.perf_counter() - started
+            started = time.perf_counter()
+            for key in wheel.advance(now):
+                session = sessions[key]
+                deadline = session.last_seen + CLIENT_IDLE_TIMEOUT
+                if deadline <= now:
+                    idle.append(session)
+                else:
+                    wheel.schedule(key, deadline)
+            wheel_time += time.perf_counter() - started
+        scan_us = scan_time / args.ticks * 1e6
+        wheel_us = wheel_time / args.ticks * 1e6
+        results.append({"clients": count, "dict_bytes_per_client": legacy_bytes,
+                        "slots_bytes_per_client": session_bytes,
+                        "scan_us_per_tick": scan_us, "wheel_us_per_tick": wheel_us})
+        print(f"{count:>8} {legacy_bytes:>14.0f} {session_bytes:>15.0f} {scan_us:>13.0f} {wheel_us:>14.0f}")
+    return results
+
+
+def run_protocol_benchmark(args):
+
+    # Packet size and encode/decode cost of JSON vs binary frames
+    client_id = str(uuid.uuid4())
+    frames = [
+        {"type": "join", "id": client_id, "port": 50123},
+        {"type": "message", "id": client_id, "text": "x" * args.text_size},
+        {"type": "message", "id": client_id, "text": "x" * args.text_size, "sender_name": "Client 42"},
+        {"type": "notice", "text": "Client 42 has joined the chat."},
+        {"type": "leave", "id": client_id},
+    ]
+
+    results = []
+    print(f"{'frame':>8} {'codec':>7} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+    for frame in frames:
+        for codec in protocol.CODECS:
+            payload = protocol.encode(frame, codec)
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                protocol.encode(frame, codec)
+            encode_us = (time.perf_counter() - started) / args.iterations * 1e6
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                protocol.decode(payload)
+            decode_us = (time.perf_counter() - started) / args.iterations * 1e6
+            results.append({"frame": frame["type"], "codec": codec, "bytes": len(payload),
+                            "encode_us": encode_us, "decode_us": decode_us})
+            print(f"{frame['type']:>8} {codec:>7} {len(payload):>6} {encode_us:>10.2f} {decode_us:>10.2f}")
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Chat server micro-benchmarks")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to PATH as JSON")
+    subparsers = parser.add_subparsers(dest="scenario", required=True)
+
+    engine_parser = subparsers.add_parser("engine", help="threaded vs asyncio relay engine")
+    engine_parser.add_argument("--clients", type=int, default=20)
+    engine_parser.add_argument("--messages", type=int, default=2000)
+    engine_parser.add_argument("--rate", type=int, default=500, help="messages/sec, 0 = unthrottled")
+    engine_parser.add_argument("--port", type=int, default=6001)
+    engine_parser.add_argument("--discovery-port", type=int, default=6010)
+    engine_parser.set_defaults(run=run_engine_benchmark)
+
+    fanout_parser = subparsers.add_parser("fanout", help="encode-once broadcast vs per-recipient encoding")
+    fanout_parser.add_argument("--client-counts", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    fanout_parser.add_argument("--text-size", type=int, default=200)
+    fanout_parser.add_argument("--duration", type=float, default=1.0)
+    fanout_parser.add_argument("--discovery-port", type=int, default=6010)
+    fanout_parser.set_defaults(run=run_fanout_benchmark)
+
+    rooms_parser = subparsers.add_parser("rooms", help="room-scoped fan-out vs broadcasting to everyone")
+    rooms_parser.add_argument("--clients", type=int, default=10000)
+    rooms_parser.add_argument("--room-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    rooms_parser.add_argument("--text-size", type=int, default=200)
+    rooms_parser.add_argument("--duration", type=float, default=1.0)
+    rooms_parser.add_argument("--discovery-port", type=int, default=6010)
+    rooms_parser.set_defaults(run=run_rooms_benchmark)
+
+    shards_parser = subparsers.add_parser("shards", help="aggregate throughput of sharded server processes")
+    shards_parser.add_argument("--server-counts", type=int, nargs="+", default=[1, 2, 4])
+    shards_parser.add_argument("--clients", type=int, default=200)
+    shards_parser.add_argument("--senders", type=int, default=10)
+    shards_parser.add_argument("--messages", type=int, default=2000)
+    shards_parser.add_argument("--rate", type=int, default=500, help="messages/sec over all senders")
+    shards_parser.add_argument("--text-size", type=int, default=100)
+    shards_parser.add_argument("--port", type=int, default=6101)
+    shards_parser.add_argument("--discovery-port", type=int, default=6110)
+    shards_parser.set_defaults(run=run_shards_benchmark)
+
+    workers_parser = subparsers.add_parser("workers", help="relay throughput of pre-forked SO_REUSEPORT workers")
+    workers_parser.add_argument("--worker-counts", type=int, nargs="+", default=[1, 2, 4])
+    workers_parser.add_argument("--clients", type=int, default=200)
+    workers_parser.add_argument("--senders", type=int, default=20)
+    workers_parser.add_argument("--messages", type=int, default=2000)
+    workers_parser.add_argument("--rate", type=int, default=500, help="messages/sec over all senders")
+    workers_parser.add_argument("--text-size", type=int, default=100)
+    workers_parser.add_argument("--port", type=int, default=6201)
+    workers_parser.add_argument("--discovery-port", type=int, default=6210)
+    workers_parser.set_defaults(run=run_workers_benchmark)
+
+    detector_parser = subparsers.add_parser("detector", help="failure detection latency vs false suspicions")
+    detector_parser.add_argument("--jitter", type=float, nargs="+", default=[0.005, 0.05, 0.1, 0.2],
+                                 help="standard deviation of heartbeat intervals, seconds")
+    detector_parser.add_argument("--pause-rate", type=float, default=0.01, help="share of delayed heartbeats")
+    detector_parser.add_argument("--max-pause", type=float, default=0.5, help="seconds")
+    detector_parser.add_argument("--beats", type=int, default=100000)
+    detector_parser.add_argument("--seed", type=int, default=1)
+    detector_parser.set_defaults(run=run_detector_benchmark)
+
+    election_parser = subparsers.add_parser("election", help="simulated time-to-leader under packet loss")
+    election_parser.add_argument("--server-counts", type=int, nargs="+", default=[3, 5, 9])
+    election_parser.add_argument("--loss", type=float, nargs="+", default=[0.0, 0.1, 0.3, 0.5])
+    election_parser.add_argument("--trials", type=int, default=200)
+    election_parser.add_argument("--latency-min", type=float, default=0.0005, help="seconds")
+    election_parser.add_argument("--latency-max", type=float, default=0.005, help="seconds")
+    election_parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL)
+    election_parser.add_argument("--limit", type=float, default=120.0, help="simulated seconds per trial")
+    election_parser.add_argument("--seed", type=int, default=1)
+    election_parser.set_defaults(run=run_election_benchmark)
+
+    registry_parser = subparsers.add_parser("registry", help="discovery and election cost against known servers")
+    registry_parser.add_argument("--server-counts", type=int, nargs="+", default=[10, 100, 1000])
+    registry_parser.add_argument("--duration", type=float, default=1.0)
+    registry_parser.add_argument("--discovery-port", type=int, default=6010)
+    registry_parser.set_defaults(run=run_registry_benchmark)
+
+    transport_parser = subparsers.add_parser("transport", help="sendmmsg vs portable sendto fan-out")
+    transport_parser.add_argument("--clients", type=int, default=2000)
+    transport_parser.add_argument("--messages", type=int, default=200)
+    transport_parser.add_argument("--text-size", type=int, default=200)
+    transport_parser.add_argument("--discovery-port", type=int, default=6010)
+    transport_parser.set_defaults(run=run_transport_benchmark)
+
+    e2e_parser = subparsers.add_parser("e2e", help="server processes against a headless client swarm")
+    e2e_parser.add_argument("--servers", type=int, default=2)
+    e2e_parser.add_argument("--engine", choices=["threaded", "asyncio"], default="asyncio")
+    e2e_parser.add_argument("--clients", type=int, default=100)
+    e2e_parser.add_argument("--senders", type=int, default=10)
+    e2e_parser.add_argument("--messages", type=int, default=2000)
+    e2e_parser.add_argument("--rate", type=int, default=200, help="messages/sec over all senders")
+    e2e_parser.add_argument("--text-size", type=int, default=100)
+    e2e_parser.add_argument("--codecs", nargs="+", choices=protocol.CODECS, default=list(protocol.CODECS))
+    e2e_parser.add_argument("--failover", action="store_true", help="kill the leader halfway through")
+    e2e_parser.add_argument("--client-rate", type=float, default=0,
+                            help="servers' per-client message rate limit, 0 = unlimited")
+    e2e_parser.add_argument("--port", type=int, default=6401)
+    e2e_parser.add_argument("--discovery-port", type=int, default=6410)
+    e2e_parser.set_defaults(run=run_e2e_benchmark)
+
+    flood_parser = subparsers.add_parser("flood", help="latency under one flooding client, without and with flood control")
+    flood_parser.add_argument("--clients", type=int, default=50)
+    flood_parser.add_argument("--senders", type=int, default=10)
+    flood_parser.add_argument("--messages", type=int, default=500)
+    flood_parser.add_argument("--rate", type=int, default=50, help="messages/sec over all well-behaved senders")
+    flood_parser.add_argument("--text-size", type=int, default=100)
+    flood_parser.add_argument("--client-rate", type=float, default=10.0)
+    flood_parser.add_argument("--relay-budget", type=float, default=100000.0)
+    flood_parser.add_argument("--port", type=int, default=6501)
+    flood_parser.add_argument("--discovery-port", type=int, default=6510)
+    flood_parser.set_defaults(run=run_flood_benchmark)
+
+    coalesce_parser = subparsers.add_parser("coalesce", help="datagrams and latency of a busy room, by batching delay")
+    coalesce_parser.add_argument("--batch-delays", type=float, nargs="+", default=[0, 2, 5, 10],
+                                 help="milliseconds, 0 = no batching")
+    coalesce_parser.add_argument("--clients", type=int, default=100)
+    coalesce_parser.add_argument("--senders", type=int, default=20)
+    coalesce_parser.add_argument("--messages", type=int, default=3000)
+    coalesce_parser.add_argument("--rate", type=int, default=500, help="messages/sec over all senders")
+    coalesce_parser.add_argument("--text-size", type=int, default=60)
+    coalesce_parser.add_argument("--codecs", nargs="+", choices=protocol.CODECS, default=list(protocol.CODECS))
+    coalesce_parser.add_argument("--port", type=int, default=6701)
+    coalesce_parser.add_argument("--discovery-port", type=int, default=6710)
+    coalesce_parser.set_defaults(run=run_coalesce_benchmark)
+
+    compress_parser = subparsers.add_parser("compress", help="bytes vs CPU of chat-dictionary compression")
+    compress_parser.add_argument("--thresholds", type=int, nargs="+", default=[0, 64, COMPRESS_THRESHOLD, 160],
+                                 help="bypass thresholds (bytes) of the in-process comparison")
+    compress_parser.add_argument("--threshold", type=int, default=COMPRESS_THRESHOLD,
+                                 help="bypass threshold (bytes) of the servers")
+    compress_parser.add_argument("--iterations", type=int, default=2000)
+    compress_parser.add_argument("--batch-delay", type=float, default=5, help="milliseconds, for the batched runs")
+    compress_parser.add_argument("--clients", type=int, default=100)
+    compress_parser.add_argument("--senders", type=int, default=20)
+    compress_parser.add_argument("--messages", type=int, default=1500)
+    compress_parser.add_argument("--rate", type=int, default=250, help="messages/sec over all senders")
+    compress_parser.add_argument("--codecs", nargs="+", choices=protocol.CODECS, default=list(protocol.CODECS))
+    compress_parser.add_argument("--port", type=int, default=6721)
+    compress_parser.add_argument("--discovery-port", type=int, default=6730)
+    compress_parser.set_defaults(run=run_compress_benchmark)
+
+    rejoin_parser = subparsers.add_parser("rejoin", help="join storm and mass rejoin, without and with resume tokens")
+    rejoin_parser.add_argument("--clients", type=int, default=500)
+    rejoin_parser.add_argument("--port", type=int, default=6601)
+    rejoin_parser.add_argument("--discovery-port", type=int, default=6610)
+    rejoin_parser.set_defaults(run=run_rejoin_benchmark)
+
+    render_parser = subparsers.add_parser("render", help="chat window rendering: per-message vs batched")
+    render_parser.add_argument("--message-counts", type=int, nargs="+", default=[1000, 5000, 20000])
+    render_parser.add_argument("--text-size", type=int, default=60)
+    render_parser.add_argument("--scrollback", type=int, default=500,
+                               help="messages kept rendered (0 = unbounded)")
+    render_parser.add_argument("--discovery-port", type=int, default=6310)
+    render_parser.set_defaults(run=run_render_benchmark)
+
+    sessions_parser = subparsers.add_parser("sessions", help="client table memory and idle-session sweep cost")
+    sessions_parser.add_argument("--client-counts", type=int, nargs="+", default=[1000, 10000, 100000])
+    sessions_parser.add_argument("--keepalive", type=float, default=10.0, help="seconds between keepalives")
+    sessions_parser.add_argument("--ticks", type=int, default=100, help="sweeps simulated")
+    sessions_parser.add_argument("--seed", type=int, default=1)
+    sessions_parser.set_defaults(run=run_sessions_benchmark)
+
+    protocol_parser = subparsers.add_parser("protocol", help="JSON vs binary frame size and codec cost")
+    protocol_parser.add_argument("--text-size", type=int, default=40)
+    protocol_parser.add_argument("--iterations", type=int, default=100000)
+    protocol_parser.set_defaults(run=run_protocol_benchmark)
+
+    args = parser.parse_args()
+    results = args.run(args)
+    if args.json:
+        parameters = {name: value for name, value in vars(args).items() if name not in ("run", "json")}
+        with open(args.json, "w") as output:
+            json.dump({"scenario": args.scenario, "parameters": parameters, "results": results},
+                      output, indent=2)
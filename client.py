@@ -1,351 +1,843 @@
-import socket
-import json
-import threading
-import uuid
-import tkinter as tk
-from tkinter import scrolledtext
-from datetime import datetime
-import time
-
-
-
-class MessagingApp:
-    
-    def __init__(self, root, discovery_port=5010):
-
-        # Discovery port and multicast group
-        self.discovery_port = discovery_port
-        self.multicast_group = '224.1.1.1'
-
-        # Discovery socket for server communication
-        self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.discovery_socket.bind(('', self.discovery_port))
-        
-        # Join multicast group
-        mreq = socket.inet_aton(self.multicast_group) + socket.inet_aton('0.0.0.0')
-        self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-        self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-
-        # Client socket for messages
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.client_socket.bind(('', 0))
-
-        # Server connection data
-        self.server_id = None
-        self.server_address = None
-
-        # Client identification
-        self.id = str(uuid.uuid4())
-        self.port = self.client_socket.getsockname()[1]
-        self.username = ""
-
-        # Connection monitoring
-        self.last_heartbeat = time.time()
-        self.is_connected = False
-        self.reconnecting = False
-
-        # UI setup
-        self.root = root
-        self.root.title("Instant Messenger")
-        self.root.geometry("400x700")
-        self.root.configure(bg='#E5DDD5')
-        
-        # Color scheme
-        self.theme_colors = {
-            'header_green': '#075E54',
-            'header_dark_green': '#054C44',
-            'chat_bg': '#E5DDD5',
-            'text_primary': '#303030',
-            'text_secondary': '#667781',
-            'text_white': '#FFFFFF',
-            'input_bg': '#FFFFFF'
-        }
-        
-        self.create_interface()
-        
-        # Handle window closing
-        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
-
-        # Start background threads
-        threading.Thread(target=self.find_server, daemon=True).start()
-        threading.Thread(target=self.receive_messages, daemon=True).start()
-        threading.Thread(target=self.monitor_heartbeat, daemon=True).start()
-
-    def create_interface(self):
-
-        # Main container
-        main_frame = tk.Frame(self.root, bg=self.theme_colors['chat_bg'])
-        main_frame.pack(fill=tk.BOTH, expand=True)
-        
-        # Header
-        header_frame = tk.Frame(main_frame, bg=self.theme_colors['header_green'], height=60)
-        header_frame.pack(fill=tk.X)
-        header_frame.pack_propagate(False)
-        
-        header_content = tk.Frame(header_frame, bg=self.theme_colors['header_green'])
-        header_content.pack(fill=tk.BOTH, padx=15, pady=10)
-        
-        title_label = tk.Label(header_content, text="💬 Group Chat", 
-                              font=('Segoe UI', 16, 'bold'), 
-                              fg=self.theme_colors['text_white'], 
-                              bg=self.theme_colors['header_green'])
-        title_label.pack(side=tk.LEFT)
-        
-        self.status_label = tk.Label(header_content, text="🔍 Connecting...", 
-                                    font=('Segoe UI', 10), 
-                                    fg=self.theme_colors['text_white'], 
-                                    bg=self.theme_colors['header_green'])
-        self.status_label.pack(side=tk.RIGHT)
-        
-        # Chat area
-        chat_container = tk.Frame(main_frame, bg=self.theme_colors['chat_bg'])
-        chat_container.pack(fill=tk.BOTH, expand=True)
-        
-        self.chat_display = scrolledtext.ScrolledText(
-            chat_container, 
-            wrap=tk.WORD, 
-            height=20, 
-            width=50,
-            font=('Segoe UI', 11),
-            bg=self.theme_colors['chat_bg'],
-            fg=self.theme_colors['text_primary'],
-            insertbackground=self.theme_colors['text_primary'],
-            selectbackground=self.theme_colors['header_green'],
-            relief=tk.FLAT,
-            borderwidth=0,
-            padx=10,
-            pady=10,
-            spacing1=5,
-            spacing2=2,
-            spacing3=5
-        )
-        self.chat_display.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-        self.chat_display.config(state='disabled')
-        
-        # Input area
-        input_container = tk.Frame(main_frame, bg=self.theme_colors['input_bg'], height=70)
-        input_container.pack(fill=tk.X, padx=10, pady=10)
-        input_container.pack_propagate(False)
-        
-        input_inner = tk.Frame(input_container, bg=self.theme_colors['input_bg'])
-        input_inner.pack(fill=tk.BOTH, padx=10, pady=10)
-
-        # Message input
-        self.message_input = tk.Entry(
-            input_inner, 
-            font=('Segoe UI', 12),
-            bg=self.theme_colors['input_bg'],
-            fg=self.theme_colors['text_primary'],
-            insertbackground=self.theme_colors['text_primary'],
-            relief=tk.FLAT,
-            borderwidth=0
-        )
-        self.message_input.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 10))
-        self.message_input.bind("<Return>", lambda event: self.send_message_from_ui())
-        
-        self.send_button = tk.Button(
-            input_inner, 
-            text="➤",
-            command=self.send_message_from_ui,
-            font=('Segoe UI', 16, 'bold'),
-            bg=self.theme_colors['header_green'],
-            fg=self.theme_colors['text_white'],
-            activebackground=self.theme_colors['header_dark_green'],
-            activeforeground=self.theme_colors['text_white'],
-            relief=tk.FLAT,
-            borderwidth=0,
-            cursor='hand2',
-            width=3,
-            height=1
-        )
-        self.send_button.pack(side=tk.RIGHT)
-        
-        # Hover effects
-        self.send_button.bind('<Enter>', lambda e: self.send_button.configure(bg=self.theme_colors['header_dark_green']))
-        self.send_button.bind('<Leave>', lambda e: self.send_button.configure(bg=self.theme_colors['header_green']))
-
-    def find_server(self):
-
-        # Listen for heartbeats from leader
-        self.display_message("🔍 Connecting to server...", "system")
-        while True:
-            response, address = self.discovery_socket.recvfrom(1024)
-            data = json.loads(response.decode())
-            
-            # Accept both heartbeat and discover messages from leader
-            if data["type"] in ["heartbeat", "discover"] and data.get("isLeader", False):
-                server_id = data['id']
-                
-                # Update heartbeat time
-                self.last_heartbeat = time.time()
-                
-                if self.server_id != server_id:
-                    self.server_id = server_id
-                    self.server_address = (address[0], data["port"])
-                    self.is_connected = True
-                    self.reconnecting = False
-                    self.join_server()
-                    self.status_label.config(text="🟢 Online")
-                    self.display_message(f"✅ Connected to server", "system")
-
-    def monitor_heartbeat(self):
-
-        while True:
-            time.sleep(5)  # Check every 5 seconds
-            
-            if self.is_connected and not self.reconnecting:
-                time_since_heartbeat = time.time() - self.last_heartbeat
-                
-                # If no heartbeat for 15 seconds, consider server lost
-                if time_since_heartbeat > 15:
-                    self.is_connected = False
-                    self.reconnecting = True
-                    self.server_address = None
-                    self.server_id = None
-                    
-                    # Update status and show reconnecting message
-                    self.status_label.config(text="🔄 Reconnecting...")
-                    self.display_message("🔌 Connection lost. Reconnecting to server...", "system")
-                    print(f"Server connection lost after {time_since_heartbeat:.1f}s without heartbeat")
-
-    def join_server(self):
-
-        # Send JOIN request to leader server
-        join_message = {
-            "type": "join",
-            "id": self.id,
-            "port": self.port
-        }
-        self.client_socket.sendto(json.dumps(
-            join_message).encode(), self.server_address)
-        self.display_message("🔗 Joined chat!", "system")
-
-    def send_message_from_ui(self):
-
-        # Send message from UI
-        message = self.message_input.get().strip()
-        if message:
-            if self.is_connected and not self.reconnecting:
-                self.transmit_message(message)
-                self.message_input.delete(0, tk.END)
-                self.display_message(f"{message}", "own")
-            else:
-                self.display_message("❌ Cannot send message - not connected to server", "error")
-
-    def transmit_message(self, message):
-
-        # Send message to leader server
-        if self.server_address and self.is_connected:
-            try:
-                msg = json.dumps({
-                    "type": "message",
-                    "id": self.id,
-                    "text": message
-                })
-                self.client_socket.sendto(msg.encode(), self.server_address)
-            except Exception as e:
-                self.display_message(f"❌ Error sending message: {e}", "error")
-                # Mark as disconnected if send fails
-                self.is_connected = False
-                self.reconnecting = True
-                self.status_label.config(text="�� Reconnecting...")
-
-    def receive_messages(self):
-
-        # Listen for incoming messages from server
-        while True:
-            try:
-                response, _ = self.client_socket.recvfrom(1024)
-                data = json.loads(response.decode())
-
-                if data["type"] == "welcome":
-                    # Receive username from server after connection
-                    self.username = data["name"]
-                    self.display_message(f"🎉 Welcome to the chat!", "system")
-
-                elif data["type"] == "message":
-                    # Receive message from another client (forwarded by server)
-                    sender_name = data.get("sender_name", "Unknown")
-                    self.display_message(f"{data['text']}", "other", sender_name)
-
-                elif data["type"] == "notice":
-                    # System message (client joined/left)
-                    self.display_message(f"🔔 {data['text']}", "system")
-
-            except Exception as e:
-                # Only show error if we're supposed to be connected
-                if self.is_connected:
-                    self.display_message(f"❌ Reception error: {e}", "error")
-                    # Mark as disconnected if receive fails
-                    self.is_connected = False
-                    self.reconnecting = True
-                    self.status_label.config(text="🔄 Reconnecting...")
-                    self.display_message("🔌 Connection lost. Reconnecting to server...", "system")
-
-    def on_close(self):
-
-        # Send leave message to server when closing
-        if self.server_address and self.is_connected:
-            leave_message = {
-                "type": "leave",
-                "id": self.id
-            }
-            try:
-                self.client_socket.sendto(json.dumps(
-                    leave_message).encode(), self.server_address)
-            except:
-                pass  # Ignore errors when closing
-        self.root.destroy()
-
-    def display_message(self, message, message_type="normal", sender_name=""):
-
-        timestamp = datetime.now().strftime("%H:%M")
-        
-        self.chat_display.config(state='normal')
-        
-        if message_type == "system":
-            self.chat_display.insert(tk.END, f"\n", "normal")
-            self.chat_display.insert(tk.END, f"  {message}  ", "system")
-            self.chat_display.insert(tk.END, f"\n", "normal")
-            
-        elif message_type == "own":
-            self.chat_display.insert(tk.END, f"\n", "normal")
-            self.chat_display.insert(tk.END, f"                                    {message}", "own_message")
-            self.chat_display.insert(tk.END, f" {timestamp}", "timestamp_own")
-            self.chat_display.insert(tk.END, f"\n", "normal")
-            
-        elif message_type == "other":
-            self.chat_display.insert(tk.END, f"\n", "normal")
-            if sender_name:
-                self.chat_display.insert(tk.END, f"{sender_name}\n", "sender_name")
-            self.chat_display.insert(tk.END, f"{message}", "other_message")
-            self.chat_display.insert(tk.END, f" {timestamp}", "timestamp_other")
-            self.chat_display.insert(tk.END, f"\n", "normal")
-            
-        elif message_type == "error":
-            self.chat_display.insert(tk.END, f"\n", "normal")
-            self.chat_display.insert(tk.END, f"  ❌ {message}  ", "error")
-            self.chat_display.insert(tk.END, f"\n", "normal")
-        
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state='disabled')
-        
-        # Configure message tags
-        self.chat_display.tag_config("normal", foreground=self.theme_colors['text_primary'], font=('Segoe UI', 11))
-        self.chat_display.tag_config("system", foreground=self.theme_colors['text_secondary'], font=('Segoe UI', 10), justify='center')
-        self.chat_display.tag_config("own_message", foreground=self.theme_colors['text_primary'], font=('Segoe UI', 11), justify='right')
-        self.chat_display.tag_config("other_message", foreground=self.theme_colors['text_primary'], font=('Segoe UI', 11), justify='left')
-        self.chat_display.tag_config("sender_name", foreground=self.theme_colors['header_green'], font=('Segoe UI', 10, 'bold'), justify='left')
-        self.chat_display.tag_config("timestamp_own", foreground=self.theme_colors['text_secondary'], font=('Segoe UI', 9), justify='right')
-        self.chat_display.tag_config("timestamp_other", foreground=self.theme_colors['text_secondary'], font=('Segoe UI', 9), justify='left')
-        self.chat_display.tag_config("error", foreground='#FF0000', font=('Segoe UI', 10), justify='center')
-
-
-if __name__ == "__main__":
-
-    # Start the application
-    root = tk.Tk()
-    app = MessagingApp(root)
-    root.mainloop()
+import socket
+import collections
+import itertools
+import json
+import queue
+import threading
+import uuid
+import tkinter as tk
+from tkinter import scrolledtext
+from datetime import datetime
+import time
+
+import protocol
+from coalescing import unpack_batch
+from compression import decompress
+from fragmentation import Fragmenter, Reassembler, RECV_BUFFER_SIZE
+from reliability import ReliableChannel, ACK_INTERVAL
+from failure_detector import PhiAccrualDetector, HEARTBEAT_INTERVAL
+from sessions import KEEPALIVE_INTERVAL
+
+
+# While reconnecting, all recently seen servers are probed this often (seconds)
+PROBE_INTERVAL = 0.25
+# Servers not heard from for this long are no longer probed
+SERVER_CACHE_TTL = 60
+# A redirect to the server we were just redirected to is ignored for this long
+REDIRECT_HOLDOFF = 0.5
+
+# The Tk thread renders queued messages this often (milliseconds), at most
+# MAX_RENDER_BATCH of them per frame so a flood cannot freeze the window
+RENDER_INTERVAL_MS = 30
+MAX_RENDER_BATCH = 1000
+
+# Messages kept rendered in the chat window; older ones move to an in-memory
+# archive of ARCHIVE_SIZE messages and are loaded back LOAD_MORE at a time when
+# the user scrolls to the top
+SCROLLBACK_MESSAGES = 500
+ARCHIVE_SIZE = 10000
+LOAD_MORE = 100
+
+
+class MessagingApp:
+    
+    def __init__(self, root, discovery_port=5010, codecs=protocol.CODECS, features=protocol.FEATURES,
+                 history_size=50, scrollback=SCROLLBACK_MESSAGES, archive_size=ARCHIVE_SIZE):
+
+        # Discovery port and multicast group
+        self.discovery_port = discovery_port
+        self.multicast_group = '224.1.1.1'
+
+        # Discovery socket for server communication
+        self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.discovery_socket.bind(('', self.discovery_port))
+        
+        # Join multicast group
+        mreq = socket.inet_aton(self.multicast_group) + socket.inet_aton('0.0.0.0')
+        self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+
+        # Client socket for messages
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.client_socket.bind(('', 0))
+
+        # Server connection data
+        self.server_id = None
+        self.server_address = None
+        # Sharded servers: the server owning our session, which may not be the leader
+        self.owner_id = None
+
+        # Client identification
+        self.id = str(uuid.uuid4())
+        self.port = self.client_socket.getsockname()[1]
+        self.username = ""
+        # Token from the last welcome: joining again with it keeps our name and room
+        self.resume_token = None
+
+        # Wire codec: JSON until the server's welcome agrees on another one
+        self.offered_codecs = list(codecs)
+        self.codec = "json"
+
+        # Long messages travel as MTU-sized fragments
+        self.fragmenter = Fragmenter()
+        self.reassembler = Reassembler(max_pending=64)
+
+        # Session features offered at join and those the server accepted
+        self.offered_features = list(features)
+        self.features = []
+        # Reliable, ordered session with the leader (shared by UI, receive and timer threads)
+        self.channel = None
+        self.channel_lock = threading.Lock()
+
+        # Current chat room, switched with "/join <room>" and "/leave"
+        self.room = protocol.DEFAULT_ROOM
+
+        # Stored messages of the room replayed on join, and the newest sequence number seen so far
+        self.history_size = history_size
+        self.last_seq = 0
+        # Newer messages than this reach us live, so replay stops here
+        self.replay_until = 0
+
+        # Connection monitoring: the leader's heartbeats train a failure detector
+        self.last_heartbeat = time.time()
+        self.failure_detector = PhiAccrualDetector()
+        # Every server heard from recently, probed all at once when the connection is lost
+        self.known_servers = {}  # server_id: ((ip, port), last heard from)
+        self.redirected_at = {}  # server_id: when a redirect last sent us there
+        self.last_probe = 0.0
+        self.last_keepalive = 0.0  # the server evicts sessions it has not heard from for a while
+        self.is_connected = False
+        self.reconnecting = False
+        # The server asked us to slow down: sending waits until this time
+        self.send_blocked_until = 0.0
+
+        # UI setup
+        self.root = root
+        self.root.title("Instant Messenger")
+        self.root.geometry("400x700")
+        self.root.configure(bg='#E5DDD5')
+        
+        # Color scheme
+        self.theme_colors = {
+            'header_green': '#075E54',
+            'header_dark_green': '#054C44',
+            'chat_bg': '#E5DDD5',
+            'text_primary': '#303030',
+            'text_secondary': '#667781',
+            'text_white': '#FFFFFF',
+            'input_bg': '#FFFFFF'
+        }
+        
+        # Messages and label updates from any thread, rendered on the Tk thread in batches
+        self.render_queue = queue.SimpleQueue()
+        # Bounded scrollback (0 = keep every message rendered): the messages in the
+        # window as (segments, line count), older ones and, while the user reads
+        # back, newer ones that do not fit in the window
+        self.scrollback = scrollback
+        self.rendered = collections.deque()
+        self.archive = collections.deque(maxlen=archive_size)
+        self.newer = collections.deque()
+        self.scroll_load_pending = False
+
+        self.create_interface()
+        self.root.after(RENDER_INTERVAL_MS, self.drain_render_queue)
+        
+        # Handle window closing
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        # Start background threads
+        threading.Thread(target=self.find_server, daemon=True).start()
+        threading.Thread(target=self.receive_messages, daemon=True).start()
+        threading.Thread(target=self.monitor_heartbeat, daemon=True).start()
+        threading.Thread(target=self.maintain_reliable_channel, daemon=True).start()
+
+    def create_interface(self):
+
+        # Main container
+        main_frame = tk.Frame(self.root, bg=self.theme_colors['chat_bg'])
+        main_frame.pack(fill=tk.BOTH, expand=True)
+        
+        # Header
+        header_frame = tk.Frame(main_frame, bg=self.theme_colors['header_green'], height=60)
+        header_frame.pack(fill=tk.X)
+        header_frame.pack_propagate(False)
+        
+        header_content = tk.Frame(header_frame, bg=self.theme_colors['header_green'])
+        header_content.pack(fill=tk.BOTH, padx=15, pady=10)
+        
+        self.title_label = tk.Label(header_content, text=f"💬 #{self.room}", 
+                              font=('Segoe UI', 16, 'bold'), 
+                              fg=self.theme_colors['text_white'], 
+                              bg=self.theme_colors['header_green'])
+        self.title_label.pack(side=tk.LEFT)
+        
+        self.status_label = tk.Label(header_content, text="🔍 Connecting...", 
+                                    font=('Segoe UI', 10), 
+                                    fg=self.theme_colors['text_white'], 
+                                    bg=self.theme_colors['header_green'])
+        self.status_label.pack(side=tk.RIGHT)
+        
+        # Chat area
+        chat_container = tk.Frame(main_frame, bg=self.theme_colors['chat_bg'])
+        chat_container.pack(fill=tk.BOTH, expand=True)
+        
+        self.chat_display = scrolledtext.ScrolledText(
+            chat_container, 
+            wrap=tk.WORD, 
+            height=20, 
+            width=50,
+            font=('Segoe UI', 11),
+            bg=self.theme_colors['chat_bg'],
+            fg=self.theme_colors['text_primary'],
+            insertbackground=self.theme_colors['text_primary'],
+            selectbackground=self.theme_colors['header_green'],
+            relief=tk.FLAT,
+            borderwidth=0,
+            padx=10,
+            pady=10,
+            spacing1=5,
+            spacing2=2,
+            spacing3=5
+        )
+        self.chat_display.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.chat_display.config(state='disabled')
+        self.chat_display.config(yscrollcommand=self.on_chat_scroll)
+        self.configure_tags()
+        
+        # Input area
+        input_container = tk.Frame(main_frame, bg=self.theme_colors['input_bg'], height=70)
+        input_container.pack(fill=tk.X, padx=10, pady=10)
+        input_container.pack_propagate(False)
+        
+        input_inner = tk.Frame(input_container, bg=self.theme_colors['input_bg'])
+        input_inner.pack(fill=tk.BOTH, padx=10, pady=10)
+
+        # Message input
+        self.message_input = tk.Entry(
+            input_inner, 
+            font=('Segoe UI', 12),
+            bg=self.theme_colors['input_bg'],
+            fg=self.theme_colors['text_primary'],
+            insertbackground=self.theme_colors['text_primary'],
+            relief=tk.FLAT,
+            borderwidth=0
+        )
+        self.message_input.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 10))
+        self.message_input.bind("<Return>", lambda event: self.send_message_from_ui())
+        
+        self.send_button = tk.Button(
+            input_inner, 
+            text="➤",
+            command=self.send_message_from_ui,
+            font=('Segoe UI', 16, 'bold'),
+            bg=self.theme_colors['header_green'],
+            fg=self.theme_colors['text_white'],
+            activebackground=self.theme_colors['header_dark_green'],
+            activeforeground=self.theme_colors['text_white'],
+            relief=tk.FLAT,
+            borderwidth=0,
+            cursor='hand2',
+            width=3,
+            height=1
+        )
+        self.send_button.pack(side=tk.RIGHT)
+        
+        # Hover effects
+        self.send_button.bind('<Enter>', lambda e: self.send_button.configure(bg=self.theme_colors['header_dark_green']))
+        self.send_button.bind('<Leave>', lambda e: self.send_button.configure(bg=self.theme_colors['header_green']))
+
+    def find_server(self):
+
+        # Listen for heartbeats from leader
+        self.display_message("🔍 Connecting to server...", "system")
+        while True:
+            response, address = self.discovery_socket.recvfrom(RECV_BUFFER_SIZE)
+            data = json.loads(response.decode())
+            if data["type"] in ["heartbeat", "discover"]:
+                self.known_servers[data['id']] = ((address[0], data["port"]), time.time())
+            
+            # Accept both heartbeat and discover messages from leader
+            if data["type"] in ["heartbeat", "discover"] and data.get("isLeader", False):
+                server_id = data['id']
+                
+                # Update heartbeat time
+                self.last_heartbeat = time.time()
+                if data["type"] == "heartbeat":
+                    self.failure_detector.heartbeat(server_id, self.last_heartbeat)
+
+                # Sharded servers list the live shards: re-join if ours is gone
+                shards = data.get("shards")
+                if self.owner_id is not None and shards is not None and self.owner_id not in shards:
+                    self.owner_id = None
+                    self.server_id = None
+                
+                if self.server_id != server_id:
+                    if self.owner_id is not None and shards is not None and self.server_address is not None:
+                        # Only the coordinator changed; our own shard server is still there
+                        self.server_id = server_id
+                        self.is_connected = True
+                        self.reconnecting = False
+                        self.set_label(self.status_label, "🟢 Online")
+                        continue
+                    self.connect_to_server(server_id, (address[0], data["port"]))
+
+    def connect_to_server(self, server_id, server_address):
+
+        # Join the leader at server_address
+        self.server_id = server_id
+        self.is_connected = True
+        self.reconnecting = False
+        self.set_label(self.status_label, "🟢 Online")
+        self.server_address = server_address
+        self.join_server()
+        self.display_message(f"✅ Connected to server", "system")
+
+    def probe_known_servers(self):
+
+        # Ask every recently heard-from server at once who leads; the first redirect wins
+        self.last_probe = time.time()
+        probe = json.dumps({"type": "probe", "id": self.id}).encode()
+        for server_address, heard in list(self.known_servers.values()):
+            if self.last_probe - heard < SERVER_CACHE_TTL:
+                try:
+                    self.client_socket.sendto(probe, server_address)
+                except OSError as e:
+                    print(f"Probe error to {server_address}: {e}")
+
+    def monitor_heartbeat(self):
+
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL / 5)
+            
+            if self.is_connected and not self.reconnecting:
+                now = time.time()
+                time_since_heartbeat = now - self.last_heartbeat
+                
+                # Server lost once the failure detector suspects it (servers that only
+                # send discovery messages: after 15 seconds without one)
+                if self.server_id in self.failure_detector:
+                    lost = self.failure_detector.suspected(self.server_id, now)
+                else:
+                    lost = time_since_heartbeat > 15
+                if lost:
+                    self.failure_detector.remove(self.server_id)
+                    self.is_connected = False
+                    self.reconnecting = True
+                    self.server_address = None
+                    self.server_id = None
+                    
+                    # Update status and show reconnecting message
+                    self.set_label(self.status_label, "🔄 Reconnecting...")
+                    self.display_message("🔌 Connection lost. Reconnecting to server...", "system")
+                    print(f"Server connection lost after {time_since_heartbeat:.1f}s without heartbeat")
+
+            if self.reconnecting and time.time() - self.last_probe >= PROBE_INTERVAL:
+                self.probe_known_servers()
+            elif self.is_connected and time.time() - self.last_keepalive >= KEEPALIVE_INTERVAL:
+                self.send_keepalive()
+
+    def send_keepalive(self):
+
+        # Keep our session alive on the server while we have nothing to say
+        self.last_keepalive = time.time()
+        try:
+            keepalive = protocol.encode({"type": "keepalive", "id": self.id}, self.codec)
+            self.client_socket.sendto(keepalive, self.server_address)
+        except (OSError, TypeError) as e:
+            print(f"Keepalive error: {e}")
+
+    def join_server(self):
+
+        # Send JOIN request to leader server, offering our codecs and features
+        self.codec = "json"
+        self.features = []
+        self.owner_id = None
+        with self.channel_lock:
+            self.channel = ReliableChannel() if "reliable" in self.offered_features else None
+        join_message = {
+            "type": "join",
+            "id": self.id,
+            "port": self.port,
+            "codecs": self.offered_codecs,
+            "features": self.offered_features
+        }
+        if self.resume_token is not None:
+            # Rejoin: present our session and how far we got in our room's messages
+            join_message["resume"] = self.resume_token
+            join_message["room"] = self.room
+            join_message["last_seq"] = self.last_seq
+        self.client_socket.sendto(json.dumps(
+            join_message).encode(), self.server_address)
+        self.display_message("🔗 Joined chat!", "system")
+
+    def send_message_from_ui(self):
+
+        # Send message from UI
+        message = self.message_input.get().strip()
+        if message:
+            if self.is_connected and not self.reconnecting:
+                wait = self.send_blocked_until - time.time()
+                if wait > 0:
+                    # Keep the text in the input box for when the server accepts messages again
+                    self.display_message(f"⏳ Slow down: try again in {wait:.1f}s", "error")
+                    return
+                if message.startswith("/join ") or message == "/leave":
+                    self.message_input.delete(0, tk.END)
+                    self.switch_room(message[6:].strip() if message != "/leave" else None)
+                elif message == "/who" or message.startswith("/who "):
+                    # Who is in the room, a page of names at a time: "/who 2"
+                    self.message_input.delete(0, tk.END)
+                    page = message[5:].strip()
+                    self.request_roster(int(page) - 1 if page.isdigit() and int(page) > 0 else 0)
+                elif self.transmit_message(message):
+                    self.message_input.delete(0, tk.END)
+                    self.display_message(f"{message}", "own")
+            else:
+                self.display_message("❌ Cannot send message - not connected to server", "error")
+
+    def transmit_message(self, message):
+
+        # Send message to leader server
+        if self.server_address and self.is_connected:
+            try:
+                msg = protocol.encode({
+                    "type": "message",
+                    "id": self.id,
+                    "text": message
+                }, self.codec)
+                for fragment in self.fragmenter.split(msg):
+                    with self.channel_lock:
+                        if self.channel is not None and "reliable" in self.features:
+                            fragment = self.channel.wrap(fragment)
+                    self.client_socket.sendto(fragment, self.server_address)
+                return True
+            except ValueError as e:
+                # Too long to send, but the connection is fine
+                self.display_message(f"❌ Message not sent: {e}", "error")
+            except Exception as e:
+                self.display_message(f"❌ Error sending message: {e}", "error")
+                # Mark as disconnected if send fails
+                self.is_connected = False
+                self.reconnecting = True
+                self.set_label(self.status_label, "🔄 Reconnecting...")
+        return False
+
+    def receive_messages(self):
+
+        # Listen for incoming messages from server
+        while True:
+            try:
+                response, address = self.client_socket.recvfrom(RECV_BUFFER_SIZE)
+                # Reliable frames come out of the channel in order; plain ones pass through
+                with self.channel_lock:
+                    if self.channel is not None:
+                        payloads = self.channel.on_datagram(response)
+                    else:
+                        payloads = [response]
+                for payload in payloads:
+                    self.receive_server_datagram(payload, address)
+
+            except Exception as e:
+                # Only show error if we're supposed to be connected
+                if self.is_connected:
+                    self.display_message(f"❌ Reception error: {e}", "error")
+                    # Mark as disconnected if receive fails
+                    self.is_connected = False
+                    self.reconnecting = True
+                    self.set_label(self.status_label, "🔄 Reconnecting...")
+                    self.display_message("🔌 Connection lost. Reconnecting to server...", "system")
+
+    def receive_server_datagram(self, payload, address):
+
+        # Handle one datagram from the server, on its own or out of the reliable channel;
+        # with "compress" it may be deflated, and with "batch" carry several frames
+        for frame in unpack_batch(decompress(payload)):
+            self.receive_server_payload(frame, address)
+
+    def receive_server_payload(self, payload, address):
+
+        # Handle one frame from the server, once all its fragments arrived
+        payload = self.reassembler.feed(payload, address)
+        if payload is None:
+            return
+        data = protocol.decode(payload)
+
+        if data["type"] == "welcome":
+            # Receive username and what was negotiated from server after connection
+            self.username = data["name"]
+            self.resume_token = data.get("resume", self.resume_token)
+            self.codec = data.get("codec", "json")
+            self.features = data.get("features", [])
+            if data.get("owner"):
+                # Sharded: the server that sent the welcome owns our session from now on
+                self.owner_id = data["owner"]
+                self.server_address = address
+            self.display_message(f"🎉 Welcome to the chat!", "system")
+            if data.get("room", protocol.DEFAULT_ROOM) != self.room:
+                # A new session starts in the default room
+                self.set_room(data.get("room", protocol.DEFAULT_ROOM))
+            if data.get("replaying"):
+                # The server already replays what we missed since last_seq
+                self.replay_until = data["log_seq"]
+            else:
+                self.catch_up(data.get("log_seq", 0))
+
+        elif data["type"] == "room":
+            # The server moved us to another room: show its recent history
+            self.set_room(data["room"])
+            self.display_message(f"📍 Now in #{data['room']} ({data['members']} online)", "system")
+            self.catch_up(data["log_seq"])
+
+        elif data["type"] == "message":
+            # Receive message from another client (forwarded by server)
+            sender_name = data.get("sender_name", "Unknown")
+            if data.get("room", self.room) != self.room:
+                return  # still in flight from the room we just left
+            self.last_seq = max(self.last_seq, data.get("seq", 0))
+            self.display_message(f"{data['text']}", "other", sender_name)
+
+        elif data["type"] == "history":
+            # A batch of stored messages, oldest first
+            for message in data["messages"]:
+                if message["seq"] > self.replay_until or message.get("room", self.room) != self.room:
+                    break
+                self.last_seq = max(self.last_seq, message["seq"])
+                if message["id"] == self.id:
+                    self.display_message(f"{message['text']}", "own")
+                else:
+                    self.display_message(f"{message['text']}", "other", message.get("sender_name", "Unknown"))
+            if data["done"] and data["messages"] and data["next"] <= self.replay_until:
+                # The server caps one reply: keep going from where it stopped
+                self.request_history(since=data["next"])
+
+        elif data["type"] == "notice":
+            # System message (client joined/left)
+            self.display_message(f"🔔 {data['text']}", "system")
+
+        elif data["type"] == "presence":
+            # Clients who joined or left the room lately, summed up
+            if data["joined"] + data["left"] > 1:
+                self.display_message(f"🔔 +{data['joined']} joined, -{data['left']} left: {data['text']}", "system")
+            else:
+                self.display_message(f"🔔 {data['text']}", "system")
+
+        elif data["type"] == "roster":
+            # One page of the room's members, asked for with /who
+            more = f" - /who {data['page'] + 2} for more" if data["page"] + 1 < data["pages"] else ""
+            self.display_message(f"👥 #{data['room']}: {data['members']} online, page {data['page'] + 1}/"
+                                 f"{data['pages']}: {', '.join(data['names'])}{more}", "system")
+
+        elif data["type"] == "slow_down":
+            # Flood control dropped or held back some of our messages: hold back for a moment
+            self.send_blocked_until = time.time() + data["retry_ms"] / 1000
+            self.display_message(f"⏳ {data['text']}", "error")
+
+        elif data["type"] == "redirect":
+            # A follower (or a probed server) names the leader: join it right away, unless
+            # we just followed a redirect there (servers briefly disagreeing on the leader)
+            now = time.time()
+            server_address = (data["ip"], data["port"])
+            self.known_servers[data["id"]] = (server_address, now)
+            if server_address == self.server_address and not self.reconnecting:
+                return
+            if now - self.redirected_at.get(data["id"], 0) < REDIRECT_HOLDOFF:
+                return
+            self.redirected_at[data["id"]] = now
+            self.connect_to_server(data["id"], server_address)
+
+        elif data["type"] == "expired":
+            # The server evicted our session (we were silent too long): join again
+            if self.server_address is not None:
+                self.display_message("⌛ Session expired, joining again", "system")
+                self.join_server()
+
+        elif data["type"] == "failover":
+            # A new leader took over our replicated session: switch without re-joining
+            self.server_id = data["id"]
+            self.server_address = (address[0], data["port"])
+            self.last_heartbeat = time.time()
+            self.is_connected = True
+            self.reconnecting = False
+            with self.channel_lock:
+                if self.channel is not None:
+                    self.channel = ReliableChannel()
+            self.set_label(self.status_label, "🟢 Online")
+            self.display_message("🔁 Switched to new leader", "system")
+
+    def set_room(self, room):
+
+        # Enter a room: its sequence numbers start over
+        self.room = room
+        self.last_seq = 0
+        self.replay_until = 0
+        self.set_label(self.title_label, f"💬 #{room}")
+
+    def catch_up(self, log_seq):
+
+        # Catch up from where we were, or fetch the latest messages on a first visit
+        self.replay_until = log_seq
+        if self.replay_until > self.last_seq:
+            if self.last_seq:
+                self.request_history(since=self.last_seq + 1)
+            elif self.history_size:
+                self.request_history(last=self.history_size)
+
+    def switch_room(self, room):
+
+        # Ask the server to move us to another room, or back to the default one
+        if room is None:
+            self.send_request({"type": "leave_room", "id": self.id})
+        elif not protocol.valid_room(room):
+            self.display_message("Room names use 1-32 letters, digits, '-' or '_'", "error")
+        else:
+            self.send_request({"type": "join_room", "id": self.id, "room": room})
+
+    def request_roster(self, page=0):
+
+        self.send_request({"type": "roster_request", "id": self.id, "page": page})
+
+    def request_history(self, last=0, since=0):
+
+        # Ask the server for stored messages: the last `last` ones, or those from seq `since` on
+        self.send_request({
+            "type": "history_request",
+            "id": self.id,
+            "last": last,
+            "since": since
+        })
+
+    def send_request(self, message):
+
+        # Small control request to the leader, over the reliable channel when negotiated
+        request = protocol.encode(message, self.codec)
+        try:
+            with self.channel_lock:
+                if self.channel is not None and "reliable" in self.features:
+                    request = self.channel.wrap(request)
+            self.client_socket.sendto(request, self.server_address)
+        except Exception as e:
+            print(f"{message['type']} request error: {e}")
+
+    def maintain_reliable_channel(self):
+
+        # Flush coalesced ACKs and retransmit unacknowledged messages
+        while True:
+            time.sleep(ACK_INTERVAL)
+            with self.channel_lock:
+                if self.channel is None or self.server_address is None:
+                    continue
+                outgoing, delivered = self.channel.poll()
+                server_address = self.server_address
+            try:
+                for datagram in outgoing:
+                    self.client_socket.sendto(datagram, server_address)
+                for payload in delivered:
+                    self.receive_server_datagram(payload, server_address)
+            except Exception as e:
+                print(f"Reliable channel error: {e}")
+
+    def on_close(self):
+
+        # Send leave message to server when closing
+        if self.server_address and self.is_connected:
+            leave_message = {
+                "type": "leave",
+                "id": self.id
+            }
+            try:
+                self.client_socket.sendto(protocol.encode(
+                    leave_message, self.codec), self.server_address)
+            except:
+                pass  # Ignore errors when closing
+        self.root.destroy()
+
+    def configure_tags(self):
+
+        # Configure message tags, once
+        self.chat_display.tag_config("normal", foreground=self.theme_colors['text_primary'], font=('Segoe UI', 11))
+        self.chat_display.tag_config("system", foreground=self.theme_colors['text_secondary'], font=('Segoe UI', 10), justify='center')
+        self.chat_display.tag_config("own_message", foreground=self.theme_colors['text_primary'], font=('Segoe UI', 11), justify='right')
+        self.chat_display.tag_config("other_message", foreground=self.theme_colors['text_primary'], font=('Segoe UI', 11), justify='left')
+        self.chat_display.tag_config("sender_name", foreground=self.theme_colors['header_green'], font=('Segoe UI', 10, 'bold'), justify='left')
+        self.chat_display.tag_config("timestamp_own", foreground=self.theme_colors['text_secondary'], font=('Segoe UI', 9), justify='right')
+        self.chat_display.tag_config("timestamp_other", foreground=self.theme_colors['text_secondary'], font=('Segoe UI', 9), justify='left')
+        self.chat_display.tag_config("error", foreground='#FF0000', font=('Segoe UI', 10), justify='center')
+
+    def set_label(self, label, text):
+
+        # Thread-safe label update, applied by the Tk thread on its next frame
+        self.render_queue.put((label, text))
+
+    def display_message(self, message, message_type="normal", sender_name=""):
+
+        # Thread-safe: queue the message as (text, tag) pairs for the Tk thread to render
+        timestamp = datetime.now().strftime("%H:%M")
+        
+        if message_type == "system":
+            segments = ("\n", "normal", f"  {message}  ", "system", "\n", "normal")
+            
+        elif message_type == "own":
+            segments = ("\n", "normal", f"                                    {message}", "own_message",
+                        f" {timestamp}", "timestamp_own", "\n", "normal")
+            
+        elif message_type == "other":
+            segments = ("\n", "normal")
+            if sender_name:
+                segments += (f"{sender_name}\n", "sender_name")
+            segments += (f"{message}", "other_message", f" {timestamp}", "timestamp_other", "\n", "normal")
+            
+        elif message_type == "error":
+            segments = ("\n", "normal", f"  ❌ {message}  ", "error", "\n", "normal")
+
+        else:
+            return
+        self.render_queue.put((None, segments))
+
+    def drain_render_queue(self):
+
+        # Tk thread: render everything queued since the last frame with a single insert
+        messages = []
+        labels = {}
+        for _ in range(MAX_RENDER_BATCH):
+            try:
+                label, value = self.render_queue.get_nowait()
+            except queue.Empty:
+                break
+            if label is None:
+                messages.append(value)
+            else:
+                labels[label] = value  # only the latest text of each label matters
+        if messages:
+            self.render_messages(messages)
+        for label, text in labels.items():
+            label.config(text=text)
+        self.root.after(RENDER_INTERVAL_MS, self.drain_render_queue)
+
+    def render_messages(self, messages):
+
+        # Tk thread: append new messages, keeping at most `scrollback` of them rendered
+        if not self.scrollback:
+            self.chat_display.config(state='normal')
+            self.chat_display.insert(tk.END, *itertools.chain.from_iterable(messages))
+            self.chat_display.see(tk.END)
+            self.chat_display.config(state='disabled')
+            return
+        if self.newer:
+            # The user is reading back: new messages wait below the window
+            self.newer.extend(messages)
+            if len(self.newer) > self.archive.maxlen:
+                self.jump_to_live()
+            return
+        following = self.chat_display.yview()[1] >= 1.0
+        if not following:
+            room = max(self.scrollback - len(self.rendered), 0)
+            messages, held = messages[:room], messages[room:]
+            self.newer.extend(held)
+        self.insert_messages(tk.END, messages)
+        if following:
+            self.trim_top(len(self.rendered) - self.scrollback)
+            self.chat_display.see(tk.END)
+
+    def insert_messages(self, index, messages):
+
+        # Render messages (oldest first) at the top or bottom of the window
+        entries = [(segments, sum(text.count("\n") for text in segments[::2])) for segments in messages]
+        if not entries:
+            return 0
+        self.chat_display.config(state='normal')
+        self.chat_display.insert(index, *itertools.chain.from_iterable(messages))
+        self.chat_display.config(state='disabled')
+        if index == tk.END:
+            self.rendered.extend(entries)
+        else:
+            self.rendered.extendleft(reversed(entries))
+        return sum(lines for _, lines in entries)
+
+    def trim_top(self, count):
+
+        # Move the oldest `count` rendered messages to the archive; returns the lines removed
+        lines = 0
+        for _ in range(max(count, 0)):
+            segments, message_lines = self.rendered.popleft()
+            self.archive.append(segments)
+            lines += message_lines
+        if lines:
+            self.chat_display.config(state='normal')
+            self.chat_display.delete("1.0", f"{lines + 1}.0")
+            self.chat_display.config(state='disabled')
+        return lines
+
+    def trim_bottom(self, count):
+
+        # Move the newest `count` rendered messages back below the window
+        lines = 0
+        for _ in range(max(count, 0)):
+            segments, message_lines = self.rendered.pop()
+            self.newer.appendleft(segments)
+            lines += message_lines
+        if lines:
+            last_line = int(self.chat_display.index("end-1c").split(".")[0])
+            self.chat_display.config(state='normal')
+            self.chat_display.delete(f"{last_line - lines}.0", "end-1c")
+            self.chat_display.config(state='disabled')
+
+    def top_line(self):
+
+        # Line number of the first visible line
+        return int(self.chat_display.index("@0,0").split(".")[0])
+
+    def on_chat_scroll(self, first, last):
+
+        # The chat window scrolled: at either end, load the next page of messages
+        self.chat_display.vbar.set(first, last)
+        if self.scroll_load_pending:
+            return
+        if float(first) <= 0.0 and self.archive:
+            self.scroll_load_pending = True
+            self.root.after_idle(self.load_older)
+        elif float(last) >= 1.0 and self.newer:
+            self.scroll_load_pending = True
+            self.root.after_idle(self.load_newer)
+
+    def load_older(self):
+
+        # Scrolled to the top: bring back the previous LOAD_MORE archived messages
+        self.scroll_load_pending = False
+        messages = [self.archive.pop() for _ in range(min(LOAD_MORE, len(self.archive)))]
+        messages.reverse()
+        top = self.top_line()
+        lines = self.insert_messages("1.0", messages)
+        self.trim_bottom(len(self.rendered) - self.scrollback)
+        # Keep the text the user was looking at in place
+        self.chat_display.yview(f"{top + lines}.0")
+
+    def load_newer(self):
+
+        # Scrolled back down: render the next LOAD_MORE messages held below the window
+        self.scroll_load_pending = False
+        messages = [self.newer.popleft() for _ in range(min(LOAD_MORE, len(self.newer)))]
+        top = self.top_line()
+        self.insert_messages(tk.END, messages)
+        lines = self.trim_top(len(self.rendered) - self.scrollback)
+        self.chat_display.yview(f"{max(top - lines, 1)}.0")
+
+    def jump_to_live(self):
+
+        # Too much arrived while reading back: archive everything and show the latest messages
+        self.trim_top(len(self.rendered))
+        while len(self.newer) > self.scrollback:
+            self.archive.append(self.newer.popleft())
+        messages = list(self.newer)
+        self.newer.clear()
+        self.insert_messages(tk.END, messages)
+        self.chat_display.see(tk.END)
+
+
+if __name__ == "__main__":
+
+    # Start the application
+    root = tk.Tk()
+    app = MessagingApp(root)
+    root.mainloop()
@@ -0,0 +1,86 @@
+import struct
+
+from fragmentation import MAX_DATAGRAM_SIZE
+
+
+# Batches start with their own magic byte (JSON starts with '{', binary frames with 0xB7,
+# fragments with 0xF7); each frame inside is preceded by its u16 length
+BATCH_MAGIC = 0xBA
+BATCH_LENGTH = struct.Struct("!H")
+# Latency budget (seconds): frames for a client wait at most this long to share a datagram
+BATCH_DELAY = 0.005
+
+
+def pack_batch(payloads):
+
+    # One datagram carrying several frames; a lone frame goes out as it is
+    if len(payloads) == 1:
+        return payloads[0]
+    parts = [bytes((BATCH_MAGIC,))]
+    for payload in payloads:
+        parts.append(BATCH_LENGTH.pack(len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def unpack_batch(datagram):
+
+    # Frames of a batch, or the datagram itself when it is not one
+    if not datagram or datagram[0] != BATCH_MAGIC:
+        return [datagram]
+    payloads = []
+    offset = 1
+    while offset < len(datagram):
+        (length,) = BATCH_LENGTH.unpack_from(datagram, offset)
+        offset += BATCH_LENGTH.size
+        if offset + length > len(datagram):
+            raise ValueError("truncated batch")
+        payloads.append(datagram[offset:offset + length])
+        offset += length
+    return payloads
+
+
+class Coalescer:
+
+    # Per-destination queues of small frames. Frames queued for the same client are
+    # packed into one MTU-sized datagram when the queue is flushed or would overflow,
+    # so a busy room costs one datagram per client per flush instead of one per message.
+
+    def __init__(self, limit=MAX_DATAGRAM_SIZE):
+
+        self.limit = limit
+        self.queues = {}  # destination: [payloads, size of their batch]
+
+    def fits(self, payload):
+
+        return 1 + BATCH_LENGTH.size + len(payload) <= self.limit
+
+    def add(self, destination, payload):
+
+        # Queue a payload (one that fits); returns the batch to send right away when
+        # the destination's queue had no room left for it
+        queue = self.queues.get(destination)
+        size = BATCH_LENGTH.size + len(payload)
+        if queue is None:
+            self.queues[destination] = [[payload], 1 + size]
+            return None
+        if queue[1] + size > self.limit:
+            batch = pack_batch(queue[0])
+            queue[0] = [payload]
+            queue[1] = 1 + size
+            return batch
+        queue[0].append(payload)
+        queue[1] += size
+        return None
+
+    def take(self, destination):
+
+        # The destination's pending batch (None when nothing is queued), removing it
+        queue = self.queues.pop(destination, None)
+        return pack_batch(queue[0]) if queue is not None else None
+
+    def drain(self):
+
+        # Every pending batch as (destination, datagram)
+        queues, self.queues = self.queues, {}
+        return [(destination, pack_batch(queue[0])) for destination, queue in queues.items()]
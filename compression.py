@@ -0,0 +1,68 @@
+import zlib
+
+from fragmentation import RECV_BUFFER_SIZE
+
+
+# Compressed payloads start with their own magic byte (JSON starts with '{', binary frames
+# with 0xB7, fragments with 0xF7, batches with 0xBA); raw deflate data follows
+COMPRESSED_MAGIC = 0xC5
+# Payloads shorter than this (bytes) are sent as they are: deflating them saves a few
+# bytes at best and costs as much CPU as a large one
+COMPRESS_THRESHOLD = 96
+# zlib level: beyond 6 chat-sized payloads shrink no further
+COMPRESS_LEVEL = 6
+# Raw deflate (no zlib header or checksum: the datagram has a checksum already) with a
+# 4 KB window and small hash tables. A payload and the dictionary fit in the window, and
+# setting up the default 256 KB of state would cost four times the deflating itself.
+WINDOW_BITS = -12
+MEMORY_LEVEL = 4
+
+# Preset dictionary: strings that recur in chat traffic, so even a lone message compresses.
+# Every payload is compressed on its own (datagrams get lost), so without it deflate would
+# have nothing to refer back to. zlib finds the strings near the end of the dictionary
+# cheapest to refer to, so the most frequent ones come last.
+CHAT_DICTIONARY = b"".join([
+    # Chat text
+    b"thanks thank you please sorry okay yeah lol what when where why how who which "
+    b"would could should there their they them then than about know think just like "
+    b"good great right really going time today tomorrow now here with this that have "
+    b"from will your not but and the for are was you can see let's I'm it's don't ",
+    # Notices, presence and rooms
+    b"You are sending too fast, some messages were not delivered"
+    b" timed out. left the chat. has left the chat. joined the chat. has joined the chat. "
+    b"others Client 1, Client 2, Client 3 and Client ",
+    # Binary frames: header, then fields in schema order
+    b"\xb7\x01\x04\x00\x00\xb7\x01\x0d\x00\x07general\x00\x00\x00",
+    b"\x00\x07general\xb7\x01\x03",
+    # JSON frames
+    b'{"type": "notice", "text": "{"type": "presence", "room": "general", "joined": 0, "left": 0, "text": "',
+    b'{"type": "roster", "room": "general", "page": 0, "pages": 1, "names": ["Client ", "Client ',
+    b'{"type": "message", "id": "", "text": "", "sender_name": "Client ", "room": "general", "seq": ',
+])
+
+
+def compress(payload, threshold=COMPRESS_THRESHOLD):
+
+    # The payload deflated against the chat dictionary, or the payload itself when it is
+    # below the threshold or would not shrink
+    if len(payload) < threshold:
+        return payload
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, WINDOW_BITS, MEMORY_LEVEL,
+                                  zdict=CHAT_DICTIONARY)
+    packed = b"\xc5" + compressor.compress(payload) + compressor.flush()
+    return packed if len(packed) < len(payload) else payload
+
+
+def decompress(datagram):
+
+    # A compressed payload inflated, or the datagram itself when it is not one
+    if not datagram or datagram[0] != COMPRESSED_MAGIC:
+        return datagram
+    decompressor = zlib.decompressobj(WINDOW_BITS, zdict=CHAT_DICTIONARY)
+    try:
+        payload = decompressor.decompress(datagram[1:], RECV_BUFFER_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"bad compressed payload: {e}")
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("compressed payload is truncated or too large")
+    return payload
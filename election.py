@@ -0,0 +1,190 @@
+import random
+
+
+# A follower stands as candidate once its failure detector suspects the leader (or,
+# without heartbeat history, after LEADER_TIMEOUT seconds of silence), plus up to
+# ELECTION_JITTER seconds picked at random so that followers rarely stand together
+LEADER_TIMEOUT = 15.0
+ELECTION_JITTER = 0.5
+# A candidate without a majority after about VOTE_TIMEOUT seconds retries
+VOTE_TIMEOUT = 0.5
+# How often servers check the election timer
+ELECTION_TICK = 0.1
+
+
+def valid_term(term):
+
+    # Terms come off the wire: only non-negative integers are taken into account
+    return isinstance(term, int) and not isinstance(term, bool) and term >= 0
+
+
+class TermElection:
+
+    # Raft-style leader election. Every election starts a new term, each server votes
+    # at most once per term and a candidate needs a majority of the known servers, so
+    # there is at most one leader per term; anything from an older term is ignored.
+    #
+    # A candidate first runs a pre-vote: servers that still hear from a leader refuse
+    # and tell it who leads, so a server that merely missed some heartbeats rejoins
+    # the current term instead of deposing a working leader. After a split vote,
+    # retries are staggered by id (Bully-style: the highest id goes first), so the
+    # next round succeeds as soon as its messages get through.
+    #
+    # Pure state machine: callers pass in the clock and the known peers, and send the
+    # (peer id, message) pairs it returns.
+
+    def __init__(self, node_id, rng=None):
+
+        self.node_id = node_id
+        self.rng = rng or random.Random()
+        self.term = 0
+        self.state = "follower"  # follower, candidate or leader
+        self.voted_for = None  # candidate this server voted for in the current term
+        self.prevoting = False  # candidate: still collecting pre-votes for term + 1
+        self.votes = set()  # candidate: ids that granted their (pre-)vote this round
+        self.leader_id = None
+        self.leader_seen = None  # when the leader was last heard from
+        self.leader_timeout = LEADER_TIMEOUT  # silence after which the leader counts as gone
+        self.failed_rounds = 0  # consecutive rounds of this candidate that ended without a leader
+        self.deadline = None  # when a follower stands or a candidate retries; None = no timer
+
+    def wait_for_leader(self, now, timeout=LEADER_TIMEOUT):
+
+        # (Re)arm the timer after which this server stands as candidate
+        self.deadline = now + timeout + self.rng.uniform(0, ELECTION_JITTER)
+
+    def due(self, now):
+
+        return self.state != "leader" and self.deadline is not None and now >= self.deadline
+
+    def leader_alive(self, now):
+
+        if self.state == "leader":
+            return True
+        return self.leader_id is not None and now - self.leader_seen < self.leader_timeout
+
+    def observe_term(self, term):
+
+        # A newer term turns this server into a follower that has not voted yet
+        if term > self.term:
+            self.term = term
+            self.state = "follower"
+            self.voted_for = None
+            self.prevoting = False
+            self.votes = set()
+            self.leader_id = None
+
+    def stand(self, now, peers):
+
+        # Start a round with a pre-vote for term + 1; returns the requests to send
+        if self.state == "candidate":
+            self.failed_rounds += 1
+        else:
+            self.failed_rounds = 0
+        self.state = "candidate"
+        self.prevoting = True
+        self.votes = {self.node_id}
+        self.leader_id = None
+        self.deadline = now + self.retry_delay(peers)
+        if self.has_majority(peers):
+            return self.campaign(peers)
+        request = {"type": "vote_request", "term": self.term + 1, "id": self.node_id, "pre": True}
+        return [(peer, request) for peer in peers]
+
+    def campaign(self, peers):
+
+        # Pre-vote won: start the new term voting for ourselves
+        self.term += 1
+        self.prevoting = False
+        self.voted_for = self.node_id
+        self.votes = {self.node_id}
+        if self.has_majority(peers):
+            self.win()
+            return []
+        request = {"type": "vote_request", "term": self.term, "id": self.node_id}
+        return [(peer, request) for peer in peers]
+
+    def retry_delay(self, peers):
+
+        # First round: random. After a split vote: one VOTE_TIMEOUT slot per higher id.
+        if self.failed_rounds == 0:
+            return VOTE_TIMEOUT * (1 + self.rng.random())
+        rank = sum(1 for peer in peers if peer > self.node_id)
+        return VOTE_TIMEOUT * (1 + rank) + self.rng.uniform(0, VOTE_TIMEOUT / 4)
+
+    def has_majority(self, peers):
+
+        return len(self.votes) >= (len(peers) + 1) // 2 + 1
+
+    def win(self):
+
+        self.state = "leader"
+        self.leader_id = self.node_id
+        self.failed_rounds = 0
+        self.deadline = None
+
+    def on_vote_request(self, message, now):
+
+        # Answer a (pre-)vote request; returns the reply to the candidate
+        term, candidate = message["term"], message["id"]
+        reply = {"type": "vote", "term": term, "id": self.node_id, "granted": False}
+        if message.get("pre"):
+            # Pre-votes change nothing here; refused while a leader is alive
+            reply.update(pre=True, current_term=self.term)
+            if self.leader_alive(now):
+                reply["leader"] = self.leader_id
+            else:
+                reply["granted"] = term > self.term
+            return reply
+        self.observe_term(term)
+        if term == self.term and self.voted_for in (None, candidate):
+            self.voted_for = candidate
+            self.wait_for_leader(now)
+            reply["granted"] = True
+        reply["term"] = self.term
+        return reply
+
+    def on_vote(self, message, now, peers):
+
+        # Count a (pre-)vote for the current round; returns the requests to send next
+        if message.get("leader") is not None:
+            self.on_leader(message["current_term"], message["leader"], now)
+            return []
+        if message.get("pre"):
+            # A server already in a later term: catch up and retry from there
+            self.observe_term(message["current_term"])
+            if (self.state == "candidate" and self.prevoting and message["granted"]
+                    and message["term"] == self.term + 1):
+                self.votes.add(message["id"])
+                if self.has_majority(peers):
+                    return self.campaign(peers)
+            return []
+        self.observe_term(message["term"])
+        if (self.state == "candidate" and not self.prevoting and message["granted"]
+                and message["term"] == self.term):
+            self.votes.add(message["id"])
+            if self.has_majority(peers):
+                self.win()
+        return []
+
+    def on_leader(self, term, leader_id, now, timeout=None):
+
+        # A leader announcement or heartbeat; False if it is stale and must be ignored.
+        # timeout: how long the leader may now stay silent (failure detector), if known.
+        if term < self.term:
+            return False
+        if term == self.term and self.state == "leader" and leader_id != self.node_id:
+            # Only possible when servers disagree on membership: the higher id wins
+            if leader_id < self.node_id:
+                return False
+        self.observe_term(term)
+        if leader_id == self.node_id:
+            return self.state == "leader"
+        self.state = "follower"
+        self.prevoting = False
+        self.leader_id = leader_id
+        self.leader_seen = now
+        self.leader_timeout = LEADER_TIMEOUT if timeout is None else timeout
+        self.failed_rounds = 0
+        self.wait_for_leader(now, self.leader_timeout)
+        return True
@@ -0,0 +1,132 @@
+import collections
+import math
+import statistics
+
+
+# Every server multicasts a heartbeat this often (seconds)
+HEARTBEAT_INTERVAL = 0.5
+
+# Suspicion level at which a node counts as failed: phi = 8 means a silence this
+# long would happen with probability 1e-8 if the node were still sending
+PHI_THRESHOLD = 8.0
+# Inter-arrival times remembered per node
+MAX_SAMPLES = 200
+# Floor on the learned deviation: LAN heartbeats are so regular that otherwise a
+# few milliseconds of scheduling delay would already look like a failure
+MIN_STD_DEVIATION = 0.1
+# Silence tolerated on top of the learned distribution (busy host, GC pause)
+ACCEPTABLE_PAUSE = 0.25
+
+
+class HeartbeatHistory:
+
+    # Sliding window of heartbeat inter-arrival times with a running mean and variance
+
+    def __init__(self, max_samples, first_interval):
+
+        self.max_samples = max_samples
+        self.intervals = collections.deque()
+        self.total = 0.0
+        self.squares = 0.0
+        self.last_arrival = None
+        # Seeded as if beats had come first_interval apart, give or take a quarter,
+        # so the first real heartbeats are judged sensibly
+        for interval in (first_interval * 0.75, first_interval * 1.25):
+            self.add(interval)
+
+    def add(self, interval):
+
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
+        if len(self.intervals) > self.max_samples:
+            dropped = self.intervals.popleft()
+            self.total -= dropped
+            self.squares -= dropped * dropped
+
+    def mean(self):
+
+        return self.total / len(self.intervals)
+
+    def std_deviation(self):
+
+        mean = self.mean()
+        return math.sqrt(max(self.squares / len(self.intervals) - mean * mean, 0.0))
+
+
+class PhiAccrualDetector:
+
+    # Phi-accrual failure detector (Hayashibara et al.): instead of a fixed timeout,
+    # learns each node's heartbeat inter-arrival distribution and turns the current
+    # silence into a suspicion level phi = -log10(P(a beat would still be due)).
+    # Regular heartbeats give fast detection; jittery ones raise the bar on their own.
+
+    def __init__(self, threshold=PHI_THRESHOLD, max_samples=MAX_SAMPLES,
+                 min_std_deviation=MIN_STD_DEVIATION, acceptable_pause=ACCEPTABLE_PAUSE,
+                 first_interval=HEARTBEAT_INTERVAL):
+
+        self.threshold = threshold
+        self.max_samples = max_samples
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval
+        # Standard deviations past the mean at which phi reaches the threshold
+        self.threshold_z = statistics.NormalDist().inv_cdf(1 - 10 ** -threshold)
+        self.histories = {}  # node: HeartbeatHistory
+
+    def __contains__(self, node):
+
+        return node in self.histories
+
+    def heartbeat(self, node, now):
+
+        # Record a heartbeat; returns the time since the previous one (None for the first)
+        history = self.histories.get(node)
+        interval = None
+        if history is None:
+            history = self.histories[node] = HeartbeatHistory(self.max_samples, self.first_interval)
+        elif now > history.last_arrival:
+            interval = now - history.last_arrival
+            history.add(interval)
+        history.last_arrival = now
+        return interval
+
+    def distribution(self, history):
+
+        return (history.mean() + self.acceptable_pause,
+                max(history.std_deviation(), self.min_std_deviation))
+
+    def phi(self, node, now):
+
+        # Suspicion level of node; 0 for nodes never heard from
+        history = self.histories.get(node)
+        if history is None:
+            return 0.0
+        mean, std_deviation = self.distribution(history)
+        later = 0.5 * math.erfc((now - history.last_arrival - mean) / (std_deviation * math.sqrt(2)))
+        return -math.log10(later) if later > 0 else math.inf
+
+    def suspected(self, node, now):
+
+        return self.phi(node, now) >= self.threshold
+
+    def timeout(self, node):
+
+        # Silence after the last heartbeat at which node becomes suspected, or None
+        history = self.histories.get(node)
+        if history is None:
+            return None
+        mean, std_deviation = self.distribution(history)
+        return mean + self.threshold_z * std_deviation
+
+    def deadline(self, node):
+
+        # Time at which node becomes suspected unless it beats again, or None
+        timeout = self.timeout(node)
+        if timeout is None:
+            return None
+        return self.histories[node].last_arrival + timeout
+
+    def remove(self, node):
+
+        self.histories.pop(node, None)
@@ -0,0 +1,168 @@
+import random
+import struct
+import time
+from collections import OrderedDict
+
+
+# Fragments start with their own magic byte (JSON starts with '{', binary frames with 0xB7)
+FRAGMENT_MAGIC = 0xF7
+FRAGMENT_HEADER = struct.Struct("!BIHH")  # magic, message id, fragment index, fragment count
+
+# Largest datagram we send: stays inside a 1500-byte Ethernet MTU after IP/UDP headers
+MAX_DATAGRAM_SIZE = 1200
+# Largest payload a peer may fragment, and so the most one message can cost a receiver
+MAX_MESSAGE_SIZE = 64 * 1024
+# Room a client's chat message must leave for what the server adds when relaying it
+# (sender_name, room, seq), so that the relayed frame still fits MAX_MESSAGE_SIZE
+RELAY_HEADER_ALLOWANCE = 256
+# Receive buffer for recvfrom, large enough for any UDP datagram
+RECV_BUFFER_SIZE = 65535
+
+
+class Fragmenter:
+
+    def __init__(self, max_datagram_size=MAX_DATAGRAM_SIZE, max_message_size=MAX_MESSAGE_SIZE):
+
+        self.max_datagram_size = max_datagram_size
+        self.max_message_size = max_message_size
+        self.chunk_size = max_datagram_size - FRAGMENT_HEADER.size
+        # Random start so a restarted sender does not reuse ids still buffered by a peer
+        self.next_message_id = random.getrandbits(32)
+
+    def split(self, payload):
+
+        # Small payloads go out unchanged; larger ones become MTU-sized fragments
+        if len(payload) <= self.max_datagram_size:
+            return [payload]
+        if len(payload) > self.max_message_size:
+            raise ValueError(f"message of {len(payload)} bytes exceeds the "
+                             f"{self.max_message_size} byte limit")
+
+        message_id = self.next_message_id
+        self.next_message_id = (message_id + 1) & 0xFFFFFFFF
+        chunk_size = self.chunk_size
+        count = (len(payload) + chunk_size - 1) // chunk_size
+        return [FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, message_id, index, count)
+                + payload[index * chunk_size:(index + 1) * chunk_size]
+                for index in range(count)]
+
+
+class PartialMessage:
+
+    __slots__ = ("source", "chunks", "received", "size", "deadline")
+
+    def __init__(self, source, count, deadline):
+
+        self.source = source
+        self.chunks = [None] * count
+        self.received = 0
+        self.size = 0
+        self.deadline = deadline
+
+
+class Reassembler:
+
+    def __init__(self, timeout=5.0, max_pending=256, max_pending_per_source=8,
+                 max_buffered_bytes=4 * 1024 * 1024, max_message_size=MAX_MESSAGE_SIZE):
+
+        # Bounds on memory spent on half-received messages
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_pending_per_source = max_pending_per_source
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_message_size = max_message_size
+
+        self.pending = OrderedDict()  # (source, message_id): PartialMessage, oldest first
+        self.pending_per_source = {}  # source: number of partial messages
+        self.buffered_bytes = 0
+        self.dropped = 0
+        self.last_sweep = time.monotonic()
+
+    def feed(self, datagram, source):
+
+        # Return a complete payload, or None while fragments are still missing
+        if not datagram or datagram[0] != FRAGMENT_MAGIC:
+            return datagram
+        if len(datagram) < FRAGMENT_HEADER.size:
+            self.dropped += 1
+            return None
+
+        _, message_id, index, count = FRAGMENT_HEADER.unpack_from(datagram)
+        chunk = datagram[FRAGMENT_HEADER.size:]
+        if index >= count or count * len(chunk) > self.max_message_size + len(chunk):
+            self.dropped += 1
+            return None
+
+        now = time.monotonic()
+        if now - self.last_sweep >= 1.0:
+            self.expire(now)
+
+        key = (source, message_id)
+        partial = self.pending.get(key)
+        if partial is None:
+            if count == 1:
+                return chunk
+            self.make_room_for(source)
+            partial = PartialMessage(source, count, now + self.timeout)
+            self.pending[key] = partial
+            self.pending_per_source[source] = self.pending_per_source.get(source, 0) + 1
+        elif len(partial.chunks) != count:
+            self.dropped += 1
+            return None
+
+        if partial.chunks[index] is None:
+            partial.chunks[index] = chunk
+            partial.received += 1
+            partial.size += len(chunk)
+            self.buffered_bytes += len(chunk)
+
+        if partial.size > self.max_message_size:
+            self.discard(key)
+            self.dropped += 1
+            return None
+
+        if partial.received == len(partial.chunks):
+            self.discard(key)
+            return b"".join(partial.chunks)
+
+        # Keep the global budget by dropping the oldest other partial messages
+        while self.buffered_bytes > self.max_buffered_bytes:
+            oldest = next((other for other in self.pending if other != key), None)
+            if oldest is None:
+                break
+            self.discard(oldest)
+            self.dropped += 1
+        return None
+
+    def make_room_for(self, source):
+
+        # Evict the oldest partial message of this source, then globally, before adding one
+        if self.pending_per_source.get(source, 0) >= self.max_pending_per_source:
+            oldest = next(key for key, partial in self.pending.items() if partial.source == source)
+            self.discard(oldest)
+            self.dropped += 1
+        while len(self.pending) >= self.max_pending:
+            self.discard(next(iter(self.pending)))
+            self.dropped += 1
+
+    def discard(self, key):
+
+        partial = self.pending.pop(key)
+        self.buffered_bytes -= partial.size
+        remaining = self.pending_per_source[partial.source] - 1
+        if remaining:
+            self.pending_per_source[partial.source] = remaining
+        else:
+            del self.pending_per_source[partial.source]
+
+    def expire(self, now=None):
+
+        # Drop partial messages whose fragments did not all arrive in time
+        now = time.monotonic() if now is None else now
+        self.last_sweep = now
+        while self.pending:
+            key, partial = next(iter(self.pending.items()))
+            if partial.deadline > now:
+                break
+            self.discard(key)
+            self.dropped += 1
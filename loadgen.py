@@ -0,0 +1,343 @@
+import json
+import selectors
+import socket
+import threading
+import time
+import uuid
+
+import protocol
+from coalescing import unpack_batch
+from compression import decompress
+from failure_detector import PhiAccrualDetector
+from fragmentation import Fragmenter, Reassembler, RECV_BUFFER_SIZE
+from sessions import KEEPALIVE_INTERVAL
+
+
+MULTICAST_GROUP = '224.1.1.1'
+# While the leader is suspected, clients still pointing at it probe the known servers this often (seconds)
+PROBE_INTERVAL = 0.25
+# Joins lost to a full server receive buffer are sent again this often (seconds)
+JOIN_RETRY_INTERVAL = 1.0
+
+
+def open_discovery_socket(discovery_port):
+
+    # Listen to the servers' discovery multicast, as the chat client does
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', discovery_port))
+    mreq = socket.inet_aton(MULTICAST_GROUP) + socket.inet_aton('0.0.0.0')
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return sock
+
+
+def find_leader(discovery_port, server_count=1, timeout=30):
+
+    # Client address of the leader, once it and server_count servers in all were heard from
+    sock = open_discovery_socket(discovery_port)
+    sock.settimeout(0.5)
+    servers = set()
+    leader = None
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            try:
+                data, address = sock.recvfrom(RECV_BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            frame = json.loads(data.decode())
+            if frame.get("type") not in ("heartbeat", "discover"):
+                continue
+            servers.add(frame["id"])
+            if frame.get("isLeader"):
+                leader = (address[0], frame["port"])
+            if leader is not None and len(servers) >= server_count:
+                return leader
+    finally:
+        sock.close()
+    return None
+
+
+class HeadlessClient:
+
+    # One simulated chat client: MessagingApp's join/message/leave protocol without
+    # Tk. It has no thread of its own; the LoadGenerator owning it reads its socket.
+
+    def __init__(self, server_address, codecs=("json",), features=()):
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(False)
+        self.id = str(uuid.uuid4())
+        self.port = self.sock.getsockname()[1]
+        self.name = None
+        self.server_address = server_address
+        self.offered_codecs = list(codecs)
+        self.offered_features = [feature for feature in features if feature != "reliable"]
+        self.codec = "json"
+        self.fragmenter = Fragmenter()
+        self.reassembler = Reassembler(max_pending=64)
+        self.joined = False
+        self.resume_token = None  # from the last welcome, presented when joining again
+
+    def send(self, frame):
+
+        payload = protocol.encode(frame, self.codec)
+        for fragment in self.fragmenter.split(payload):
+            self.sock.sendto(fragment, self.server_address)
+
+    def join(self):
+
+        # Plain datagrams only: no reliable channel
+        self.codec = "json"
+        self.joined = False
+        join = {
+            "type": "join",
+            "id": self.id,
+            "port": self.port,
+            "codecs": self.offered_codecs,
+            "features": self.offered_features
+        }
+        if self.resume_token is not None:
+            join["resume"] = self.resume_token
+        self.send(join)
+
+    def send_text(self, text):
+
+        self.send({"type": "message", "id": self.id, "text": text})
+
+    def keepalive(self):
+
+        if self.joined:
+            self.send({"type": "keepalive", "id": self.id})
+
+    def leave(self):
+
+        if self.joined:
+            self.send({"type": "leave", "id": self.id})
+            self.joined = False
+
+    def probe(self, addresses):
+
+        # Ask each server who leads; the leader answers with a redirect
+        probe = json.dumps({"type": "probe", "id": self.id}).encode()
+        for address in addresses:
+            self.sock.sendto(probe, address)
+
+    def on_datagram(self, data, address):
+
+        # Handle one datagram from a server; returns the frames it completed (a batch
+        # carries several)
+        frames = []
+        for payload in unpack_batch(decompress(data)):
+            payload = self.reassembler.feed(payload, address)
+            if payload is not None:
+                frames.append(self.on_frame(protocol.decode(payload), address))
+        return frames
+
+    def on_frame(self, frame, address):
+
+        if frame["type"] == "welcome":
+            self.name = frame["name"]
+            self.resume_token = frame.get("resume", self.resume_token)
+            self.codec = frame.get("codec", "json")
+            if frame.get("owner"):
+                # Sharded: the server that sent the welcome owns this session
+                self.server_address = address
+            self.joined = True
+
+        elif frame["type"] == "redirect":
+            # Not the leader (any more): join the one it names
+            server_address = (frame["ip"], frame["port"])
+            if server_address != self.server_address or not self.joined:
+                self.server_address = server_address
+                self.join()
+
+        elif frame["type"] == "expired":
+            # The server evicted this session
+            self.join()
+
+        elif frame["type"] == "failover":
+            # A new leader took over this replicated session
+            self.server_address = (address[0], frame["port"])
+            self.joined = True
+
+        return frame
+
+    def close(self):
+
+        self.sock.close()
+
+
+class LoadGenerator:
+
+    # Thousands of HeadlessClients in one process. A single thread reads every client
+    # socket and the discovery multicast: a leader its failure detector suspects makes
+    # the clients still pointing at it probe the other servers, like MessagingApp does.
+    # Message texts start with their send time, so every delivery is timed, except
+    # untimed background traffic (marked "-").
+
+    def __init__(self, count, server_address, discovery_port=None, codecs=("json",), features=()):
+
+        self.clients = [HeadlessClient(server_address, codecs, features) for _ in range(count)]
+        self.selector = selectors.DefaultSelector()
+        for client in self.clients:
+            self.selector.register(client.sock, selectors.EVENT_READ, client)
+        self.discovery_socket = None
+        if discovery_port is not None:
+            self.discovery_socket = open_discovery_socket(discovery_port)
+            self.discovery_socket.setblocking(False)
+            self.selector.register(self.discovery_socket, selectors.EVENT_READ, None)
+
+        # Leader tracking
+        self.failure_detector = PhiAccrualDetector()
+        self.servers = {}  # server_id: client address (ip, port)
+        self.leader_id = None
+        self.lost_address = None  # address of the leader last suspected, while clients still use it
+        self.last_probe = 0.0
+        self.last_keepalive = time.time()
+
+        # Delivery statistics (reader thread; read them after stop())
+        self.delivered = 0
+        self.untimed_delivered = 0
+        self.slow_downs = 0  # slow-down notices received from flood control
+        self.notices = 0  # join/leave notices and presence deltas received, over all clients
+        self.datagrams = 0  # datagrams received, over all clients
+        self.bytes_received = 0  # their size
+        self.latencies = []
+        self.last_delivery = None
+        self.mark_time = None  # deliveries of messages sent after this time are watched
+        self.recovered_at = None  # first such delivery
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+
+        for client in self.clients:
+            client.join()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def wait_joined(self, timeout):
+
+        # Number of clients welcomed, waiting up to timeout seconds for all of them and
+        # joining again those whose join or welcome was dropped
+        deadline = time.time() + timeout
+        retry_at = time.time() + JOIN_RETRY_INTERVAL
+        while time.time() < deadline:
+            waiting = [client for client in self.clients if not client.joined]
+            if not waiting:
+                break
+            if time.time() >= retry_at:
+                retry_at = time.time() + JOIN_RETRY_INTERVAL
+                for client in waiting:
+                    client.join()
+            time.sleep(0.05)
+        return sum(1 for client in self.clients if client.joined)
+
+    def send(self, index, text="", timed=True):
+
+        # Client number index sends a message stamped with the current time
+        stamp = repr(time.perf_counter()) if timed else "-"
+        self.clients[index].send_text(f"{stamp} {text}")
+
+    def mark(self):
+
+        # Watch for the first delivery of a message sent from now on (failover time)
+        self.recovered_at = None
+        self.mark_time = time.perf_counter()
+        return self.mark_time
+
+    def run(self):
+
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.05):
+                while True:
+                    try:
+                        data, address = key.fileobj.recvfrom(RECV_BUFFER_SIZE)
+                    except OSError:
+                        break
+                    if key.data is None:
+                        self.on_discovery(data, address)
+                    else:
+                        self.on_client_datagram(key.data, data, address)
+            self.check_leader()
+            if time.time() - self.last_keepalive >= KEEPALIVE_INTERVAL:
+                self.last_keepalive = time.time()
+                for client in self.clients:
+                    client.keepalive()
+
+    def on_discovery(self, data, address):
+
+        frame = json.loads(data.decode())
+        if frame.get("type") not in ("heartbeat", "discover"):
+            return
+        self.servers[frame["id"]] = (address[0], frame["port"])
+        if frame.get("isLeader"):
+            self.leader_id = frame["id"]
+            if frame["type"] == "heartbeat":
+                self.failure_detector.heartbeat(frame["id"], time.time())
+
+    def check_leader(self):
+
+        # Once the leader is suspected, its clients probe every other server until moved
+        now = time.time()
+        if self.leader_id is not None and self.failure_detector.suspected(self.leader_id, now):
+            self.failure_detector.remove(self.leader_id)
+            self.lost_address = self.servers.pop(self.leader_id, None)
+            self.leader_id = None
+        if self.lost_address is None or now - self.last_probe < PROBE_INTERVAL:
+            return
+        self.last_probe = now
+        addresses = [address for address in self.servers.values() if address != self.lost_address]
+        stranded = [client for client in self.clients if client.server_address == self.lost_address]
+        if not stranded:
+            self.lost_address = None
+        for client in stranded:
+            client.probe(addresses)
+
+    def on_client_datagram(self, client, data, address):
+
+        self.datagrams += 1
+        self.bytes_received += len(data)
+        for frame in client.on_datagram(data, address):
+            self.on_client_frame(frame)
+
+    def on_client_frame(self, frame):
+
+        if frame["type"] == "slow_down":
+            self.slow_downs += 1
+        elif frame["type"] in ("notice", "presence"):
+            self.notices += 1
+        if frame["type"] != "message":
+            return
+        stamp = frame["text"].split(" ", 1)[0]
+        if stamp == "-":
+            self.untimed_delivered += 1
+            return
+        now = time.perf_counter()
+        sent = float(stamp)
+        self.delivered += 1
+        self.latencies.append(now - sent)
+        self.last_delivery = now
+        if self.mark_time is not None and self.recovered_at is None and sent >= self.mark_time:
+            self.recovered_at = now
+
+    def stop(self):
+
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        for client in self.clients:
+            try:
+                client.leave()
+            except OSError:
+                pass
+            client.close()
+        if self.discovery_socket is not None:
+            self.discovery_socket.close()
+        self.selector.close()
@@ -0,0 +1,212 @@
+import bisect
+import mmap
+import os
+import struct
+import time
+
+
+# Each record: sequence number, append time, payload length, then the payload bytes
+RECORD_HEADER = struct.Struct("!QdI")
+# Each index entry: byte offset of one record inside its segment
+INDEX_ENTRY = struct.Struct("!Q")
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Most messages one history request may return, and the size of each reply frame
+MAX_REPLAY = 1000
+REPLAY_BATCH_BYTES = 16 * 1024
+
+
+class Segment:
+
+    # One log file plus its dense offset index, named after the first sequence number
+
+    def __init__(self, directory, first_seq):
+
+        self.first_seq = first_seq
+        self.log_path = os.path.join(directory, f"{first_seq:020d}.log")
+        self.index_path = os.path.join(directory, f"{first_seq:020d}.idx")
+        self.log_file = None
+        self.index_file = None
+        self.maps = None  # (log mmap, index mmap, log size, index size) currently mapped
+
+        # Recover: only records that are fully written and indexed count
+        self.count = 0
+        self.size = 0
+        if os.path.exists(self.index_path) and os.path.exists(self.log_path):
+            log_size = os.path.getsize(self.log_path)
+            with open(self.index_path, "rb") as index_file:
+                index = index_file.read()
+            with open(self.log_path, "rb") as log_file:
+                for position in range(len(index) // INDEX_ENTRY.size):
+                    (offset,) = INDEX_ENTRY.unpack_from(index, position * INDEX_ENTRY.size)
+                    log_file.seek(offset)
+                    header = log_file.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    _, _, length = RECORD_HEADER.unpack(header)
+                    if offset + RECORD_HEADER.size + length > log_size:
+                        break
+                    self.count = position + 1
+                    self.size = offset + RECORD_HEADER.size + length
+
+    @property
+    def next_seq(self):
+
+        return self.first_seq + self.count
+
+    def open_for_append(self):
+
+        # Drop any torn tail left by a crash, then append from the last good record
+        self.log_file = open(self.log_path, "ab")
+        self.log_file.truncate(self.size)
+        self.index_file = open(self.index_path, "ab")
+        self.index_file.truncate(self.count * INDEX_ENTRY.size)
+
+    def append(self, payload, timestamp):
+
+        seq = self.next_seq
+        self.log_file.write(RECORD_HEADER.pack(seq, timestamp, len(payload)) + payload)
+        self.log_file.flush()
+        self.index_file.write(INDEX_ENTRY.pack(self.size))
+        self.index_file.flush()
+        self.size += RECORD_HEADER.size + len(payload)
+        self.count += 1
+        return seq
+
+    def mapped(self):
+
+        # Read-only mappings, refreshed when the active segment has grown
+        if self.maps is not None and self.maps[2] == self.size:
+            return self.maps
+        self.unmap()
+        if self.count == 0:
+            return None
+        with open(self.log_path, "rb") as log_file, open(self.index_path, "rb") as index_file:
+            log_map = mmap.mmap(log_file.fileno(), self.size, access=mmap.ACCESS_READ)
+            index_map = mmap.mmap(index_file.fileno(), self.count * INDEX_ENTRY.size,
+                                  access=mmap.ACCESS_READ)
+        self.maps = (log_map, index_map, self.size, self.count)
+        return self.maps
+
+    def read(self, seq, limit):
+
+        # Sequential read of up to limit records starting at seq: one index lookup, then a scan
+        maps = self.mapped()
+        if maps is None:
+            return []
+        log_map, index_map, size, count = maps
+        position = seq - self.first_seq
+        if position < 0 or position >= count:
+            return []
+        (offset,) = INDEX_ENTRY.unpack_from(index_map, position * INDEX_ENTRY.size)
+        records = []
+        while len(records) < limit and offset < size:
+            record_seq, timestamp, length = RECORD_HEADER.unpack_from(log_map, offset)
+            start = offset + RECORD_HEADER.size
+            records.append((record_seq, timestamp, log_map[start:start + length]))
+            offset = start + length
+        return records
+
+    def unmap(self):
+
+        if self.maps is not None:
+            self.maps[0].close()
+            self.maps[1].close()
+            self.maps = None
+
+    def close(self):
+
+        self.unmap()
+        for handle in (self.log_file, self.index_file):
+            if handle is not None:
+                handle.close()
+        self.log_file = None
+        self.index_file = None
+
+    def delete(self):
+
+        self.close()
+        for path in (self.log_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class MessageLog:
+
+    # Append-only chat history split into rotated segments, read through mmap
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, max_segments=None):
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+
+        first_seqs = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.segments = [Segment(directory, first_seq) for first_seq in first_seqs]
+        # Drop empty segments left behind by an interrupted rotation, except the first one
+        while len(self.segments) > 1 and self.segments[-1].count == 0:
+            self.segments.pop().delete()
+        if not self.segments:
+            # Sequence numbers start at 1 so that 0 can mean "nothing seen yet"
+            self.segments.append(Segment(directory, 1))
+        self.first_seqs = [segment.first_seq for segment in self.segments]
+        self.segments[-1].open_for_append()
+
+    @property
+    def first_seq(self):
+
+        return self.segments[0].first_seq
+
+    @property
+    def next_seq(self):
+
+        return self.segments[-1].next_seq
+
+    def append(self, payload, timestamp=None):
+
+        # Store one message and return its sequence number
+        active = self.segments[-1]
+        if active.size >= self.segment_size:
+            active = self.rotate()
+        return active.append(payload, time.time() if timestamp is None else timestamp)
+
+    def rotate(self):
+
+        # Close the active segment and start a new one at the next sequence number
+        previous = self.segments[-1]
+        previous.log_file.close()
+        previous.index_file.close()
+        previous.log_file = previous.index_file = None
+        segment = Segment(self.directory, previous.next_seq)
+        segment.open_for_append()
+        self.segments.append(segment)
+        self.first_seqs.append(segment.first_seq)
+        # Retention: drop the oldest segments beyond max_segments
+        while self.max_segments and len(self.segments) > self.max_segments:
+            self.segments.pop(0).delete()
+            self.first_seqs.pop(0)
+        return segment
+
+    def read_from(self, seq, limit):
+
+        # Up to limit (seq, timestamp, payload) records starting at seq, across segments
+        seq = max(seq, self.first_seq)
+        records = []
+        index = bisect.bisect_right(self.first_seqs, seq) - 1
+        while index < len(self.segments) and len(records) < limit:
+            segment = self.segments[index]
+            records.extend(segment.read(max(seq, segment.first_seq), limit - len(records)))
+            index += 1
+        return records
+
+    def last(self, count):
+
+        # The most recent count records, oldest first
+        return self.read_from(max(self.first_seq, self.next_seq - count), count)
+
+    def close(self):
+
+        for segment in self.segments:
+            segment.close()
@@ -0,0 +1,182 @@
+import bisect
+import http.server
+import threading
+
+
+# Histogram bucket upper bounds (seconds) for timings on the datagram path
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Bucket upper bounds (seconds) for heartbeats arriving late
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Label values come off the wire (frame types): past this many series per metric,
+# new values are counted under "other"
+MAX_SERIES = 64
+
+
+def escape_label(value):
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(label, value, extra=""):
+
+    # {label="value",extra} or "" when the series has no label
+    parts = []
+    if label is not None and value is not None:
+        parts.append(f'{label}="{escape_label(value)}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+
+    # Monotonic count, optionally split by the value of one label. Updates are plain
+    # dict increments: the engines already serialize the handlers that record them.
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label=None):
+
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}  # label value (None without a label): count
+
+    def inc(self, label_value=None, amount=1):
+
+        if label_value not in self.values and len(self.values) >= MAX_SERIES:
+            label_value = "other"
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+
+        for value, count in list(self.values.items()):
+            yield f"{self.name}{format_labels(self.label, value)} {count}"
+
+
+class Gauge:
+
+    # Value read from the server when the metrics are rendered; costs nothing in between
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read):
+
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def samples(self):
+
+        yield f"{self.name} {self.read()}"
+
+
+class CounterFunction(Gauge):
+
+    # Counter kept elsewhere (e.g. by the transport), read when rendered
+
+    kind = "counter"
+
+
+class Histogram:
+
+    # Distribution over fixed buckets, optionally split by the value of one label
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label=None, buckets=LATENCY_BUCKETS):
+
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}  # label value: [per-bucket counts (last one is +Inf), sum]
+
+    def observe(self, amount, label_value=None):
+
+        series = self.series.get(label_value)
+        if series is None:
+            if len(self.series) >= MAX_SERIES:
+                label_value = "other"
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, amount)] += 1
+        series[1] += amount
+
+    def samples(self):
+
+        for value, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), list(counts)):
+                cumulative += count
+                bucket = 'le="' + str(bound) + '"'
+                yield f"{self.name}_bucket{format_labels(self.label, value, bucket)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.label, value)} {total}"
+            yield f"{self.name}_count{format_labels(self.label, value)} {cumulative}"
+
+
+class MetricsRegistry:
+
+    # A process's metrics, rendered in the Prometheus text exposition format
+
+    def __init__(self):
+
+        self.metrics = []
+
+    def add(self, metric):
+
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label=None):
+
+        return self.add(Counter(name, help_text, label))
+
+    def histogram(self, name, help_text, label=None, buckets=LATENCY_BUCKETS):
+
+        return self.add(Histogram(name, help_text, label, buckets))
+
+    def gauge(self, name, help_text, read):
+
+        return self.add(Gauge(name, help_text, read))
+
+    def counter_function(self, name, help_text, read):
+
+        return self.add(CounterFunction(name, help_text, read))
+
+    def render(self):
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(registry, port, host="127.0.0.1"):
+
+    # Answer GET /metrics on a background thread; returns the HTTP server
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+
+            pass  # scrapes are not worth a log line
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
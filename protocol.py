@@ -0,0 +1,191 @@
+import json
+import re
+import struct
+import uuid
+
+
+# Binary frames start with a magic byte that can never begin a JSON object
+BINARY_MAGIC = 0xB7
+PROTOCOL_VERSION = 1
+
+# Codecs in order of preference
+CODECS = ("binary", "json")
+
+# Optional session features, negotiated in the join/welcome handshake
+FEATURES = ("reliable", "presence", "batch", "compress")
+# Frame types only clients with a feature understand: the others get downgrade(frame)
+FEATURE_FRAMES = {"presence": "presence"}
+
+# Every client starts in this room; room names are short and safe to use as directory names
+DEFAULT_ROOM = "general"
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+# Client ids are canonical UUID strings, the form binary frames carry them in
+CLIENT_ID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+HEADER = struct.Struct("!BBB")  # magic, version, message type
+U16 = struct.Struct("!H")
+U32 = struct.Struct("!I")
+U64 = struct.Struct("!Q")
+
+# Message type byte and ordered field layout of every binary frame.
+# Field kinds: "uuid" (16 raw bytes), "text" (u16 length + UTF-8),
+# "u16", "u32", "u64" and "bool" (one byte).
+MESSAGE_SCHEMAS = {
+    "join": (1, [("id", "uuid"), ("port", "u16")]),
+    "welcome": (2, [("name", "text"), ("codec", "text")]),
+    "message": (3, [("id", "uuid"), ("text", "text"), ("sender_name", "text"), ("seq", "u64"),
+                    ("room", "text")]),
+    "notice": (4, [("text", "text")]),
+    "leave": (5, [("id", "uuid")]),
+    "failover": (6, [("id", "text"), ("port", "u16")]),
+    "history_request": (7, [("id", "uuid"), ("last", "u32"), ("since", "u64")]),
+    "join_room": (8, [("id", "uuid"), ("room", "text")]),
+    "leave_room": (9, [("id", "uuid")]),
+    "room": (10, [("room", "text"), ("members", "u32"), ("log_seq", "u64")]),
+    "slow_down": (11, [("text", "text"), ("retry_ms", "u32")]),
+    "keepalive": (12, [("id", "uuid")]),
+    "presence": (13, [("room", "text"), ("joined", "u32"), ("left", "u32"), ("text", "text")]),
+    "roster_request": (14, [("id", "uuid"), ("page", "u32")]),
+}
+
+FIELD_DEFAULTS = {"uuid": None, "text": "", "u16": 0, "u32": 0, "u64": 0, "bool": False}
+NIL_UUID = bytes(16)
+
+TYPES_BY_CODE = {code: (name, fields) for name, (code, fields) in MESSAGE_SCHEMAS.items()}
+
+# Raw UUID bytes <-> canonical string, cached since the same ids recur on every frame
+UUID_CACHE_LIMIT = 65536
+uuid_strings = {}
+uuid_bytes = {}
+
+
+def uuid_to_bytes(value):
+
+    raw = uuid_bytes.get(value)
+    if raw is None:
+        raw = uuid.UUID(value).bytes if value else NIL_UUID
+        if len(uuid_bytes) >= UUID_CACHE_LIMIT:
+            uuid_bytes.clear()
+        uuid_bytes[value] = raw
+    return raw
+
+
+def uuid_from_bytes(raw):
+
+    value = uuid_strings.get(raw)
+    if value is None:
+        value = str(uuid.UUID(bytes=raw)) if raw != NIL_UUID else ""
+        if len(uuid_strings) >= UUID_CACHE_LIMIT:
+            uuid_strings.clear()
+        uuid_strings[raw] = value
+    return value
+
+
+def encode_binary(message):
+
+    # Fixed header followed by the fields of the message type, in schema order
+    code, fields = MESSAGE_SCHEMAS[message["type"]]
+    parts = [HEADER.pack(BINARY_MAGIC, PROTOCOL_VERSION, code)]
+    for name, kind in fields:
+        value = message.get(name, FIELD_DEFAULTS[kind])
+        if kind == "text":
+            raw = value.encode()
+            parts.append(U16.pack(len(raw)))
+            parts.append(raw)
+        elif kind == "uuid":
+            parts.append(uuid_to_bytes(value))
+        elif kind == "u16":
+            parts.append(U16.pack(value))
+        elif kind == "u32":
+            parts.append(U32.pack(value))
+        elif kind == "u64":
+            parts.append(U64.pack(value))
+        elif kind == "bool":
+            parts.append(b"\x01" if value else b"\x00")
+    return b"".join(parts)
+
+
+def decode_binary(payload):
+
+    magic, version, code = HEADER.unpack_from(payload)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"unsupported protocol version {version}")
+    if code not in TYPES_BY_CODE:
+        raise ValueError(f"unknown message type {code}")
+    name, fields = TYPES_BY_CODE[code]
+    message = {"type": name}
+    offset = HEADER.size
+    for field, kind in fields:
+        if kind == "text":
+            (length,) = U16.unpack_from(payload, offset)
+            offset += 2
+            message[field] = payload[offset:offset + length].decode()
+            offset += length
+        elif kind == "uuid":
+            message[field] = uuid_from_bytes(payload[offset:offset + 16])
+            offset += 16
+        elif kind == "u16":
+            (message[field],) = U16.unpack_from(payload, offset)
+            offset += 2
+        elif kind == "u32":
+            (message[field],) = U32.unpack_from(payload, offset)
+            offset += 4
+        elif kind == "u64":
+            (message[field],) = U64.unpack_from(payload, offset)
+            offset += 8
+        elif kind == "bool":
+            message[field] = payload[offset] == 1
+            offset += 1
+    if offset > len(payload):
+        raise ValueError("truncated binary frame")
+    return message
+
+
+def encode(message, codec="json"):
+
+    # Serialize a message dict with the negotiated codec
+    if codec == "binary" and message["type"] in MESSAGE_SCHEMAS:
+        return encode_binary(message)
+    # Raw UTF-8 rather than \u escapes keeps non-ASCII text from growing sixfold
+    return json.dumps(message, ensure_ascii=False).encode()
+
+
+def decode(payload):
+
+    # Detect the codec from the first byte: old peers only ever send JSON
+    if payload and payload[0] == BINARY_MAGIC:
+        return decode_binary(payload)
+    return json.loads(payload.decode())
+
+
+def valid_room(name):
+
+    return isinstance(name, str) and ROOM_NAME.fullmatch(name) is not None
+
+
+def valid_client_id(client_id):
+
+    return isinstance(client_id, str) and CLIENT_ID.fullmatch(client_id) is not None
+
+
+def negotiate_codec(offered, supported=CODECS):
+
+    # Pick the first codec offered by the peer that we support; JSON otherwise
+    for codec in offered or ():
+        if codec in supported:
+            return codec
+    return "json"
+
+
+def downgrade(message):
+
+    # What a client without the feature a frame needs receives instead
+    if message["type"] == "presence":
+        return {"type": "notice", "text": message["text"]}
+    return message
+
+
+def negotiate_features(offered, supported=FEATURES):
+
+    # Features both sides support; old peers offer none
+    return [feature for feature in offered or () if feature in supported]
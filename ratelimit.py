@@ -0,0 +1,49 @@
+# A client may relay CLIENT_RATE chat messages per second on average, in bursts of up to CLIENT_BURST
+CLIENT_RATE = 10.0
+CLIENT_BURST = 30.0
+# Deliveries (one message to one recipient) the server fans out per second over all
+# clients; tune to what the host and uplink sustain. Up to RELAY_BURST seconds' worth
+# may be spent at once.
+RELAY_BUDGET = 100000.0
+RELAY_BURST = 0.1
+# Messages waiting for relay budget; once full, further ones are dropped
+RELAY_QUEUE_LIMIT = 1000
+# The waiting messages are relayed this often (seconds), as far as the budget allows
+RELAY_TICK = 0.01
+# A throttled client is told to slow down at most this often (seconds)
+SLOW_DOWN_INTERVAL = 1.0
+
+
+class TokenBucket:
+
+    # Tokens refill at `rate` per second up to `capacity`. A cost above the capacity is
+    # granted from a full bucket and leaves it in debt, so a single large fan-out is
+    # never refused forever but still pays for its size.
+
+    def __init__(self, rate, capacity, now):
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now, cost=1.0):
+
+        # Spend cost tokens if there are enough; False leaves the bucket unchanged
+        self.refill(now)
+        if self.tokens < min(cost, self.capacity):
+            return False
+        self.tokens -= cost
+        return True
+
+    def wait_time(self, now, cost=1.0):
+
+        # Seconds until take(cost) would succeed
+        self.refill(now)
+        return max(min(cost, self.capacity) - self.tokens, 0.0) / self.rate
@@ -0,0 +1,166 @@
+import bisect
+import heapq
+import time
+
+
+class ServerRegistry:
+
+    # Known servers by id, with a secondary (ip, port) index, the ring order kept
+    # sorted, the current leader flags and a min-heap of expiry deadlines, so that
+    # discovery, election hops and reaping never scan the whole registry.
+
+    def __init__(self, timeout=20):
+
+        self.timeout = timeout
+        self.servers = {}  # server_id: {id, ip, port, isLeader, last_heartbeat}
+        self.ids_by_address = {}  # (ip, port): server_id
+        self.ring = []  # server ids in election ring order
+        self.leaders = set()  # ids currently flagged as leader
+        self.deadlines = {}  # server_id: time after which the server counts as dead
+        self.expiry = []  # heap of (deadline, server_id); stale entries are skipped lazily
+        self.version = 0  # bumped whenever a server is added, renamed or removed
+
+    def __len__(self):
+
+        return len(self.servers)
+
+    def __contains__(self, server_id):
+
+        return server_id in self.servers
+
+    def __iter__(self):
+
+        return iter(self.servers)
+
+    def __getitem__(self, server_id):
+
+        return self.servers[server_id]
+
+    def get(self, server_id, default=None):
+
+        return self.servers.get(server_id, default)
+
+    def values(self):
+
+        return self.servers.values()
+
+    def items(self):
+
+        return self.servers.items()
+
+    def upsert(self, server_id, ip, port, is_leader=None, now=None, deadline=None):
+
+        # Record a sign of life from a server, matching it by id or else by address.
+        # Returns (entry, whether it is new); is_leader None leaves the flag unchanged.
+        # The server expires at deadline, or timeout seconds from now if none is given.
+        now = time.time() if now is None else now
+        address = (ip, port)
+        info = self.servers.get(server_id)
+        if info is None:
+            old_id = self.ids_by_address.get(address)
+            if old_id is not None:
+                info = self.rename(old_id, server_id)
+        is_new = info is None
+        if is_new:
+            info = {
+                "id": server_id,
+                "ip": ip,
+                "port": port,
+                "isLeader": bool(is_leader),
+                "last_heartbeat": now
+            }
+            self.servers[server_id] = info
+            bisect.insort(self.ring, server_id)
+            self.version += 1
+        else:
+            old_address = (info["ip"], info["port"])
+            if old_address != address:
+                self.ids_by_address.pop(old_address, None)
+                info["ip"], info["port"] = ip, port
+            if is_leader is not None:
+                info["isLeader"] = bool(is_leader)
+            info["last_heartbeat"] = now
+        self.ids_by_address[address] = server_id
+        if info["isLeader"]:
+            self.leaders.add(server_id)
+        else:
+            self.leaders.discard(server_id)
+        if deadline is None:
+            deadline = now + self.timeout
+        if self.deadlines.get(server_id) != deadline:
+            self.deadlines[server_id] = deadline
+            heapq.heappush(self.expiry, (deadline, server_id))
+        return info, is_new
+
+    def rename(self, old_id, new_id):
+
+        # A server came back under another id on the same address
+        info = self.servers.pop(old_id)
+        self.deadlines.pop(old_id, None)
+        self.remove_from_ring(old_id)
+        if old_id in self.leaders:
+            self.leaders.discard(old_id)
+            self.leaders.add(new_id)
+        info["id"] = new_id
+        self.servers[new_id] = info
+        bisect.insort(self.ring, new_id)
+        self.version += 1
+        return info
+
+    def set_leader(self, leader_id):
+
+        # A leader was announced: it is now the only server flagged as leader
+        for server_id in self.leaders:
+            if server_id != leader_id and server_id in self.servers:
+                self.servers[server_id]["isLeader"] = False
+        self.leaders = {leader_id} if leader_id in self.servers else set()
+        if leader_id in self.servers:
+            self.servers[leader_id]["isLeader"] = True
+
+    def leader(self, exclude=None):
+
+        # Entry of a server flagged as leader (other than exclude), or None
+        for server_id in self.leaders:
+            if server_id != exclude:
+                return self.servers[server_id]
+        return None
+
+    def remove(self, server_id):
+
+        info = self.servers.pop(server_id, None)
+        if info is None:
+            return None
+        address = (info["ip"], info["port"])
+        if self.ids_by_address.get(address) == server_id:
+            del self.ids_by_address[address]
+        self.deadlines.pop(server_id, None)
+        self.remove_from_ring(server_id)
+        self.leaders.discard(server_id)
+        self.version += 1
+        return info
+
+    def remove_from_ring(self, server_id):
+
+        index = bisect.bisect_left(self.ring, server_id)
+        if index < len(self.ring) and self.ring[index] == server_id:
+            del self.ring[index]
+
+    def successor(self, server_id):
+
+        # Next server after server_id in ring order (wrapping around), or None if empty
+        if not self.ring:
+            return None
+        index = bisect.bisect_right(self.ring, server_id) % len(self.ring)
+        return self.ring[index]
+
+    def expired(self, now=None):
+
+        # Ids of servers whose deadline has passed, oldest deadline first
+        now = time.time() if now is None else now
+        expired = []
+        while self.expiry and self.expiry[0][0] <= now:
+            deadline, server_id = heapq.heappop(self.expiry)
+            # Only the newest heap entry of a server counts; earlier ones are stale
+            if self.deadlines.get(server_id) == deadline:
+                expired.append(server_id)
+        return expired
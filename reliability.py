@@ -0,0 +1,260 @@
+import heapq
+import random
+import struct
+import time
+
+
+# Reliable frames carry their own magic bytes in front of the (possibly fragmented) payload
+DATA_MAGIC = 0xD1
+ACK_MAGIC = 0xA1
+DATA_HEADER = struct.Struct("!BII")  # magic, stream id, sequence number
+ACK_HEADER = struct.Struct("!BIIB")  # magic, stream id, cumulative ack, number of SACK ranges
+SACK_RANGE = struct.Struct("!IH")  # first sequence number, length of a received run
+MAX_SACK_RANGES = 16
+
+SEQ_MASK = 0xFFFFFFFF
+
+# How often pending ACKs are flushed and retransmissions checked
+ACK_INTERVAL = 0.02
+
+
+def seq_delta(a, b):
+
+    # Signed distance a - b on the 32-bit sequence circle
+    return ((a - b + 0x80000000) & SEQ_MASK) - 0x80000000
+
+
+def is_reliable_frame(datagram):
+
+    return bool(datagram) and datagram[0] in (DATA_MAGIC, ACK_MAGIC)
+
+
+class ReliableChannel:
+
+    # One direction-pair of a reliable session with a single peer: sequences our
+    # outgoing frames, retransmits them until acknowledged, and delivers the
+    # peer's frames in order with coalesced cumulative/selective ACKs.
+
+    def __init__(self, window_size=256, min_rto=0.05, max_rto=2.0, max_retries=10, gap_timeout=None):
+
+        self.window_size = window_size
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_retries = max_retries
+        # A peer with the same settings retransmits a frame for up to its first RTO plus
+        # max_retries backed-off ones, each at most max_rto; skipping a gap any sooner
+        # drops frames that are still on their way. The extra max_rto covers poll ticks.
+        if gap_timeout is None:
+            gap_timeout = (max_retries + 2) * max_rto
+        self.gap_timeout = gap_timeout
+
+        # Sending side: random stream id so the peer notices a restarted sender
+        self.stream_id = random.getrandbits(32)
+        self.next_seq = 0
+        self.send_base = 0
+        self.in_flight = {}  # seq: [payload, deadline, retries, first_sent]
+        self.deadlines = []  # heap of (deadline, seq); stale entries are skipped lazily
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = 0.2
+
+        # Receiving side
+        self.peer_stream_id = None
+        self.expected = 0
+        self.out_of_order = {}  # seq: payload
+        self.gap_since = None
+        self.ack_pending = False
+
+        # Counters
+        self.retransmitted = 0
+        self.abandoned = 0
+        self.skipped = 0
+
+    @property
+    def busy(self):
+
+        # Whether poll() still has work to do for this channel
+        return bool(self.in_flight) or self.ack_pending or bool(self.out_of_order)
+
+    def wrap(self, payload, now=None):
+
+        # Sequence an outgoing payload and keep it until the peer acknowledges it
+        now = time.monotonic() if now is None else now
+        seq = self.next_seq
+        # Sliding window: never run more than window_size ahead of the oldest unacked
+        # frame. Past that we give up on it (bounded memory) and the peer skips the gap.
+        self.advance_send_base()
+        while seq_delta(seq, self.send_base) >= self.window_size:
+            if self.in_flight.pop(self.send_base, None) is not None:
+                self.abandoned += 1
+            self.send_base = (self.send_base + 1) & SEQ_MASK
+            self.advance_send_base()
+        self.next_seq = (seq + 1) & SEQ_MASK
+        # The payload is kept by reference, so frames shared by a fan-out are stored once
+        self.in_flight[seq] = [payload, now + self.rto, 0, now]
+        heapq.heappush(self.deadlines, (now + self.rto, seq))
+        return DATA_HEADER.pack(DATA_MAGIC, self.stream_id, seq) + payload
+
+    def advance_send_base(self):
+
+        # Oldest sequence number that may still be unacknowledged
+        while self.send_base != self.next_seq and self.send_base not in self.in_flight:
+            self.send_base = (self.send_base + 1) & SEQ_MASK
+
+    def on_datagram(self, datagram, now=None):
+
+        # Process one received datagram and return the payloads now deliverable in order
+        now = time.monotonic() if now is None else now
+        magic = datagram[0] if datagram else None
+        if magic == ACK_MAGIC:
+            self.on_ack(datagram, now)
+            return []
+        if magic == DATA_MAGIC:
+            return self.on_data(datagram, now)
+        # Plain datagrams (handshake, old peers) bypass the channel
+        return [datagram]
+
+    def on_data(self, datagram, now):
+
+        if len(datagram) < DATA_HEADER.size:
+            return []
+        _, stream_id, seq = DATA_HEADER.unpack_from(datagram)
+        if stream_id != self.peer_stream_id:
+            # New peer stream (first frame, or the peer restarted)
+            self.peer_stream_id = stream_id
+            self.expected = 0
+            self.out_of_order.clear()
+            self.gap_since = None
+        self.ack_pending = True
+
+        delta = seq_delta(seq, self.expected)
+        if delta < 0:
+            return []  # duplicate, the ACK will tell the peer again
+        delivered = []
+        if delta >= self.window_size:
+            # The peer abandoned frames we never got: jump so this one fits the window
+            delivered.extend(self.skip_to((seq - self.window_size + 1) & SEQ_MASK))
+            delivered.extend(self.drain_in_order(now))
+            delta = seq_delta(seq, self.expected)
+            if delta < 0:
+                return delivered
+        payload = datagram[DATA_HEADER.size:]
+        if delta > 0:
+            self.out_of_order.setdefault(seq, payload)
+            if self.gap_since is None:
+                self.gap_since = now
+            return delivered
+        delivered.append(payload)
+        self.expected = (self.expected + 1) & SEQ_MASK
+        delivered.extend(self.drain_in_order(now))
+        return delivered
+
+    def drain_in_order(self, now):
+
+        delivered = []
+        while self.expected in self.out_of_order:
+            delivered.append(self.out_of_order.pop(self.expected))
+            self.expected = (self.expected + 1) & SEQ_MASK
+        self.gap_since = now if self.out_of_order else None
+        return delivered
+
+    def skip_to(self, new_expected):
+
+        # Give up on missing frames before new_expected, delivering what we buffered
+        delivered = []
+        while seq_delta(new_expected, self.expected) > 0:
+            payload = self.out_of_order.pop(self.expected, None)
+            if payload is None:
+                self.skipped += 1
+            else:
+                delivered.append(payload)
+            self.expected = (self.expected + 1) & SEQ_MASK
+        return delivered
+
+    def on_ack(self, datagram, now):
+
+        if len(datagram) < ACK_HEADER.size:
+            return
+        _, stream_id, cumulative, range_count = ACK_HEADER.unpack_from(datagram)
+        if stream_id != self.stream_id:
+            return
+        ranges = []
+        offset = ACK_HEADER.size
+        for _ in range(range_count):
+            if offset + SACK_RANGE.size > len(datagram):
+                break
+            ranges.append(SACK_RANGE.unpack_from(datagram, offset))
+            offset += SACK_RANGE.size
+
+        for seq in list(self.in_flight):
+            acked = seq_delta(seq, cumulative) < 0
+            if not acked:
+                acked = any(0 <= seq_delta(seq, start) < length for start, length in ranges)
+            if acked:
+                _, _, retries, first_sent = self.in_flight.pop(seq)
+                if retries == 0:
+                    self.update_rto(now - first_sent)
+
+    def update_rto(self, sample):
+
+        # Smoothed RTT estimate (RFC 6298), only from frames that were never retransmitted
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def ack_frame(self):
+
+        # Cumulative ACK plus selective ranges of the frames buffered past the first gap
+        ranges = []
+        for seq in sorted(self.out_of_order, key=lambda seq: seq_delta(seq, self.expected)):
+            if ranges and seq_delta(seq, ranges[-1][0]) == ranges[-1][1]:
+                ranges[-1][1] += 1
+            elif len(ranges) < MAX_SACK_RANGES:
+                ranges.append([seq, 1])
+            else:
+                break
+        self.ack_pending = False
+        return ACK_HEADER.pack(ACK_MAGIC, self.peer_stream_id, self.expected, len(ranges)) + b"".join(
+            SACK_RANGE.pack(start, length) for start, length in ranges)
+
+    def poll(self, now=None):
+
+        # Timer work: returns (datagrams to send, payloads delivered after a gap timeout)
+        now = time.monotonic() if now is None else now
+        outgoing = []
+        delivered = []
+
+        if self.gap_since is not None and now - self.gap_since >= self.gap_timeout:
+            # A frame never arrived: skip to the next buffered one
+            first = min(self.out_of_order, key=lambda seq: seq_delta(seq, self.expected))
+            delivered.extend(self.skip_to(first))
+            delivered.extend(self.drain_in_order(now))
+            self.ack_pending = True
+
+        if self.ack_pending and self.peer_stream_id is not None:
+            outgoing.append(self.ack_frame())
+
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, seq = heapq.heappop(deadlines)
+            entry = self.in_flight.get(seq)
+            if entry is None or entry[1] != deadline:
+                continue  # acknowledged or rescheduled since
+            if entry[2] >= self.max_retries:
+                del self.in_flight[seq]
+                self.abandoned += 1
+                continue
+            # Retransmit with exponential backoff
+            entry[2] += 1
+            entry[1] = now + min(self.max_rto, self.rto * (2 ** entry[2]))
+            heapq.heappush(deadlines, (entry[1], seq))
+            self.retransmitted += 1
+            outgoing.append(DATA_HEADER.pack(DATA_MAGIC, self.stream_id, seq) + entry[0])
+        if not self.in_flight:
+            deadlines.clear()
+
+        return outgoing, delivered
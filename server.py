@@ -1,468 +1,1869 @@
-import socket
-import threading
-import json
-import uuid
-import time
-
-
-
-class Server:
-    
-    def __init__(self):
-
-        # Server attributes
-        self.port = 5001
-        self.multicast_group = '224.1.1.1'
-        self.discovery_port = 5010
-        
-        # Get IP address
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            self.ip = s.getsockname()[0]
-            s.close()
-        except:
-            self.ip = "127.0.0.1"
-            
-        # Server ID using IP:Port
-        self.id = f"{self.ip}:{self.port}"
-        self.is_leader = False
-        self.last_heartbeat = time.time()
-        self.voted = False
-
-
-        # Multicast discovery socket
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_socket.bind(('', self.port))
-        self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        except AttributeError:
-            pass  
-        self.discovery_socket.bind(('', self.discovery_port))
-        # Join multicast group
-        mreq = socket.inet_aton(self.multicast_group) + socket.inet_aton('0.0.0.0')
-        self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-        self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-
-        # group view
-        self.clients = {}  # client_id: {ip, port, name}
-        self.servers = {}  # server_id: {ip, port, isLeader}
-
-    def multicast_server_leader(self):
-
-        # Multicast that this server is the new leader
-        msg = {
-            "type": "leader",
-            "id": self.id,
-            "port": self.port
-        }
-        self.discovery_socket.sendto(json.dumps(
-            msg).encode(), (self.multicast_group, self.discovery_port))
-        print(f"Leader {self.id} announced.")
-
-    def send_to_all_clients(self, message, sender):
-
-        
-        sender_name = self.clients[sender]["name"]
-        message["sender_name"] = sender_name
-
-        print(f"📨 [{sender_name}]: {message['text']}")
-        print(f"   └─ Sending to {len(self.clients) - 1} other clients")
-
-        for client_id, info in self.clients.items():
-            if client_id != sender:
-                try:
-                    self.server_socket.sendto(json.dumps(
-                        message).encode(), (info["ip"], info["port"]))
-                except Exception as e:
-                    print(f"❌ Send error to {client_id}: {e}")
-
-    def send_system_message(self, message, exclude=None):
-
-        
-        target_count = len(self.clients) - (1 if exclude else 0)
-        print(f"📢 System message: {message['text']}")
-        print(f"   └─ Sending to {target_count} clients")
-        
-        for client_id, info in self.clients.items():
-            if client_id != exclude:
-                try:
-                    self.server_socket.sendto(json.dumps(
-                        message).encode(), (info["ip"], info["port"]))
-                except Exception as e:
-                    print(f"❌ Send error to {client_id}: {e}")
-
-    def display_client_list(self):
-
-        if not self.clients:
-            print("👥 No clients connected")
-            return
-            
-        print(f"\n👥 Connected Clients ({len(self.clients)}):")
-        print("─" * 50)
-        for i, (client_id, info) in enumerate(self.clients.items(), 1):
-            print(f"  {i}. {info['name']} ({info['ip']}:{info['port']})")
-        print("─" * 50)
-
-    def display_server_status(self):
-
-        print(f"\n🖥️  Server Status:")
-        print("─" * 50)
-        print(f"  Server ID: {self.id}")
-        print(f"  Leader: {'✅ Yes' if self.is_leader else '❌ No'}")
-        print(f"  Connected Clients: {len(self.clients)}")
-        print(f"  Known Servers: {len(self.servers)}")
-        print("─" * 50)
-
-    def initiate_server_leader_election(self):
-
-        # Start leader election with own token
-        print(f"Server {self.id} starting leader election...")
-        self.forward_server_token(self.id)
-
-    def remove_dead_server_nodes(self):
-
-        # Remove servers that haven't sent heartbeats for too long
-        while True:
-            time.sleep(5) 
-            now = time.time()
-            to_remove = []
-            for server_id, info in list(self.servers.items()):
-                if server_id == self.id:
-                    continue
-                last_hb = info.get("last_heartbeat", 0)
-                time_since_last = now - last_hb
-                # Remove if no activity for 20 seconds
-                if time_since_last > 20:
-                    print(f"❌ Removing dead server {server_id} ({info['ip']}:{info['port']}) from servers.")
-                    to_remove.append(server_id)
-            for server_id in to_remove:
-                self.servers.pop(server_id, None)
-            
-            # Display current status every health check
-            self.display_server_status()
-            self.display_client_list()
-
-    def forward_server_token(self, token_id):
-
-        # Forward the election token in the ring
-        sorted_servers = sorted(
-            self.servers.values(), key=lambda x: x["id"])
-        my_index = next((i for i, s in enumerate(
-            sorted_servers) if s["id"] == self.id), None)
-        if my_index is None:
-            return
-        
-        print(f"Forwarding token {token_id}. Known servers: {len(sorted_servers)}")
-        for s in sorted_servers:
-            print(f"  - {s['id']} ({s['ip']}:{s['port']}) Leader: {s['isLeader']}")
-        
-        # Check whether a leader already exists
-        existing_leader = next((s for s in sorted_servers if s["isLeader"] and s["id"] != self.id), None)
-        if existing_leader:
-            print(f"Leader already exists: {existing_leader['id']}. Not becoming leader.")
-            return
-        
-        # If only one server in the ring, become leader immediately
-        if len(sorted_servers) == 1:
-            print("Only one server in the ring. I will become leader.")
-            self.is_leader = True
-            self.multicast_server_leader()
-            threading.Thread(target=self.multicast_server_heartbeat, daemon=True).start()
-            self.voted = True
-            return
-        # Otherwise forward token to next server
-        for offset in range(1, len(sorted_servers)):
-            next_index = (my_index + offset) % len(sorted_servers)
-            next_server = sorted_servers[next_index]
-            next_address = (next_server["ip"], next_server["port"])
-            if next_server["id"] == self.id:
-                # Only this server remaining
-                print("No other reachable server. I will become leader.")
-                self.is_leader = True
-                self.multicast_server_leader()
-                threading.Thread(target=self.multicast_server_heartbeat, daemon=True).start()
-                self.voted = True
-                return
-            try:
-                election_msg = {
-                    "type": "election",
-                    "token": token_id
-                }
-                self.server_socket.sendto(json.dumps(
-                    election_msg).encode(), next_address)
-                print(f"Election token forwarded to {next_server['id']}")
-                return
-            except Exception as e:
-                print(f"Removing unreachable server {next_server['id']}: {e}")
-                self.servers.pop(next_server["id"], None)
-        # If no server is reachable, become leader
-        print("No reachable server in the ring. I will become leader.")
-        self.is_leader = True
-        self.multicast_server_leader()
-        threading.Thread(target=self.multicast_server_heartbeat, daemon=True).start()
-        self.voted = True
-
-    def multicast_server_discovery(self):
-
-        # Regular multicast messages for server discovery
-        while True:
-            msg = {
-                "type": "discover",
-                "id": self.id,
-                "port": self.port,
-                "isLeader": self.is_leader
-            }
-            self.discovery_socket.sendto(json.dumps(
-                msg).encode(), (self.multicast_group, self.discovery_port))
-            time.sleep(5) 
-
-    def multicast_server_heartbeat(self):
-
-        # Only the leader sends regular heartbeats via multicast
-        while self.is_leader:
-            msg = {
-                "type": "heartbeat",
-                "id": self.id,
-                "port": self.port
-            }
-            self.discovery_socket.sendto(json.dumps(
-                msg).encode(), (self.multicast_group, self.discovery_port))
-            print("Heartbeat sent by the leader.")
-            time.sleep(5)
-
-    def monitor_server_heartbeat(self):
-
-        # Check regularly if heartbeat from leader is still being received
-        while True:
-            time.sleep(5)  
-            # Only initiate election if we're not the leader and haven't received heartbeats
-            if not self.is_leader and (time.time() - self.last_heartbeat > 15):
-                print(f"Leader unresponsive for {time.time() - self.last_heartbeat:.1f}s. Initiating leader election.")
-                self.initiate_server_leader_election()
-
-    def listen_on_discovery_port(self):
-        # Receiving Discovery, Heartbeat or Leader messages
-        while True:
-            message, address = self.discovery_socket.recvfrom(1024)
-            data = json.loads(message.decode())
-            server_id = data['id']
-            server_ip = address[0]
-            server_port = data['port']
-
-            if data["type"] == "discover":
-                # Search for an existing server with the same IP:Port
-                existing_server = None
-                for sid, info in self.servers.items():
-                    if info["ip"] == server_ip and info["port"] == server_port:
-                        existing_server = sid
-                        break
-                
-                if existing_server:
-                    # Update existing server
-                    self.servers[existing_server]["id"] = server_id
-                    self.servers[existing_server]["isLeader"] = data['isLeader']
-                    self.servers[existing_server]["last_heartbeat"] = time.time()
-                    print(f"Updated existing server: {server_ip}:{server_port}")
-                    
-                    # If it is a leader, also update self.last_heartbeat
-                    if data['isLeader'] and server_id != self.id:
-                        self.last_heartbeat = time.time()
-                        print(f"Leader discovery received from {server_ip}:{server_port}")
-                else:
-                    # New server discovered
-                    self.servers[server_id] = {
-                        "id": server_id,
-                        "ip": server_ip,
-                        "port": server_port,
-                        "isLeader": data['isLeader'],
-                        "last_heartbeat": time.time()
-                    }
-                    print(f"Discovered new server: {server_ip}:{server_port}")
-                    # Only start new leader election if no leader exists
-                    if not self.is_leader and not any(info["isLeader"] for info in self.servers.values()):
-                        print("New server discovered and no leader exists. Initiating leader election...")
-                        self.initiate_server_leader_election()
-
-            # Leader message
-            elif data["type"] == "leader":
-                # Leader was announced
-                leader_id = server_id
-                self.is_leader = (leader_id == self.id)
-                self.voted = False
-                print(f"Server {leader_id} has been elected as leader.")
-
-                if leader_id in self.servers:
-                    self.servers[leader_id]["isLeader"] = True
-                else:
-                    self.servers[leader_id] = {
-                        "id": leader_id,
-                        "ip": address[0],
-                        "port": data["port"],
-                        "isLeader": True,
-                        "last_heartbeat": time.time()
-                    }
-
-            # Heartbeat message
-            elif data["type"] == "heartbeat":
-                if server_id != self.id:
-                    self.last_heartbeat = time.time()
-                    # Update heartbeat time for this server
-                    if server_id in self.servers:
-                        self.servers[server_id]["last_heartbeat"] = time.time()
-                    else:
-                        # Search for servers with the same IP:Port
-                        existing_server = None
-                        for sid, info in self.servers.items():
-                            if info["ip"] == server_ip and info["port"] == server_port:
-                                existing_server = sid
-                                break
-                        
-                        if existing_server:
-                            # Update existing server
-                            self.servers[existing_server]["id"] = server_id
-                            self.servers[existing_server]["last_heartbeat"] = time.time()
-                        else:
-                            # New server
-                            self.servers[server_id] = {
-                                "id": server_id,
-                                "ip": server_ip,
-                                "port": server_port,
-                                "isLeader": False,
-                                "last_heartbeat": time.time()
-                            }
-                    print(
-                        f"Heartbeat received from leader {server_ip}:{server_port}.")
-
-    def listen_on_server_client_port(self):
-
-        # Receive messages from clients or election tokens
-        while True:
-            try:
-                message, address = self.server_socket.recvfrom(1024)
-                data = json.loads(message.decode())
-
-                if data["type"] == "join":
-                    # Client wants to join
-                    client_id = data["id"]
-                    client_ip = address[0]
-                    client_port = data["port"]
-
-                    if client_id not in self.clients:
-                        client_number = len(self.clients) + 1
-                        self.clients[client_id] = {
-                            "id": client_id,
-                            "ip": client_ip,
-                            "port": client_port,
-                            "name": f"Client {client_number}"
-                        }
-                        print(f"\n✅ {self.clients[client_id]['name']} connected from {client_ip}:{client_port}")
-                        self.display_client_list()
-
-                        # Reply to client with their name
-                        welcome = {
-                            "type": "welcome",
-                            "name": f"Client {client_number}"
-                        }
-                        self.server_socket.sendto(json.dumps(
-                            welcome).encode(), (client_ip, client_port))
-
-                        # Notify other clients about join
-                        notice = {
-                            "type": "notice",
-                            "text": f"Client {client_number} has joined the chat."
-                        }
-                        self.send_system_message(notice, exclude=client_id)
-
-                elif data["type"] == "message":
-                    # Message received from client
-                    sender_id = data["id"]
-                    text = data["text"]
-                    sender_name = self.clients[sender_id]["name"]
-                    print(f"\n💬 Message from {sender_name}: {text}")
-                    self.send_to_all_clients(data, sender_id)
-
-                elif data["type"] == "leave":
-                    # Client has left the chat
-                    client_id = data["id"]
-                    if client_id in self.clients:
-                        name = self.clients[client_id]["name"]
-                        print(f"\n👋 {name} has left the chat.")
-                        self.clients.pop(client_id)
-                        self.display_client_list()
-
-                        notice = {
-                            "type": "notice",
-                            "text": f"{name} has left the chat."
-                        }
-                        self.send_system_message(notice)
-
-                elif data["type"] == "election":
-                    # Election token received and processed
-                    token_id = data["token"]
-                    if not self.voted:
-                        if token_id > self.id:
-                            self.forward_server_token(token_id)
-                            self.voted = True
-                        elif token_id < self.id:
-                            self.forward_server_token(self.id)
-                            self.voted = True
-                        elif token_id == self.id:
-                            print("🎉 I was elected as leader!")
-                            self.is_leader = True
-                            self.multicast_server_leader()
-                            threading.Thread(
-                                target=self.multicast_server_heartbeat, daemon=True).start()
-                            self.voted = True
-                    else:
-                        # Already voted, no re-broadcast/thread-start
-                        pass
-
-            except Exception as e:
-                print(f"❌ Server error: {e}")
-
-    def start_server_system(self):
-
-        # Server startup and start parallel threads
-        print("🚀 Starting Distributed Chat Server...")
-        print("=" * 60)
-        print(f"🖥️  Server ID: {self.id}")
-        print(f"🌐 Server running on port {self.port}")
-        print(f"🔍 Listening for discovery messages on port {self.discovery_port}")
-        print(f"📡 Multicast group: {self.multicast_group}")
-        print("=" * 60)
-
-        threading.Thread(target=self.listen_on_server_client_port, daemon=True).start()
-        threading.Thread(target=self.listen_on_discovery_port, daemon=True).start()
-        threading.Thread(target=self.monitor_server_heartbeat, daemon=True).start()
-        threading.Thread(target=self.multicast_server_discovery, daemon=True).start()
-        threading.Thread(target=self.remove_dead_server_nodes, daemon=True).start()
-
-        time.sleep(10)  # Time for discovery of other servers
-        
-        # Check if leader election is needed at startup
-        if not self.is_leader and not any(info["isLeader"] for info in self.servers.values()):
-            print("No leader found at startup. Initiating leader election...")
-            self.initiate_server_leader_election()
-        elif any(info["isLeader"] for info in self.servers.values()):
-            leader = next(s for s in self.servers.values() if s["isLeader"])
-            print(f"Leader already exists: {leader['id']}")
-
-        # Display server status and client list
-        print("\n✅ Server system started successfully!")
-        print("📊 Initial status:")
-        self.display_server_status()
-        self.display_client_list()
-
-        # Keep main thread alive
-        while True:
-            time.sleep(1)
-
-
-if __name__ == "__main__":
-
-    # Start the server
-    server = Server()
-    server.start_server_system()
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import random
+import socket
+import threading
+import json
+import logging
+import os
+import sys
+import uuid
+import time
+
+import metrics
+import protocol
+from coalescing import Coalescer, BATCH_DELAY
+from compression import compress, COMPRESS_THRESHOLD
+from election import TermElection, ELECTION_TICK, LEADER_TIMEOUT, valid_term
+from failure_detector import PhiAccrualDetector, HEARTBEAT_INTERVAL
+from fragmentation import Fragmenter, Reassembler, RECV_BUFFER_SIZE, MAX_MESSAGE_SIZE, RELAY_HEADER_ALLOWANCE
+from message_log import MessageLog, MAX_REPLAY, REPLAY_BATCH_BYTES
+from ratelimit import TokenBucket, CLIENT_RATE, CLIENT_BURST, RELAY_BUDGET, RELAY_BURST, \
+    RELAY_QUEUE_LIMIT, RELAY_TICK, SLOW_DOWN_INTERVAL
+from registry import ServerRegistry
+from reliability import ReliableChannel, is_reliable_frame, ACK_INTERVAL
+from sessions import ClientSession, TimerWheel, CLIENT_IDLE_TIMEOUT, SWEEP_TICK, PRESENCE_INTERVAL, \
+    ROSTER_PAGE, generate_resume_secret, make_resume_token, read_resume_token, presence_delta
+from sharding import HashRing
+from transport import create_transport
+import workers
+
+
+# Console output: the periodic status at info level, every relayed message at debug level
+logger = logging.getLogger("chat.server")
+
+
+class ServerDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, handler, label):
+
+        # Hand every datagram received on the endpoint to the server handler
+        self.handler = handler
+        self.label = label
+
+    def datagram_received(self, data, addr):
+
+        try:
+            self.handler(data, addr)
+        except Exception as e:
+            logger.error(f"❌ {self.label} error: {e}")
+
+    def error_received(self, exc):
+
+        logger.error(f"❌ {self.label} socket error: {exc}")
+
+
+class Server:
+    
+    def __init__(self, port=5001, discovery_port=5010, engine="threaded", transport="auto",
+                 codecs=protocol.CODECS, features=protocol.FEATURES, log_dir=None, sharded=False,
+                 worker_count=1, election="term", metrics_port=None, client_rate=CLIENT_RATE,
+                 client_burst=CLIENT_BURST, relay_budget=RELAY_BUDGET,
+                 client_idle_timeout=CLIENT_IDLE_TIMEOUT, resume_secret=None,
+                 batch_delay=BATCH_DELAY, compress_threshold=COMPRESS_THRESHOLD):
+
+        # Server attributes
+        self.port = port
+        self.multicast_group = '224.1.1.1'
+        self.discovery_port = discovery_port
+
+        # Event engine: "threaded" (one thread per loop) or "asyncio" (single event loop)
+        self.engine = engine
+        self.loop = None
+        # Guards the group view when the threaded engine is used
+        self.lock = threading.RLock()
+
+        # Wire codecs this server accepts from clients, in order of preference
+        self.codecs = tuple(codecs)
+        # Session features this server offers to clients
+        self.features = tuple(features)
+        # Clients with the "batch" feature get the room frames sent to them within
+        # batch_delay seconds packed into one datagram; 0 sends every frame at once
+        self.batch_delay = batch_delay
+        if not batch_delay:
+            self.features = tuple(feature for feature in self.features if feature != "batch")
+        self.coalescer = Coalescer()
+        # Clients with the "compress" feature get the datagrams of compress_threshold
+        # bytes or more deflated against the chat dictionary
+        self.compress_threshold = compress_threshold
+        
+        # Get IP address
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(("8.8.8.8", 80))
+            self.ip = s.getsockname()[0]
+            s.close()
+        except:
+            self.ip = "127.0.0.1"
+            
+        # Server ID using IP:Port
+        self.id = f"{self.ip}:{self.port}"
+        self.is_leader = False
+        self.last_heartbeat = time.time()
+        self.voted = False
+        # Leader election: "term" (terms, majority votes, randomized timeouts) or
+        # "ring" (the original token passed around the ring of server ids)
+        self.election_mode = election
+        self.election = TermElection(self.id)
+        # Suspicion of other servers learned from their heartbeat inter-arrival times
+        self.failure_detector = PhiAccrualDetector()
+        self.leader_timeout = LEADER_TIMEOUT  # silence after which the leader counts as gone
+
+        # Pre-fork mode: worker_count processes share the client port through SO_REUSEPORT.
+        # Worker 0 (this process) is the primary and alone runs discovery and election.
+        if worker_count > 1 and not workers.prefork_available():
+            logger.warning("⚠️  Pre-forked workers need fork() and SO_REUSEPORT, running a single process")
+            worker_count = 1
+        self.worker_count = worker_count
+        self.worker_index = 0
+        self.primary_pid = os.getpid()
+        self.control_socket = None
+        self.worker_addresses = []  # control socket address of every worker, by index
+        self.worker_processes = {}  # primary: worker index: Process
+        self.client_counter = None  # shared-memory counter for client names across workers
+        self.remote_clients = {}  # client_id: ClientSession owned by another worker
+        self.remote_ids_by_address = {}  # (ip, port): client_id owned by another worker
+
+
+        # Multicast discovery socket
+        if worker_count > 1:
+            self.server_socket = workers.bind_reuseport(self.port)
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server_socket.bind(('', self.port))
+        # Fan-out goes through a pluggable transport (batched sendmmsg on Linux)
+        self.transport_backend = transport
+        self.transport = create_transport(self.server_socket, transport)
+        # Large payloads are split into MTU-sized fragments and reassembled on receipt
+        self.fragmenter = Fragmenter()
+        self.reassembler = Reassembler()
+        self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except AttributeError:
+            pass  
+        self.discovery_socket.bind(('', self.discovery_port))
+        # Join multicast group
+        mreq = socket.inet_aton(self.multicast_group) + socket.inet_aton('0.0.0.0')
+        self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+
+        # group view
+        self.clients = {}  # client_id: ClientSession
+        self.client_addresses = {}  # client_id: (ip, port), cached for fan-out
+        self.client_ids_by_address = {}  # (ip, port): client_id
+        self.channels = {}  # client_id: ReliableChannel, for clients using "reliable"
+        self.busy_channels = set()  # client_ids whose channel has ACKs or retransmissions pending
+        self.rooms = {}  # room: {client_id: (ip, port)}, so fan-out only touches the room's members
+        # Sessions of clients not heard from (no datagram, no keepalive) for
+        # client_idle_timeout seconds are evicted; the wheel finds them without a scan
+        self.client_idle_timeout = client_idle_timeout
+        self.idle_wheel = TimerWheel(time.monotonic())
+        # Welcomes carry a resume token: a client joining again with it (after losing its
+        # server, or being evicted) keeps its name and room, and gets what it missed.
+        # Without a shared secret the tokens are only good on this server.
+        if resume_secret is None:
+            resume_secret = generate_resume_secret()
+            logger.warning("⚠️  No cluster secret: resume tokens only work on this server until it restarts")
+        self.resume_secret = resume_secret
+        # Presence: joins and leaves held back while a room's updates are rate limited
+        self.pending_presence = {}  # room: {event: [(name, client not to tell)]}
+        self.presence_sent = {}  # room: when its last presence update went out
+
+        # Replication of the client table from the leader to followers
+        self.membership_version = 0  # bumped by the leader on every membership change
+        self.pending_snapshot = None  # follower: {"version", "count", "pages"} being assembled
+        self.servers = ServerRegistry(timeout=20)  # server_id: {id, ip, port, isLeader, last_heartbeat}
+
+        # On-disk chat history replayed to late joiners, one log per room (disabled without a log directory)
+        self.log_dir = log_dir
+        self.message_logs = {}  # room: MessageLog, opened on first use
+
+        # Sharded mode: clients are spread over all live servers by consistent hashing of
+        # their id, each server relays to its own clients and forwards to its peers
+        self.sharded = sharded
+        self.ring = HashRing()
+        self.ring_version = None  # registry version the hash ring was last built from
+        self.next_client_number = 1  # leader: names handed out to routed joins
+        self.peer_channels = {}  # (ip, port) of another server: ReliableChannel for relayed frames
+        self.busy_peers = set()  # peer addresses whose channel has ACKs or retransmissions pending
+
+        # Counters and histograms served in the Prometheus text format on
+        # 127.0.0.1:metrics_port (worker n: metrics_port + n); None disables the endpoint
+        self.metrics_port = metrics_port
+        self.metrics = metrics.MetricsRegistry()
+        self.datagrams_received = self.metrics.counter(
+            "chat_datagrams_received_total", "Datagrams received, by socket", "socket")
+        self.metrics.counter_function(
+            "chat_datagrams_sent_total", "Datagrams sent through the client-port transport",
+            lambda: self.transport.datagrams)
+        self.metrics.counter_function(
+            "chat_send_syscalls_total", "Send syscalls made by the client-port transport",
+            lambda: self.transport.syscalls)
+        self.parse_seconds = self.metrics.histogram(
+            "chat_parse_seconds", "Time to reassemble and decode a frame, by frame type", "type")
+        self.fanout_seconds = self.metrics.histogram(
+            "chat_fanout_seconds", "Time to encode and send one frame to its recipients")
+        self.election_events = self.metrics.counter(
+            "chat_election_events_total", "Leader election events, by event", "event")
+        self.heartbeat_lag = self.metrics.histogram(
+            "chat_heartbeat_lag_seconds", "How late peer heartbeats arrive past the heartbeat interval",
+            buckets=metrics.LAG_BUCKETS)
+        self.metrics.gauge("chat_clients", "Clients connected to this process", lambda: len(self.clients))
+        self.metrics.gauge("chat_rooms", "Rooms with members in this process", lambda: len(self.rooms))
+        self.metrics.gauge("chat_known_servers", "Servers in the registry", lambda: len(self.servers))
+        self.metrics.gauge("chat_is_leader", "1 while this server leads", lambda: int(self.is_leader))
+        self.metrics.gauge("chat_election_term", "Current election term", lambda: self.election.term)
+        self.metrics_server = None
+
+        # Flood control: each client's chat messages pass a token bucket (client_rate per
+        # second), and the fan-out they cause a global budget of deliveries per second.
+        # Messages over the client's rate are dropped, those over the budget wait in
+        # relay_queue; either way the sender is told to slow down. 0 disables a limit.
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.client_buckets = {}  # client_id: TokenBucket
+        self.relay_budget = None
+        if relay_budget:
+            self.relay_budget = TokenBucket(relay_budget, relay_budget * RELAY_BURST, time.monotonic())
+        self.relay_queue = collections.deque()  # (message, sender id) waiting for relay budget
+        self.slow_down_sent = {}  # client_id: when it was last told to slow down
+        self.messages_dropped = self.metrics.counter(
+            "chat_messages_dropped_total", "Chat messages dropped by flood control, by limit", "limit")
+        self.metrics.gauge("chat_relay_queue", "Chat messages waiting for relay budget",
+                           lambda: len(self.relay_queue))
+        self.clients_evicted = self.metrics.counter(
+            "chat_clients_evicted_total", "Client sessions evicted after client_idle_timeout of silence")
+
+    def multicast_server_leader(self):
+
+        # Multicast that this server is the new leader
+        msg = {
+            "type": "leader",
+            "id": self.id,
+            "port": self.port,
+            "term": self.election.term
+        }
+        self.discovery_socket.sendto(json.dumps(
+            msg).encode(), (self.multicast_group, self.discovery_port))
+        logger.info(f"Leader {self.id} announced.")
+
+    def room_log(self, room):
+
+        # Message log of a room, or None when history is disabled
+        if self.log_dir is None:
+            return None
+        log = self.message_logs.get(room)
+        if log is None:
+            log = self.message_logs[room] = MessageLog(os.path.join(self.log_dir, room))
+        return log
+
+    def relay_client_message(self, message, sender):
+
+        # Admit a client's chat message: over the sender's own rate it is dropped, over
+        # the relay budget it waits (or, with the queue full, is dropped too)
+        now = time.monotonic()
+        if self.client_rate:
+            bucket = self.client_buckets.get(sender)
+            if bucket is None:
+                bucket = self.client_buckets[sender] = TokenBucket(self.client_rate, self.client_burst, now)
+            if not bucket.take(now):
+                self.messages_dropped.inc("client_rate")
+                self.send_slow_down(sender, bucket.wait_time(now), now)
+                return
+        if self.relay_budget is not None:
+            if self.relay_queue or not self.relay_budget.take(now, self.relay_cost(sender)):
+                if len(self.relay_queue) >= RELAY_QUEUE_LIMIT:
+                    self.messages_dropped.inc("relay_budget")
+                    self.send_slow_down(sender, SLOW_DOWN_INTERVAL, now)
+                    return
+                self.relay_queue.append((message, sender))
+                # Roughly how long the deliveries queued ahead of it take
+                wait = len(self.relay_queue) * self.relay_cost(sender) / self.relay_budget.rate
+                self.send_slow_down(sender, wait, now, "You are sending too fast, your messages are delayed")
+                return
+        self.send_to_all_clients(message, sender)
+
+    def relay_cost(self, sender):
+
+        # Deliveries a message of sender costs here: one per other member of its room
+        return max(len(self.rooms.get(self.clients[sender].room, ())) - 1, 1)
+
+    def drain_relay_queue(self):
+
+        # Relay waiting messages while the budget lasts (runs every RELAY_TICK seconds);
+        # the bucket's capacity bounds the fan-out work done per tick
+        now = time.monotonic()
+        while self.relay_queue:
+            message, sender = self.relay_queue[0]
+            if sender not in self.clients:
+                self.relay_queue.popleft()
+                continue
+            if not self.relay_budget.take(now, self.relay_cost(sender)):
+                break
+            self.relay_queue.popleft()
+            self.send_to_all_clients(message, sender)
+
+    def send_slow_down(self, client_id, retry_after, now,
+                       text="You are sending too fast, some messages were not delivered"):
+
+        # Ask a throttled client to back off, at most once per SLOW_DOWN_INTERVAL
+        if now - self.slow_down_sent.get(client_id, now - SLOW_DOWN_INTERVAL) < SLOW_DOWN_INTERVAL:
+            return
+        self.slow_down_sent[client_id] = now
+        notice = {
+            "type": "slow_down",
+            "text": text,
+            "retry_ms": int(retry_after * 1000) + 1
+        }
+        self.send_to_client(client_id, protocol.encode(notice, self.clients[client_id].codec))
+
+    def send_to_all_clients(self, message, sender):
+
+        
+        sender_name = self.clients[sender].name
+        room = self.clients[sender].room
+        message["sender_name"] = sender_name
+        message["room"] = room
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"📨 [{sender_name}] #{room}: {message['text']}")
+            logger.debug(f"   └─ Sending to {len(self.rooms[room]) - 1} other clients")
+
+        self.deliver_to_room(message, exclude=sender)
+        self.relay_beyond_process(message, room)
+
+    def deliver_to_room(self, message, exclude=None):
+
+        # Store a chat message under this server's sequence numbers and fan it out to
+        # the room's members connected here
+        room = message["room"]
+        log = self.room_log(room)
+        if log is not None:
+            # The stored record already carries its sequence number, so replay needs no re-encoding.
+            # A binary frame can outgrow the limit as JSON (escaped text): such a message
+            # could be neither replayed nor sent to JSON clients, so it is not kept at all.
+            message["seq"] = log.next_seq
+            record = protocol.encode(message)
+            if len(record) > MAX_MESSAGE_SIZE:
+                logger.warning(f"⚠️  Dropped a message of {len(record)} bytes in #{room}: over the size limit")
+                return
+            log.append(record)
+
+        self.broadcast_frame(message, exclude=exclude, room=room)
+
+    def send_system_message(self, message, exclude=None, room=None):
+
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            targets = self.clients if room is None else self.rooms.get(room, {})
+            target_count = len(targets) - (1 if exclude in targets else 0)
+            logger.debug(f"📢 System message: {message['text']}")
+            logger.debug(f"   └─ Sending to {target_count} clients")
+
+        self.broadcast_frame(message, exclude=exclude, room=room)
+        self.relay_beyond_process(message, room)
+
+    def relay_beyond_process(self, message, room, from_worker=False, from_peer=False):
+
+        # Pass a room frame delivered here on to the clients this process does not serve:
+        # sibling workers over the control channel, and (primary only) peer shards
+        if self.worker_count > 1 and not from_worker:
+            self.send_to_workers({
+                "type": "worker_relay",
+                "room": room,
+                "message": message
+            })
+        if self.sharded and self.worker_index == 0 and not from_peer:
+            self.relay_to_peers(message, room)
+
+    def relay_to_peers(self, message, room):
+
+        # Sharded mode: hand a room frame to every other server over its reliable peer channel,
+        # encoded and fragmented once for all of them
+        fragments = self.fragmenter.split(protocol.encode({
+            "type": "shard_relay",
+            "room": room,
+            "message": message
+        }))
+        now = time.monotonic()
+        datagrams = []
+        for address in self.follower_addresses():
+            channel = self.peer_channels.get(address)
+            if channel is None:
+                channel = self.peer_channels[address] = ReliableChannel()
+            for fragment in fragments:
+                datagrams.append((channel.wrap(fragment, now), address))
+            self.busy_peers.add(address)
+        for index, e in self.transport.send_many(datagrams):
+            logger.error(f"❌ Relay send error to {datagrams[index][1]}: {e}")
+
+    def shard_owner(self, client_id):
+
+        # Live server the hash ring assigns a client to; the ring follows the known server set
+        if self.ring_version != self.servers.version or self.id not in self.ring.nodes:
+            self.ring_version = self.servers.version
+            live = set(self.servers) | {self.id}
+            for server_id in self.ring.nodes - live:
+                self.ring.remove(server_id)
+            for server_id in live - self.ring.nodes:
+                self.ring.add(server_id)
+        return self.ring.lookup(client_id)
+
+    def broadcast_frame(self, message, exclude=None, plain=False, room=None):
+
+        # Serialize (and fragment) once per codec and reuse the same buffers for every
+        # recipient; reliable clients only add their own small sequence header unless
+        # the frame is sent plain (outside the reliable channel). With a room, only
+        # that room's subscribers are visited. Clients lacking the feature a frame
+        # type needs get its downgraded form, also encoded once. Frames for clients
+        # with the "batch" feature wait in the coalescer for flush_batches; those for
+        # clients with "compress" are deflated, each distinct datagram once.
+        started = time.perf_counter()
+        fragments_by_codec = {}
+        compressed = {}
+        recipients = []
+        datagrams = []
+        now = time.monotonic()
+        feature = protocol.FEATURE_FRAMES.get(message["type"])
+        targets = self.client_addresses if room is None else self.rooms.get(room, {})
+        for client_id, address in targets.items():
+            if client_id == exclude:
+                continue
+            session = self.clients[client_id]
+            key = session.codec
+            if feature is not None and feature not in session.features:
+                key = (session.codec, "downgraded")
+            fragments = fragments_by_codec.get(key)
+            if fragments is None:
+                frame = message if key == session.codec else protocol.downgrade(message)
+                try:
+                    fragments = self.fragmenter.split(protocol.encode(frame, session.codec))
+                except ValueError as e:
+                    # Too large in this encoding: its recipients miss it, the others do not
+                    logger.error(f"❌ Cannot send {message['type']} as {session.codec}: {e}")
+                    fragments = []
+                fragments_by_codec[key] = fragments
+            if not fragments:
+                continue
+            outgoing = fragments
+            if not plain and "batch" in session.features:
+                if len(fragments) == 1 and self.coalescer.fits(fragments[0]):
+                    batch = self.coalescer.add(client_id, fragments[0])
+                    if batch is None:
+                        continue
+                    outgoing = [batch]
+                elif client_id in self.coalescer.queues:
+                    # Too large to share a datagram: the frames queued before it go first
+                    outgoing = [self.coalescer.take(client_id)] + fragments
+            channel = None if plain else self.channels.get(client_id)
+            compressing = "compress" in session.features
+            for fragment in outgoing:
+                if compressing:
+                    fragment = self.compress_payload(fragment, compressed)
+                recipients.append(client_id)
+                if channel is None:
+                    datagrams.append((fragment, address))
+                else:
+                    datagrams.append((channel.wrap(fragment, now), address))
+            if channel is not None:
+                self.busy_channels.add(client_id)
+        failures = self.transport.send_many(datagrams)
+        for index, e in failures:
+            logger.error(f"❌ Send error to {recipients[index]}: {e}")
+        self.fanout_seconds.observe(time.perf_counter() - started)
+
+    def send_to_client(self, client_id, payload):
+
+        # One encoded frame to a single client, fragmented and sent over its reliable channel
+        address = self.client_addresses[client_id]
+        channel = self.channels.get(client_id)
+        now = time.monotonic()
+        datagrams = []
+        fragments = self.fragmenter.split(payload)
+        if client_id in self.coalescer.queues:
+            # Room frames queued for the client go first
+            fragments.insert(0, self.coalescer.take(client_id))
+        compressing = "compress" in self.clients[client_id].features
+        for fragment in fragments:
+            if compressing:
+                fragment = compress(fragment, self.compress_threshold)
+            if channel is not None:
+                fragment = channel.wrap(fragment, now)
+            datagrams.append((fragment, address))
+        if channel is not None:
+            self.busy_channels.add(client_id)
+        for index, e in self.transport.send_many(datagrams):
+            logger.error(f"❌ Send error to {client_id}: {e}")
+
+    def flush_batches(self):
+
+        # Send the frames queued for each client, one datagram per client (runs every batch_delay seconds)
+        if not self.coalescer.queues:
+            return
+        now = time.monotonic()
+        datagrams = []
+        compressed = {}
+        for client_id, batch in self.coalescer.drain():
+            if "compress" in self.clients[client_id].features:
+                # Members of a busy room mostly have the same batch queued
+                batch = self.compress_payload(batch, compressed)
+            channel = self.channels.get(client_id)
+            if channel is not None:
+                batch = channel.wrap(batch, now)
+                self.busy_channels.add(client_id)
+            datagrams.append((batch, self.client_addresses[client_id]))
+        for index, e in self.transport.send_many(datagrams):
+            logger.error(f"❌ Send error to {datagrams[index][1]}: {e}")
+
+    def compress_payload(self, payload, compressed):
+
+        # Deflate a datagram once per send round, however many clients it goes to
+        packed = compressed.get(payload)
+        if packed is None:
+            packed = compressed[payload] = compress(payload, self.compress_threshold)
+        return packed
+
+    def replay_history(self, client_id, last=0, since=0):
+
+        # Stream stored messages of the client's room: the last `last` ones, or those from seq
+        # `since` on. Records are JSON already, so batches are built by joining them without decoding.
+        log = self.room_log(self.clients[client_id].room)
+        if last:
+            records = log.last(min(last, MAX_REPLAY))
+        else:
+            records = log.read_from(since, MAX_REPLAY)
+        next_seq = records[-1][0] + 1 if records else max(since, log.first_seq)
+        logger.debug(f"📜 Replaying {len(records)} stored messages to {self.clients[client_id].name}")
+
+        batches = [[]]
+        batch_size = 0
+        for seq, _, payload in records:
+            if batches[-1] and batch_size + len(payload) > REPLAY_BATCH_BYTES:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append((seq, payload))
+            batch_size += len(payload) + 2
+        for index, batch in enumerate(batches):
+            done = index == len(batches) - 1
+            header = json.dumps({
+                "type": "history",
+                "next": next_seq if done else batches[index + 1][0][0],
+                "done": done
+            })
+            try:
+                self.send_to_client(client_id, header[:-1].encode() + b', "messages": ['
+                                    + b", ".join(payload for _, payload in batch) + b"]}")
+            except ValueError as e:
+                # A single stored message near the size limit no longer fits with the batch header
+                logger.error(f"❌ History batch not sent to {client_id}: {e}")
+
+    def add_client(self, client_id, ip, port, name, codec="json", features=(), room=protocol.DEFAULT_ROOM):
+
+        # Register a client, cache its address tuple and start its idle timer
+        now = time.monotonic()
+        session = self.clients[client_id] = ClientSession(client_id, ip, port, name, codec, features, room, now)
+        self.client_addresses[client_id] = session.address
+        self.client_ids_by_address[session.address] = client_id
+        self.rooms.setdefault(room, {})[client_id] = session.address
+        session.wheel_slot = self.idle_wheel.schedule(client_id, now + self.client_idle_timeout)
+        if "reliable" in features:
+            self.channels[client_id] = ReliableChannel()
+
+    def remove_client(self, client_id):
+
+        # Forget a client and its cached address
+        address = self.client_addresses.pop(client_id, None)
+        if address is not None:
+            self.transport.forget(address)
+            self.client_ids_by_address.pop(address, None)
+        self.channels.pop(client_id, None)
+        self.busy_channels.discard(client_id)
+        self.coalescer.queues.pop(client_id, None)
+        self.client_buckets.pop(client_id, None)
+        self.slow_down_sent.pop(client_id, None)
+        info = self.clients.pop(client_id, None)
+        if info is not None:
+            self.leave_room_index(client_id, info.room)
+            self.idle_wheel.discard(client_id, info.wheel_slot)
+        return info
+
+    def end_session(self, client_id, event):
+
+        # Drop a client's session and tell its room ("left" or "timed_out")
+        info = self.remove_client(client_id)
+        self.replicate_membership("leave", client_id)
+        self.announce_presence(info.room, event, info.name)
+
+    def announce_presence(self, room, event, name, exclude=None):
+
+        # Tell a room a client joined or left. The first change in PRESENCE_INTERVAL goes
+        # out at once; those following it (a mass reconnect, a failover) wait for
+        # flush_presence, which sends them as one delta, so N joins cost a few broadcasts
+        # instead of N.
+        now = time.monotonic()
+        if room not in self.pending_presence and \
+                now - self.presence_sent.get(room, now - PRESENCE_INTERVAL) >= PRESENCE_INTERVAL:
+            self.presence_sent[room] = now
+            self.send_system_message(presence_delta(room, {event: [name]}), exclude=exclude, room=room)
+            return
+        self.pending_presence.setdefault(room, {}).setdefault(event, []).append((name, exclude))
+
+    def flush_presence(self):
+
+        # Send the held back joins and leaves, one delta per room (runs every PRESENCE_INTERVAL)
+        now = time.monotonic()
+        pending, self.pending_presence = self.pending_presence, {}
+        for room, changes in pending.items():
+            self.presence_sent[room] = now
+            delta = presence_delta(room, {event: [name for name, _ in entries] for event, entries in changes.items()})
+            logger.info(f"📢 #{room}: +{delta['joined']} joined, -{delta['left']} left")
+            # A lone joiner needs no news of itself
+            entries = [entry for entries in changes.values() for entry in entries]
+            self.send_system_message(delta, exclude=entries[0][1] if len(entries) == 1 else None, room=room)
+        for room, sent in list(self.presence_sent.items()):
+            if now - sent >= PRESENCE_INTERVAL:
+                del self.presence_sent[room]
+
+    def send_roster(self, client_id, page):
+
+        # One page of the names in the client's room, in name order. Pre-forked, the
+        # sibling workers' members are included; sharded, only this server's.
+        room = self.clients[client_id].room
+        names = [self.clients[member].name for member in self.rooms.get(room, ())]
+        names.extend(info.name for info in self.remote_clients.values() if info.room == room)
+        names.sort()
+        pages = max(1, (len(names) + ROSTER_PAGE - 1) // ROSTER_PAGE)
+        page = min(max(page, 0), pages - 1)
+        roster = {
+            "type": "roster",
+            "room": room,
+            "members": len(names),
+            "page": page,
+            "pages": pages,
+            "names": names[page * ROSTER_PAGE:(page + 1) * ROSTER_PAGE]
+        }
+        # Always JSON: a list of names has no binary layout
+        self.send_to_client(client_id, protocol.encode(roster))
+
+    def sweep_idle_clients(self):
+
+        # Evict the sessions of clients silent for client_idle_timeout seconds, so fan-out
+        # stops sending to them (runs every SWEEP_TICK). Followers leave the replicas of
+        # the leader's table alone; the leader evicts and replicates the leave.
+        if not (self.is_leader or self.sharded or self.worker_index != 0):
+            return
+        now = time.monotonic()
+        for client_id in self.idle_wheel.advance(now):
+            info = self.clients.get(client_id)
+            if info is None:
+                continue
+            deadline = info.last_seen + self.client_idle_timeout
+            if deadline > now:
+                # Heard from since it was filed: file it again under its new deadline
+                info.wheel_slot = self.idle_wheel.schedule(client_id, deadline)
+                continue
+            info.wheel_slot = None
+            logger.info(f"\n⌛ {info.name} timed out after {now - info.last_seen:.0f}s of silence.")
+            self.clients_evicted.inc()
+            self.end_session(client_id, "timed_out")
+
+    def move_client_to_room(self, client_id, room):
+
+        # Switch a client's room subscription, returning the room it left
+        info = self.clients[client_id]
+        old_room = info.room
+        self.leave_room_index(client_id, old_room)
+        info.room = room
+        self.rooms.setdefault(room, {})[client_id] = self.client_addresses[client_id]
+        return old_room
+
+    def leave_room_index(self, client_id, room):
+
+        members = self.rooms.get(room)
+        if members is not None:
+            members.pop(client_id, None)
+            if not members:
+                del self.rooms[room]
+
+    def switch_room(self, client_id, room):
+
+        # Leader: move a client to another room, confirm it and tell both rooms
+        info = self.clients[client_id]
+        if room == info.room:
+            return
+        old_room = self.move_client_to_room(client_id, room)
+        self.replicate_membership("room", client_id)
+        logger.info(f"🚪 {info.name} moved from #{old_room} to #{room}")
+
+        log = self.room_log(room)
+        confirmation = {
+            "type": "room",
+            "room": room,
+            "members": len(self.rooms[room]),
+            "log_seq": log.next_seq - 1 if log is not None else 0
+        }
+        self.send_to_client(client_id, protocol.encode(confirmation, info.codec))
+        self.send_system_message({
+            "type": "notice",
+            "text": f"{info.name} has left #{old_room}."
+        }, room=old_room)
+        self.send_system_message({
+            "type": "notice",
+            "text": f"{info.name} has joined #{room}."
+        }, exclude=client_id, room=room)
+
+    def flush_reliable_channels(self):
+
+        # Send coalesced ACKs and due retransmissions (runs every ACK_INTERVAL)
+        now = time.monotonic()
+        datagrams = []
+        for client_id in list(self.busy_channels):
+            channel = self.channels.get(client_id)
+            if channel is None:
+                self.busy_channels.discard(client_id)
+                continue
+            address = self.client_addresses[client_id]
+            outgoing, delivered = channel.poll(now)
+            datagrams.extend((datagram, address) for datagram in outgoing)
+            for payload in delivered:
+                self.receive_client_payload(payload, address)
+            if not channel.busy:
+                self.busy_channels.discard(client_id)
+        for address in list(self.busy_peers):
+            channel = self.peer_channels.get(address)
+            if channel is None:
+                self.busy_peers.discard(address)
+                continue
+            outgoing, delivered = channel.poll(now)
+            datagrams.extend((datagram, address) for datagram in outgoing)
+            for payload in delivered:
+                self.receive_client_payload(payload, address)
+            if not channel.busy:
+                self.busy_peers.discard(address)
+        if datagrams:
+            for index, e in self.transport.send_many(datagrams):
+                logger.error(f"❌ Send error to {datagrams[index][1]}: {e}")
+
+    def follower_addresses(self):
+
+        # Server ports of every other known server
+        return [(info["ip"], info["port"]) for server_id, info in self.servers.items()
+                if server_id != self.id]
+
+    def is_server_address(self, address):
+
+        # Whether a datagram came from a known server: peer-only frames are ignored otherwise
+        return address in self.servers.ids_by_address
+
+    def is_leader_address(self, address):
+
+        # Whether a datagram came from the server we know as leader
+        return self.servers.ids_by_address.get(address) in self.servers.leaders
+
+    def client_info(self, client_id):
+
+        # Entry of a client served by this process or, pre-forked, by a sibling worker
+        return self.clients.get(client_id) or self.remote_clients.get(client_id)
+
+    def client_record(self, client_id):
+
+        # Compact replicated form of a client entry
+        return self.client_info(client_id).record()
+
+    def send_to_servers(self, message, addresses):
+
+        # JSON frame (fragmented if needed) to other servers' ports
+        fragments = self.fragmenter.split(protocol.encode(message))
+        datagrams = [(fragment, address) for address in addresses for fragment in fragments]
+        for index, e in self.transport.send_many(datagrams):
+            logger.error(f"❌ Replication send error to {datagrams[index][1]}: {e}")
+
+    def replicate_membership(self, op, client_id):
+
+        # Share one membership change ("join", "leave" or "room") with the sibling workers
+        # and the follower servers
+        if self.worker_count > 1:
+            self.send_to_workers({
+                "type": "worker_member",
+                "op": op,
+                "id": client_id,
+                "worker": self.worker_index,
+                "record": self.client_record(client_id) if op != "leave" else None
+            })
+        self.replicate_to_followers(op, client_id)
+
+    def replicate_to_followers(self, op, client_id):
+
+        # Leader: stream one membership delta to the followers. Only the primary worker
+        # talks to other servers, and sharded servers each keep their own part of the
+        # client table instead.
+        if self.sharded or self.worker_index != 0:
+            return
+        self.membership_version += 1
+        delta = {
+            "type": "replica_delta",
+            "version": self.membership_version,
+            "op": op,
+            "id": client_id
+        }
+        if op == "join":
+            delta["record"] = self.client_record(client_id)
+        elif op == "room":
+            delta["room"] = self.client_info(client_id).room
+        self.send_to_servers(delta, self.follower_addresses())
+
+    def send_replica_snapshot(self, addresses=None):
+
+        # Leader: full client table in pages, so followers can repair missed deltas (runs every 5 seconds)
+        if not self.is_leader or self.sharded:
+            return
+        addresses = self.follower_addresses() if addresses is None else addresses
+        if not addresses:
+            return
+        records = [self.client_record(client_id)
+                   for client_id in list(self.clients) + list(self.remote_clients)]
+        page_size = 100
+        count = max(1, (len(records) + page_size - 1) // page_size)
+        for page in range(count):
+            snapshot = {
+                "type": "replica_snapshot",
+                "version": self.membership_version,
+                "page": page,
+                "count": count,
+                "records": records[page * page_size:(page + 1) * page_size]
+            }
+            self.send_to_servers(snapshot, addresses)
+
+    def apply_replica_delta(self, data, address):
+
+        # Follower: apply deltas in version order, ask for a snapshot on a gap
+        version = data["version"]
+        if version <= self.membership_version:
+            return
+        if version != self.membership_version + 1:
+            logger.warning(f"Replication gap ({self.membership_version} -> {version}), requesting snapshot")
+            self.server_socket.sendto(json.dumps({"type": "replica_sync"}).encode(), address)
+            return
+        if data["op"] == "join":
+            self.remove_client(data["id"])
+            self.add_client(*data["record"])
+        elif data["op"] == "leave":
+            self.remove_client(data["id"])
+        elif data["op"] == "room" and data["id"] in self.clients:
+            self.move_client_to_room(data["id"], data["room"])
+        self.membership_version = version
+
+    def apply_replica_snapshot(self, data):
+
+        # Follower: collect all pages of one snapshot version, then replace the client table
+        version = data["version"]
+        if version < self.membership_version:
+            return
+        pending = self.pending_snapshot
+        if pending is None or pending["version"] != version or pending["count"] != data["count"]:
+            pending = self.pending_snapshot = {"version": version, "count": data["count"], "pages": {}}
+        pending["pages"][data["page"]] = data["records"]
+        if len(pending["pages"]) < pending["count"]:
+            return
+
+        self.pending_snapshot = None
+        records = [record for page in sorted(pending["pages"]) for record in pending["pages"][page]]
+        replicated_ids = {record[0] for record in records}
+        for client_id in list(self.clients):
+            if client_id not in replicated_ids:
+                self.remove_client(client_id)
+        for record in records:
+            client_id, name, room = record[0], record[3], record[6]
+            if client_id not in self.clients:
+                self.add_client(*record)
+            else:
+                self.clients[client_id].name = name
+                if self.clients[client_id].room != room:
+                    self.move_client_to_room(client_id, room)
+        self.membership_version = version
+
+    def send_to_workers(self, message):
+
+        # JSON control frame to every sibling worker process
+        payload = json.dumps(message, ensure_ascii=False).encode()
+        for index, address in enumerate(self.worker_addresses):
+            if index != self.worker_index and address is not None:
+                try:
+                    self.control_socket.sendto(payload, address)
+                except Exception as e:
+                    logger.error(f"❌ Control send error to worker {index}: {e}")
+
+    def apply_worker_member(self, data):
+
+        # A sibling worker registered, dropped or moved one of its clients
+        client_id = data["id"]
+        if data["op"] == "join":
+            # Also sent when a worker takes over a client the kernel now routes to it
+            client_id, ip, port, name, codec, features, room = data["record"]
+            self.remove_client(client_id)
+            self.forget_remote_client(client_id)
+            self.remote_clients[client_id] = ClientSession(client_id, ip, port, name, codec, features, room,
+                                                           worker=data["worker"])
+            self.remote_ids_by_address[(ip, port)] = client_id
+        elif data["op"] == "leave":
+            self.forget_remote_client(client_id)
+        elif data["op"] == "room" and client_id in self.remote_clients:
+            self.remote_clients[client_id].room = data["record"][6]
+        self.replicate_to_followers(data["op"], client_id)
+
+    def forget_remote_client(self, client_id):
+
+        info = self.remote_clients.pop(client_id, None)
+        if info is not None:
+            self.remote_ids_by_address.pop(info.address, None)
+
+    def adopt_client(self, client_id):
+
+        # The kernel now routes this client to us (a worker exited or the socket set
+        # changed): take over its session from the sibling that had it
+        info = self.remote_clients[client_id]
+        self.forget_remote_client(client_id)
+        self.add_client(client_id, info.ip, info.port, info.name, info.codec, info.features, info.room)
+        self.replicate_membership("join", client_id)
+        logger.info(f"🔀 Worker {self.worker_index} took over {info.name}")
+
+    def handle_control_datagram(self, message, address):
+
+        # Frames from sibling workers: forwarded server traffic, membership and room relays
+        self.datagrams_received.inc("control")
+        if workers.is_forwarded(message):
+            datagram, sender = workers.unpack_forward(message)
+            self.handle_client_datagram(datagram, sender)
+            return
+        data = json.loads(message.decode())
+        if data["type"] == "worker_member":
+            self.apply_worker_member(data)
+        elif data["type"] == "worker_relay":
+            relayed = data["message"]
+            if relayed["type"] == "message":
+                self.deliver_to_room(relayed)
+            else:
+                self.broadcast_frame(relayed, room=data["room"])
+            self.relay_beyond_process(relayed, data["room"], from_worker=True)
+
+    def next_client_name(self):
+
+        # Pre-forked workers number clients from one shared counter
+        if self.client_counter is None:
+            return f"Client {len(self.clients) + 1}"
+        with self.client_counter.get_lock():
+            self.client_counter.value += 1
+            return f"Client {self.client_counter.value}"
+
+    def announce_failover_to_clients(self):
+
+        # New leader: point every replicated client at this server so nobody has to re-join
+        if not self.clients or self.sharded:
+            return
+        failover = {
+            "type": "failover",
+            "id": self.id,
+            "port": self.port
+        }
+        logger.info(f"🔁 Taking over {len(self.clients)} replicated client sessions")
+        self.broadcast_frame(failover, plain=True)
+
+    def display_client_list(self):
+
+        # One line per client: only at debug level
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.remote_clients:
+            logger.debug(f"👥 {len(self.remote_clients)} more clients on other workers")
+        if not self.clients:
+            logger.debug("👥 No clients connected")
+            return
+            
+        logger.debug(f"\n👥 Connected Clients ({len(self.clients)}):")
+        logger.debug("─" * 50)
+        for i, (client_id, info) in enumerate(self.clients.items(), 1):
+            logger.debug(f"  {i}. {info.name} ({info.ip}:{info.port}) #{info.room}")
+        logger.debug("─" * 50)
+
+    def display_server_status(self):
+
+        logger.info(f"\n🖥️  Server Status:")
+        logger.info("─" * 50)
+        logger.info(f"  Server ID: {self.id}")
+        logger.info(f"  Leader: {'✅ Yes' if self.is_leader else '❌ No'}")
+        logger.info(f"  Connected Clients: {len(self.clients) + len(self.remote_clients)}")
+        if self.worker_count > 1:
+            logger.info(f"  Workers: {self.worker_count}")
+        logger.info(f"  Rooms: {len(self.rooms)}")
+        logger.info(f"  Known Servers: {len(self.servers)}")
+        logger.info("─" * 50)
+
+    def schedule_periodic(self, interval, callback, immediate=False):
+
+        # Run callback every interval seconds on the active engine.
+        # Returning False from the callback stops the timer.
+        if self.loop is not None:
+            def tick():
+                if callback() is not False:
+                    self.loop.call_later(interval, tick)
+            self.loop.call_later(0 if immediate else interval, tick)
+            return
+
+        def run():
+            if not immediate:
+                time.sleep(interval)
+            while True:
+                with self.lock:
+                    keep_running = callback()
+                if keep_running is False:
+                    return
+                time.sleep(interval)
+        threading.Thread(target=run, daemon=True).start()
+
+    def become_leader(self):
+
+        # Take over leadership; our heartbeats now carry the leader flag
+        self.is_leader = True
+        self.pending_snapshot = None
+        # Replicated sessions were never heard from here: give each client a full
+        # timeout to reach the new leader
+        now = time.monotonic()
+        for info in self.clients.values():
+            info.last_seen = now
+        self.multicast_server_leader()
+        self.voted = True
+        self.announce_failover_to_clients()
+
+    def initiate_server_leader_election(self):
+
+        # Start leader election: term mode stands as candidate once it could have heard
+        # a leader's heartbeat, plus up to ELECTION_JITTER seconds so that servers
+        # noticing at the same moment rarely collide
+        if self.election_mode == "term":
+            if self.election.state == "follower" and self.election.leader_id is None:
+                self.election.wait_for_leader(time.time(), timeout=2 * HEARTBEAT_INTERVAL)
+            return
+        logger.info(f"Server {self.id} starting leader election...")
+        self.election_events.inc("ring_election")
+        self.forward_server_token(self.id)
+
+    def election_peers(self):
+
+        return [server_id for server_id in self.servers.ring if server_id != self.id]
+
+    def check_election_timer(self):
+
+        # Term mode: stand as candidate once the leader or our last round timed out
+        # (runs every ELECTION_TICK seconds)
+        now = time.time()
+        if not self.election.due(now):
+            return
+        logger.info(f"🗳️  Server {self.id} standing for election in term {self.election.term + 1}")
+        self.election_events.inc("candidate")
+        self.send_vote_requests(self.election.stand(now, self.election_peers()))
+        self.follow_election_outcome()
+
+    def send_vote_requests(self, requests):
+
+        for peer_id, request in requests:
+            info = self.servers.get(peer_id)
+            if info is not None:
+                self.server_socket.sendto(json.dumps(request).encode(), (info["ip"], info["port"]))
+
+    def follow_election_outcome(self):
+
+        # Term mode: take over or give up leadership after the election state changed
+        if self.election.state == "leader" and not self.is_leader:
+            logger.info(f"🎉 I was elected as leader in term {self.election.term}!")
+            self.election_events.inc("elected")
+            self.become_leader()
+        elif self.election.state != "leader" and self.is_leader:
+            logger.info(f"⬇️  Stepping down: term {self.election.term} has another leader")
+            self.election_events.inc("stepped_down")
+            self.is_leader = False
+
+    def accept_leader(self, leader_id, data):
+
+        # Whether a leader announcement or heartbeat is current; term mode ignores older terms
+        if self.election_mode != "term":
+            return True
+        if not valid_term(data.get("term", 0)):
+            return False
+        accepted = self.election.on_leader(data.get("term", 0), leader_id, time.time(),
+                                           self.failure_detector.timeout(leader_id))
+        self.follow_election_outcome()
+        if accepted and leader_id != self.id:
+            if leader_id in self.servers:
+                self.servers.set_leader(leader_id)
+        return accepted
+
+    def observe_server(self, server_id, ip, port, is_leader=None, beat=False):
+
+        # Record a message from another server; heartbeats also train its failure detector,
+        # which sets when the registry expires it (servers without heartbeats: 20 seconds)
+        now = time.time()
+        if beat:
+            interval = self.failure_detector.heartbeat(server_id, now)
+            if interval is not None:
+                self.heartbeat_lag.observe(max(interval - HEARTBEAT_INTERVAL, 0.0))
+        return self.servers.upsert(server_id, ip, port, is_leader, now=now,
+                                   deadline=self.failure_detector.deadline(server_id))
+
+    def remove_dead_server_nodes(self):
+
+        # Remove servers the failure detector suspects (runs every heartbeat interval);
+        # the registry's deadline heap yields only the expired ones
+        for server_id in self.servers.expired():
+            if server_id == self.id:
+                continue
+            info = self.servers.remove(server_id)
+            self.failure_detector.remove(server_id)
+            logger.warning(f"❌ Removing dead server {server_id} ({info['ip']}:{info['port']}) from servers.")
+            self.election_events.inc("server_removed")
+            address = (info["ip"], info["port"])
+            self.peer_channels.pop(address, None)
+            self.busy_peers.discard(address)
+
+    def display_status(self):
+
+        # Display current status (runs every 5 seconds)
+        self.display_server_status()
+        self.display_client_list()
+
+    def forward_server_token(self, token_id):
+
+        # Forward the election token to the next server in ring order
+        if self.id not in self.servers:
+            return
+
+        logger.debug(f"Forwarding token {token_id}. Known servers: {len(self.servers)}")
+
+        # Check whether a leader already exists
+        existing_leader = self.servers.leader(exclude=self.id)
+        if existing_leader:
+            logger.info(f"Leader already exists: {existing_leader['id']}. Not becoming leader.")
+            return
+
+        # If only one server in the ring, become leader immediately
+        if len(self.servers) == 1:
+            logger.info("Only one server in the ring. I will become leader.")
+            self.become_leader()
+            return
+        # Otherwise forward token to next server, dropping unreachable ones
+        while True:
+            next_id = self.servers.successor(self.id)
+            if next_id == self.id:
+                # Only this server remaining
+                logger.info("No other reachable server. I will become leader.")
+                self.become_leader()
+                return
+            next_server = self.servers[next_id]
+            next_address = (next_server["ip"], next_server["port"])
+            try:
+                election_msg = {
+                    "type": "election",
+                    "token": token_id
+                }
+                self.server_socket.sendto(json.dumps(
+                    election_msg).encode(), next_address)
+                logger.debug(f"Election token forwarded to {next_id}")
+                return
+            except Exception as e:
+                logger.warning(f"Removing unreachable server {next_id}: {e}")
+                self.servers.remove(next_id)
+
+    def multicast_server_discovery(self):
+
+        # Regular multicast messages for server discovery (runs every 5 seconds)
+        msg = {
+            "type": "discover",
+            "id": self.id,
+            "port": self.port,
+            "isLeader": self.is_leader,
+            "term": self.election.term
+        }
+        if self.sharded and self.is_leader:
+            msg["shards"] = self.live_shards()
+        self.discovery_socket.sendto(json.dumps(
+            msg).encode(), (self.multicast_group, self.discovery_port))
+
+    def multicast_server_heartbeat(self):
+
+        # Every server multicasts sub-second heartbeats for the failure detectors of the
+        # others; the leader's also keep its followers and clients (runs every HEARTBEAT_INTERVAL)
+        msg = {
+            "type": "heartbeat",
+            "id": self.id,
+            "port": self.port,
+            "isLeader": self.is_leader,
+            "term": self.election.term
+        }
+        if self.sharded and self.is_leader:
+            msg["shards"] = self.live_shards()
+        self.discovery_socket.sendto(json.dumps(
+            msg).encode(), (self.multicast_group, self.discovery_port))
+
+    def live_shards(self):
+
+        # Servers currently owning clients, so clients of a vanished one can re-join
+        if self.id in self.servers:
+            return list(self.servers.ring)
+        return sorted(self.servers.ring + [self.id])
+
+    def monitor_server_heartbeat(self):
+
+        # Check if heartbeat from leader is still being received (runs every second)
+        # Only initiate election if we're not the leader and the leader went silent for
+        # longer than its failure detector allows
+        if not self.is_leader and (time.time() - self.last_heartbeat > self.leader_timeout):
+            logger.warning(f"Leader unresponsive for {time.time() - self.last_heartbeat:.1f}s. Initiating leader election.")
+            self.initiate_server_leader_election()
+
+    def listen_on_discovery_port(self):
+        # Receiving Discovery, Heartbeat or Leader messages
+        while True:
+            message, address = self.discovery_socket.recvfrom(RECV_BUFFER_SIZE)
+            with self.lock:
+                self.handle_discovery_datagram(message, address)
+
+    def handle_discovery_datagram(self, message, address):
+
+        # Process one Discovery, Heartbeat or Leader message
+        started = time.perf_counter()
+        data = json.loads(message.decode())
+        self.parse_seconds.observe(time.perf_counter() - started, data["type"])
+        self.datagrams_received.inc("discovery")
+        server_id = data['id']
+        server_ip = address[0]
+        server_port = data['port']
+
+        if data["type"] == "discover":
+            # Known servers are matched by id or, if it changed, by IP:Port
+            is_leader = data['isLeader']
+            if is_leader and server_id != self.id:
+                is_leader = self.accept_leader(server_id, data)
+            info, is_new = self.observe_server(server_id, server_ip, server_port, is_leader)
+            if not is_new:
+                logger.debug(f"Updated existing server: {server_ip}:{server_port}")
+
+                # If it is a leader, also update self.last_heartbeat
+                if is_leader and server_id != self.id:
+                    self.last_heartbeat = time.time()
+                    logger.debug(f"Leader discovery received from {server_ip}:{server_port}")
+            else:
+                logger.info(f"Discovered new server: {server_ip}:{server_port}")
+                # Only start new leader election if no leader exists
+                if not self.is_leader and not self.servers.leader():
+                    logger.info("New server discovered and no leader exists. Initiating leader election...")
+                    self.initiate_server_leader_election()
+
+        # Leader message
+        elif data["type"] == "leader":
+            # Leader was announced
+            leader_id = server_id
+            if not self.accept_leader(leader_id, data):
+                logger.debug(f"Ignoring leader {leader_id} from stale term {data.get('term', 0)}.")
+                return
+            self.is_leader = (leader_id == self.id)
+            self.voted = False
+            logger.info(f"Server {leader_id} has been elected as leader.")
+            self.election_events.inc("leader_announced")
+
+            if leader_id not in self.servers:
+                self.observe_server(leader_id, address[0], data["port"])
+            self.servers.set_leader(leader_id)
+
+        # Heartbeat message
+        elif data["type"] == "heartbeat":
+            if server_id != self.id:
+                # Update heartbeat time for this server
+                self.observe_server(server_id, server_ip, server_port, beat=True)
+                # The leader's heartbeats also confirm its leadership
+                if data.get("isLeader", True):
+                    if not self.accept_leader(server_id, data):
+                        logger.debug(f"Ignoring heartbeat of {server_id} from stale term {data.get('term', 0)}.")
+                        return
+                    self.last_heartbeat = time.time()
+                    self.leader_timeout = self.failure_detector.timeout(server_id)
+
+    def listen_on_server_client_port(self):
+
+        # Receive messages from clients or election tokens
+        while True:
+            try:
+                message, address = self.server_socket.recvfrom(RECV_BUFFER_SIZE)
+                with self.lock:
+                    self.handle_client_datagram(message, address)
+            except Exception as e:
+                logger.error(f"❌ Server error: {e}")
+
+    def redirect_target(self):
+
+        # Leader that clients reaching this server should talk to instead, if it is alive
+        if self.is_leader or self.sharded:
+            return None
+        leader = self.servers.leader(exclude=self.id)
+        if leader is None or self.failure_detector.suspected(leader["id"], time.time()):
+            return None
+        return leader
+
+    def send_redirect(self, address, leader):
+
+        # Tell a client where the leader is; always plain JSON like the welcome
+        redirect = {
+            "type": "redirect",
+            "id": leader["id"],
+            "ip": leader["ip"],
+            "port": leader["port"]
+        }
+        self.server_socket.sendto(json.dumps(redirect).encode(), address)
+
+    def handle_client_datagram(self, message, address):
+
+        # A follower answers stray client datagrams (a stale leader address, a probe)
+        # with the leader's address instead of serving them
+        self.datagrams_received.inc("client")
+        if address not in self.servers.ids_by_address:
+            leader = self.redirect_target()
+            if leader is not None:
+                self.send_redirect(address, leader)
+                return
+
+        # Pre-forked: a client of a sibling worker arriving here is taken over; other
+        # unknown senders are servers (or fragments of their frames) and go to the primary
+        if self.worker_count > 1 and address not in self.client_ids_by_address:
+            remote_id = self.remote_ids_by_address.get(address)
+            if remote_id is not None:
+                self.adopt_client(remote_id)
+            elif self.worker_index != 0 and not self.is_join(message):
+                self.control_socket.sendto(workers.pack_forward(message, address),
+                                           self.worker_addresses[0])
+                return
+
+        # Any datagram from a client keeps its session alive
+        session = self.clients.get(self.client_ids_by_address.get(address))
+        if session is not None:
+            session.last_seen = time.monotonic()
+
+        # Reliable frames go through the channel of the client (or, sharded, the peer
+        # server) sending from this address
+        if is_reliable_frame(message):
+            client_id = self.client_ids_by_address.get(address)
+            channel = self.channels.get(client_id)
+            if channel is not None:
+                payloads = channel.on_datagram(message)
+                self.busy_channels.add(client_id)
+            elif self.sharded and address in self.follower_addresses():
+                channel = self.peer_channels.get(address)
+                if channel is None:
+                    channel = self.peer_channels[address] = ReliableChannel()
+                payloads = channel.on_datagram(message)
+                self.busy_peers.add(address)
+            else:
+                return
+        else:
+            payloads = [message]
+        for payload in payloads:
+            self.receive_client_payload(payload, address)
+
+    def is_join(self, message):
+
+        # Joins are always plain JSON, so a worker can tell them from server traffic
+        if not message.startswith(b"{"):
+            return False
+        try:
+            return json.loads(message.decode()).get("type") == "join"
+        except ValueError:
+            return False
+
+    def listen_on_control_port(self):
+
+        # Receive frames from the sibling worker processes
+        while True:
+            try:
+                message, address = self.control_socket.recvfrom(RECV_BUFFER_SIZE)
+                with self.lock:
+                    self.handle_control_datagram(message, address)
+            except Exception as e:
+                logger.error(f"❌ Worker control error: {e}")
+
+    def receive_client_payload(self, payload, address):
+
+        # Process one client message or election token, once all its fragments arrived
+        started = time.perf_counter()
+        payload = self.reassembler.feed(payload, address)
+        if payload is None:
+            return
+        data = protocol.decode(payload)
+        self.parse_seconds.observe(time.perf_counter() - started, data["type"])
+
+        if data["type"] == "join":
+            # Client wants to join; an id binary frames cannot carry would break the fan-out
+            client_id = data["id"]
+            if not protocol.valid_client_id(client_id):
+                return
+            if self.sharded and self.client_info(client_id) is None:
+                owner = self.shard_owner(client_id)
+                if owner != self.id and owner in self.servers:
+                    # Hand the join to the server owning this client; it welcomes the client itself
+                    data["type"] = "shard_join"
+                    data["ip"] = address[0]
+                    data["name"] = f"Client {self.next_client_number}"
+                    self.next_client_number += 1
+                    owner_info = self.servers[owner]
+                    self.send_to_servers(data, [(owner_info["ip"], owner_info["port"])])
+                    logger.debug(f"➡️  {data['name']} routed to shard {owner}")
+                    return
+            name = None
+            if self.sharded:
+                name = f"Client {self.next_client_number}"
+                self.next_client_number += 1
+            self.accept_client(data, address[0], name)
+
+        elif data["type"] == "probe":
+            # A reconnecting client looks for the leader: that is us, or nobody we know yet
+            if self.is_leader:
+                self.send_redirect(address, {"id": self.id, "ip": self.ip, "port": self.port})
+
+        elif data["type"] == "shard_join":
+            # The leader routed a join to this server, the client's owner on the hash ring
+            if self.sharded and self.is_server_address(address):
+                self.accept_client(data, data["ip"], data["name"])
+
+        elif data["type"] == "shard_relay":
+            # A room frame from a client of another shard: deliver it to our members of the room
+            if self.sharded and self.is_server_address(address):
+                message = data["message"]
+                if message["type"] == "message":
+                    self.deliver_to_room(message)
+                else:
+                    self.broadcast_frame(message, room=data["room"])
+                self.relay_beyond_process(message, data["room"], from_peer=True)
+
+        elif data["type"] == "message":
+            # Message received from client; one too large to relay once the server's
+            # fields are added is dropped before it is logged
+            sender_id = data["id"]
+            if sender_id not in self.clients or len(payload) > MAX_MESSAGE_SIZE - RELAY_HEADER_ALLOWANCE:
+                return
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"\n💬 Message from {self.clients[sender_id].name}: {data['text']}")
+            self.relay_client_message(data, sender_id)
+
+        elif data["type"] == "leave":
+            # Client has left the chat
+            client_id = data["id"]
+            if client_id in self.clients:
+                logger.info(f"\n👋 {self.clients[client_id].name} has left the chat.")
+                self.end_session(client_id, "left")
+
+        elif data["type"] == "keepalive":
+            # Every datagram from a client refreshes its session, so there is nothing left
+            # to do, unless the session is gone (evicted while the client was suspended):
+            # then the client is told to join again
+            if data["id"] not in self.clients:
+                self.server_socket.sendto(json.dumps({"type": "expired"}).encode(), address)
+
+        elif data["type"] == "join_room":
+            # Client switches to another (possibly new) room
+            if data["id"] in self.clients and protocol.valid_room(data["room"]):
+                self.switch_room(data["id"], data["room"])
+
+        elif data["type"] == "leave_room":
+            # Client leaves its room and goes back to the default one
+            if data["id"] in self.clients:
+                self.switch_room(data["id"], protocol.DEFAULT_ROOM)
+
+        elif data["type"] == "history_request":
+            # A client asks for stored messages: {"last": K} or {"since": S}, both counts
+            last, since = data.get("last", 0), data.get("since", 0)
+            if self.log_dir is not None and data["id"] in self.clients \
+                    and all(isinstance(value, int) and value >= 0 for value in (last, since)):
+                self.replay_history(data["id"], min(last, MAX_REPLAY), since)
+
+        elif data["type"] == "roster_request":
+            # A client asks who is in its room, one page at a time
+            if data["id"] in self.clients and isinstance(data.get("page", 0), int):
+                self.send_roster(data["id"], data.get("page", 0))
+
+        elif data["type"] == "replica_delta":
+            # Membership change streamed by the leader
+            if not self.is_leader and self.is_leader_address(address):
+                self.apply_replica_delta(data, address)
+
+        elif data["type"] == "replica_snapshot":
+            # Periodic full client table from the leader
+            if not self.is_leader and self.is_leader_address(address):
+                self.apply_replica_snapshot(data)
+
+        elif data["type"] == "replica_sync":
+            # A follower missed deltas and asks for a fresh snapshot
+            if self.is_leader and self.is_server_address(address):
+                self.send_replica_snapshot([address])
+
+        elif data["type"] == "vote_request":
+            # Term mode: a candidate asks for our (pre-)vote in its term
+            if not self.is_server_address(address) or not valid_term(data.get("term")):
+                return
+            reply = self.election.on_vote_request(data, time.time())
+            self.follow_election_outcome()
+            self.server_socket.sendto(json.dumps(reply).encode(), address)
+
+        elif data["type"] == "vote":
+            # Term mode: reply to our own (pre-)vote request
+            if not self.is_server_address(address) or not valid_term(data.get("term")) \
+                    or not valid_term(data.get("current_term", 0)):
+                return
+            self.send_vote_requests(self.election.on_vote(data, time.time(), self.election_peers()))
+            self.follow_election_outcome()
+
+        elif data["type"] == "election":
+            # Election token received and processed
+            token_id = data["token"]
+            if not self.voted:
+                if token_id > self.id:
+                    self.forward_server_token(token_id)
+                    self.voted = True
+                elif token_id < self.id:
+                    self.forward_server_token(self.id)
+                    self.voted = True
+                elif token_id == self.id:
+                    logger.info("🎉 I was elected as leader!")
+                    self.become_leader()
+            else:
+                # Already voted, no re-broadcast/thread-start
+                pass
+
+    def accept_client(self, data, client_ip, name=None):
+
+        # Register a joining client and send its welcome. A client that joins again
+        # (after a leader change) gets a fresh session with the same name and room, and so
+        # does one presenting a resume token to a server that does not know it.
+        client_id = data["id"]
+        client_port = data["port"]
+        # Old clients offer no codecs or features and stay on plain JSON
+        codec = protocol.negotiate_codec(data.get("codecs"), self.codecs)
+        features = protocol.negotiate_features(data.get("features"), self.features)
+        previous = self.remove_client(client_id) or self.remote_clients.get(client_id)
+        self.forget_remote_client(client_id)
+        resumed_name = None
+        if previous is None and data.get("resume"):
+            resumed_name = read_resume_token(self.resume_secret, client_id, data["resume"], time.time())
+        if previous is not None:
+            name, room = previous.name, previous.room
+        elif resumed_name is not None:
+            name = resumed_name
+            room = data.get("room") if protocol.valid_room(data.get("room")) else protocol.DEFAULT_ROOM
+            logger.info(f"\n🔄 {name} resumed its session from {client_ip}:{client_port}")
+        else:
+            name = name or self.next_client_name()
+            room = protocol.DEFAULT_ROOM
+        self.add_client(client_id, client_ip, client_port, name, codec, features, room)
+        self.replicate_membership("join", client_id)
+        if previous is None and resumed_name is None:
+            logger.info(f"\n✅ {name} connected from {client_ip}:{client_port}")
+
+        # Reply to client with their name and what was negotiated (always as plain JSON)
+        welcome = {
+            "type": "welcome",
+            "name": name,
+            "codec": codec,
+            "features": features,
+            "room": room,
+            "resume": make_resume_token(self.resume_secret, client_id, name, time.time())
+        }
+        if self.sharded:
+            # Tells the client this server (the sender of the welcome) is now its own
+            welcome["owner"] = self.id
+        log = self.room_log(room)
+        # A returning client says up to which sequence number it has the room's messages:
+        # the rest are replayed right away, saving it a history request
+        last_seq = data.get("last_seq") if previous is not None or resumed_name is not None else None
+        replay = log is not None and isinstance(last_seq, int) and 0 < last_seq < log.next_seq - 1
+        if log is not None:
+            # Latest stored sequence number, so the client knows history is available
+            welcome["log_seq"] = log.next_seq - 1
+            welcome["replaying"] = replay
+        self.server_socket.sendto(json.dumps(
+            welcome).encode(), (client_ip, client_port))
+        if replay:
+            self.replay_history(client_id, since=last_seq + 1)
+
+        if previous is None and resumed_name is None:
+            # Notify other clients about join
+            self.announce_presence(room, "joined", name, exclude=client_id)
+
+    def print_startup_banner(self):
+
+        logger.info("🚀 Starting Distributed Chat Server...")
+        logger.info("=" * 60)
+        logger.info(f"🖥️  Server ID: {self.id}")
+        logger.info(f"⚙️  Engine: {self.engine}, transport: {self.transport.name}")
+        if self.worker_count > 1:
+            logger.info(f"🧵 {self.worker_count} worker processes share port {self.port} (SO_REUSEPORT)")
+        if self.sharded:
+            logger.info("🧩 Sharded mode: clients are spread across all live servers")
+        logger.info(f"🌐 Server running on port {self.port}")
+        logger.info(f"🔍 Listening for discovery messages on port {self.discovery_port}")
+        logger.info(f"📡 Multicast group: {self.multicast_group}")
+        logger.info("=" * 60)
+
+    def start_periodic_tasks(self):
+
+        # Timers shared by both engines
+        if self.election_mode == "term":
+            self.schedule_periodic(ELECTION_TICK, self.check_election_timer)
+        else:
+            self.schedule_periodic(1, self.monitor_server_heartbeat)
+        self.schedule_periodic(5, self.multicast_server_discovery, immediate=True)
+        self.schedule_periodic(HEARTBEAT_INTERVAL, self.multicast_server_heartbeat, immediate=True)
+        self.schedule_periodic(HEARTBEAT_INTERVAL, self.remove_dead_server_nodes)
+        self.schedule_periodic(5, self.display_status)
+        self.schedule_periodic(5, self.send_replica_snapshot)
+        self.schedule_periodic(ACK_INTERVAL, self.flush_reliable_channels)
+        self.schedule_periodic(SWEEP_TICK, self.sweep_idle_clients)
+        self.schedule_periodic(PRESENCE_INTERVAL, self.flush_presence)
+        if self.batch_delay:
+            self.schedule_periodic(self.batch_delay, self.flush_batches)
+        if self.relay_budget is not None:
+            self.schedule_periodic(RELAY_TICK, self.drain_relay_queue)
+        if self.worker_processes:
+            self.schedule_periodic(1, self.check_workers)
+
+    def check_leader_at_startup(self):
+
+        # Check if leader election is needed at startup
+        leader = self.servers.leader()
+        if not self.is_leader and leader is None:
+            logger.info("No leader found at startup. Initiating leader election...")
+            self.initiate_server_leader_election()
+        elif leader is not None:
+            logger.info(f"Leader already exists: {leader['id']}")
+
+        # Display server status and client list
+        logger.info("\n✅ Server system started successfully!")
+        logger.info("📊 Initial status:")
+        self.display_server_status()
+        self.display_client_list()
+
+    def start_workers(self):
+
+        # Pre-fork the other workers before any thread or event loop exists. Each binds
+        # its own SO_REUSEPORT socket on the client port, so the kernel spreads clients
+        # (by source address) across the processes.
+        context = multiprocessing.get_context("fork")
+        self.client_counter = context.Value("i", 0)
+        control_sockets = workers.create_control_sockets(self.worker_count)
+        self.worker_addresses = [sock.getsockname() for sock in control_sockets]
+        # One log per worker: "." cannot appear in room names, so no room directory clashes
+        base_dir = self.log_dir
+        if base_dir is not None:
+            self.log_dir = os.path.join(base_dir, "worker.0")
+        for index in range(1, self.worker_count):
+            process = context.Process(target=self.run_worker, args=(index, control_sockets, base_dir),
+                                      daemon=True)
+            process.start()
+            self.worker_processes[index] = process
+        for sock in control_sockets[1:]:
+            sock.close()
+        self.control_socket = control_sockets[0]
+
+    def run_worker(self, index, control_sockets, base_dir):
+
+        # Entry point of a forked worker: serve clients on the shared port, nothing else
+        random.seed()  # forked children would otherwise pick the same stream and fragment ids
+        self.worker_index = index
+        for position, sock in enumerate(control_sockets):
+            if position != index:
+                sock.close()
+        self.control_socket = control_sockets[index]
+        self.discovery_socket.close()
+        self.server_socket.close()
+        self.server_socket = workers.bind_reuseport(self.port)
+        self.transport = create_transport(self.server_socket, self.transport_backend)
+        self.fragmenter = Fragmenter()
+        if base_dir is not None:
+            self.log_dir = os.path.join(base_dir, f"worker.{index}")
+        self.start_metrics_endpoint()
+
+        if self.engine == "asyncio":
+            asyncio.run(self.run_async_worker())
+            return
+        threading.Thread(target=self.listen_on_server_client_port, daemon=True).start()
+        threading.Thread(target=self.listen_on_control_port, daemon=True).start()
+        self.schedule_periodic(ACK_INTERVAL, self.flush_reliable_channels)
+        self.schedule_periodic(1, self.check_primary_alive)
+        self.schedule_periodic(SWEEP_TICK, self.sweep_idle_clients)
+        self.schedule_periodic(PRESENCE_INTERVAL, self.flush_presence)
+        if self.batch_delay:
+            self.schedule_periodic(self.batch_delay, self.flush_batches)
+        if self.relay_budget is not None:
+            self.schedule_periodic(RELAY_TICK, self.drain_relay_queue)
+        while True:
+            time.sleep(1)
+
+    async def run_async_worker(self):
+
+        self.loop = asyncio.get_running_loop()
+        await self.loop.create_datagram_endpoint(
+            lambda: ServerDatagramProtocol(self.handle_client_datagram, "Server"),
+            sock=self.server_socket)
+        await self.loop.create_datagram_endpoint(
+            lambda: ServerDatagramProtocol(self.handle_control_datagram, "Worker control"),
+            sock=self.control_socket)
+        self.schedule_periodic(ACK_INTERVAL, self.flush_reliable_channels)
+        self.schedule_periodic(1, self.check_primary_alive)
+        self.schedule_periodic(SWEEP_TICK, self.sweep_idle_clients)
+        self.schedule_periodic(PRESENCE_INTERVAL, self.flush_presence)
+        if self.batch_delay:
+            self.schedule_periodic(self.batch_delay, self.flush_batches)
+        if self.relay_budget is not None:
+            self.schedule_periodic(RELAY_TICK, self.drain_relay_queue)
+        await asyncio.Event().wait()
+
+    def check_workers(self):
+
+        # Primary: take over the sessions of a worker that died until the kernel routes
+        # those clients to a live worker again (runs every second)
+        for index, process in list(self.worker_processes.items()):
+            if process.is_alive():
+                continue
+            del self.worker_processes[index]
+            self.worker_addresses[index] = None
+            orphans = [client_id for client_id, info in self.remote_clients.items()
+                       if info.worker == index]
+            logger.warning(f"⚠️  Worker {index} exited, taking over its {len(orphans)} clients")
+            for client_id in orphans:
+                self.adopt_client(client_id)
+
+    def check_primary_alive(self):
+
+        # Workers exit with the primary (runs every second)
+        if os.getppid() != self.primary_pid:
+            logger.info(f"Worker {self.worker_index}: primary process gone, exiting")
+            os._exit(0)
+
+    def start_metrics_endpoint(self):
+
+        # Prometheus endpoint of this process (worker n listens on metrics_port + n)
+        if self.metrics_port is None:
+            return
+        port = self.metrics_port + self.worker_index
+        try:
+            self.metrics_server = metrics.serve_metrics(self.metrics, port)
+        except OSError as e:
+            logger.error(f"❌ Metrics endpoint not started on port {port}: {e}")
+            return
+        logger.info(f"📈 Metrics on http://127.0.0.1:{port}/metrics")
+
+    def start_server_system(self):
+
+        # Server startup on the selected engine
+        if self.worker_count > 1:
+            self.start_workers()
+        self.start_metrics_endpoint()
+        if self.engine == "asyncio":
+            asyncio.run(self.run_async_server_system())
+            return
+
+        # Threaded engine: start parallel threads
+        self.print_startup_banner()
+
+        threading.Thread(target=self.listen_on_server_client_port, daemon=True).start()
+        threading.Thread(target=self.listen_on_discovery_port, daemon=True).start()
+        if self.control_socket is not None:
+            threading.Thread(target=self.listen_on_control_port, daemon=True).start()
+        self.start_periodic_tasks()
+
+        time.sleep(10)  # Time for discovery of other servers
+
+        with self.lock:
+            self.check_leader_at_startup()
+
+        # Keep main thread alive
+        while True:
+            time.sleep(1)
+
+    async def run_async_server_system(self):
+
+        # Asyncio engine: both ports and all timers run on a single event loop,
+        # so the group view is only ever touched from one thread
+        self.print_startup_banner()
+        self.loop = asyncio.get_running_loop()
+
+        await self.loop.create_datagram_endpoint(
+            lambda: ServerDatagramProtocol(self.handle_client_datagram, "Server"),
+            sock=self.server_socket)
+        await self.loop.create_datagram_endpoint(
+            lambda: ServerDatagramProtocol(self.handle_discovery_datagram, "Discovery"),
+            sock=self.discovery_socket)
+        if self.control_socket is not None:
+            await self.loop.create_datagram_endpoint(
+                lambda: ServerDatagramProtocol(self.handle_control_datagram, "Worker control"),
+                sock=self.control_socket)
+        self.start_periodic_tasks()
+
+        await asyncio.sleep(10)  # Time for discovery of other servers
+        self.check_leader_at_startup()
+
+        # Keep the event loop alive
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Distributed chat server")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="event engine used for sockets and timers")
+    parser.add_argument("--transport", choices=["auto", "sendmmsg", "portable"], default="auto",
+                        help="send backend used for fan-out to clients")
+    parser.add_argument("--codecs", nargs="+", choices=protocol.CODECS, default=list(protocol.CODECS),
+                        help="wire codecs offered to clients, in order of preference")
+    parser.add_argument("--features", nargs="*", choices=protocol.FEATURES, default=list(protocol.FEATURES),
+                        help="session features offered to clients")
+    parser.add_argument("--log-dir", default=None,
+                        help="directory of the persistent message log replayed to late joiners")
+    parser.add_argument("--sharded", action="store_true",
+                        help="spread clients over all live servers instead of relaying through the leader")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="pre-forked processes sharing the client port through SO_REUSEPORT")
+    parser.add_argument("--election", choices=["term", "ring"], default="term",
+                        help="leader election: term-based majority votes or the token ring")
+    parser.add_argument("--client-rate", type=float, default=CLIENT_RATE,
+                        help="chat messages per second each client may send, 0 = unlimited")
+    parser.add_argument("--client-burst", type=float, default=CLIENT_BURST,
+                        help="messages a client may send in a burst above its rate")
+    parser.add_argument("--relay-budget", type=float, default=RELAY_BUDGET,
+                        help="deliveries per second relayed over all clients, 0 = unlimited")
+    parser.add_argument("--client-timeout", type=float, default=CLIENT_IDLE_TIMEOUT,
+                        help="seconds of silence after which a client's session is evicted")
+    parser.add_argument("--batch-delay", type=float, default=BATCH_DELAY * 1000,
+                        help="milliseconds room frames may wait to share a datagram, 0 = no batching")
+    parser.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD,
+                        help="smallest datagram (bytes) deflated for clients with the compress feature")
+    parser.add_argument("--cluster-secret", default=None,
+                        help="secret signing resume tokens, the same on every server of the cluster "
+                             "(default: random, tokens then only work on the server that issued them)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (worker n: PORT + n)")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="info",
+                        help="console output: debug also logs every relayed message")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--discovery-port", type=int, default=5010)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s", stream=sys.stdout)
+
+    # Start the server
+    server = Server(port=args.port, discovery_port=args.discovery_port,
+                    engine=args.engine, transport=args.transport, codecs=args.codecs,
+                    features=args.features, log_dir=args.log_dir, sharded=args.sharded,
+                    worker_count=args.workers, election=args.election, metrics_port=args.metrics_port,
+                    client_rate=args.client_rate, client_burst=args.client_burst,
+                    relay_budget=args.relay_budget, client_idle_timeout=args.client_timeout,
+                    resume_secret=args.cluster_secret, batch_delay=args.batch_delay / 1000,
+                    compress_threshold=args.compress_threshold)
+    server.start_server_system()
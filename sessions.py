@@ -0,0 +1,173 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+
+
+# Clients send a keepalive this often (seconds) ...
+KEEPALIVE_INTERVAL = 10.0
+# ... and a session nothing was heard from for this long is evicted
+CLIENT_IDLE_TIMEOUT = 35.0
+# Resolution (seconds) and number of slots of the wheel that finds idle sessions
+SWEEP_TICK = 1.0
+WHEEL_SLOTS = 64
+# Resume tokens are signed with a secret every server of a cluster must share
+# (--cluster-secret) to accept the tokens the others issued, and are honoured for
+# this long (seconds) after they were issued
+RESUME_TOKEN_LIFETIME = 3600.0
+# Presence (join and leave) updates of a room go out at most this often (seconds):
+# the changes in between are summed up in one delta
+PRESENCE_INTERVAL = 0.5
+# Names per page of a roster response
+ROSTER_PAGE = 100
+# How a join or leave notice reads for one client and for several
+NOTICE_PHRASES = {
+    "joined": ("has joined the chat", "joined the chat"),
+    "left": ("has left the chat", "left the chat"),
+    "timed_out": ("timed out", "timed out"),
+}
+# A summary names this many clients and counts the others
+NOTICE_NAMES = 3
+
+
+def summarize_notice(event, names):
+
+    # "Client 1 has joined the chat." or "Client 1, Client 2, Client 3 and 5 others joined the chat."
+    single, several = NOTICE_PHRASES[event]
+    if len(names) == 1:
+        return f"{names[0]} {single}."
+    if len(names) <= NOTICE_NAMES:
+        return f"{', '.join(names[:-1])} and {names[-1]} {several}."
+    return f"{', '.join(names[:NOTICE_NAMES])} and {len(names) - NOTICE_NAMES} others {several}."
+
+
+def presence_delta(room, changes):
+
+    # One room's membership changes ({event: [names]}) as a compact presence frame;
+    # its text is what clients without the presence feature get as a notice
+    left = len(changes.get("left", ())) + len(changes.get("timed_out", ()))
+    return {
+        "type": "presence",
+        "room": room,
+        "joined": len(changes.get("joined", ())),
+        "left": left,
+        "text": " ".join(summarize_notice(event, names) for event, names in changes.items())
+    }
+
+
+def generate_resume_secret():
+
+    # Secret of a server started without --cluster-secret: its tokens are only
+    # honoured by itself (and its workers), and not after a restart
+    return secrets.token_hex(32)
+
+
+def make_resume_token(secret, client_id, name, now):
+
+    # "<name, base64>.<issued>.<signature>": any server knowing the secret can restore
+    # the name of the client with this id, whether or not it ever held the session
+    encoded = base64.urlsafe_b64encode(name.encode()).decode()
+    issued = int(now)
+    return f"{encoded}.{issued}.{sign_resume_token(secret, client_id, encoded, issued)}"
+
+
+def read_resume_token(secret, client_id, token, now, lifetime=RESUME_TOKEN_LIFETIME):
+
+    # Name a resume token restores for client_id, or None when it is not genuine or expired
+    try:
+        encoded, issued, signature = token.split(".")
+        issued = int(issued)
+        # Compared as bytes: compare_digest refuses str with non-ASCII characters
+        signature = signature.encode()
+        name = base64.urlsafe_b64decode(encoded.encode()).decode()
+    except (AttributeError, ValueError, binascii.Error):
+        return None
+    if not hmac.compare_digest(signature, sign_resume_token(secret, client_id, encoded, issued).encode()):
+        return None
+    if now - issued > lifetime:
+        return None
+    return name
+
+
+def sign_resume_token(secret, client_id, encoded_name, issued):
+
+    message = f"{client_id}:{encoded_name}:{issued}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+class ClientSession:
+
+    # One client's entry in the session table. __slots__ keeps an entry to a handful
+    # of pointers instead of a dict repeating the same keys for every client, and the
+    # address tuple is shared with the fan-out caches.
+
+    __slots__ = ("id", "ip", "port", "address", "name", "codec", "features", "room",
+                 "last_seen", "wheel_slot", "worker")
+
+    def __init__(self, client_id, ip, port, name, codec="json", features=(), room=None,
+                 last_seen=0.0, worker=None):
+
+        self.id = client_id
+        self.ip = ip
+        self.port = port
+        self.address = (ip, port)
+        self.name = name
+        self.codec = codec
+        self.features = tuple(features)
+        self.room = room
+        self.last_seen = last_seen  # monotonic time of the last datagram from the client
+        self.wheel_slot = None  # slot of the idle wheel this session is filed in
+        self.worker = worker  # pre-forked: index of the worker serving a remote client
+
+    def record(self):
+
+        # Compact replicated form: [id, ip, port, name, codec, features, room]
+        return [self.id, self.ip, self.port, self.name, self.codec, list(self.features), self.room]
+
+
+class TimerWheel:
+
+    # Hashed timing wheel: each key is filed in the slot of its deadline, and a sweep
+    # only visits the slots the clock went past since the previous one. A deadline
+    # that moves later (a client was heard from again) costs nothing when it happens:
+    # the key is simply filed further on when its old slot comes round.
+
+    def __init__(self, now, tick=SWEEP_TICK, slots=WHEEL_SLOTS):
+
+        self.tick = tick
+        self.size = slots
+        self.slots = [set() for _ in range(slots)]
+        self.current = int(now / tick)  # last tick swept
+
+    def schedule(self, key, deadline):
+
+        # File key under its deadline (at most one revolution ahead); returns the slot
+        ticks = int(deadline / self.tick)
+        if ticks <= self.current:
+            ticks = self.current + 1
+        elif ticks > self.current + self.size:
+            ticks = self.current + self.size
+        slot = ticks % self.size
+        self.slots[slot].add(key)
+        return slot
+
+    def discard(self, key, slot):
+
+        if slot is not None:
+            self.slots[slot].discard(key)
+
+    def advance(self, now):
+
+        # Keys filed in the slots the clock went past; the caller checks their deadlines
+        target = int(now / self.tick)
+        # After a long stall one revolution covers every slot
+        self.current = max(self.current, target - self.size)
+        due = []
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % self.size]
+            if slot:
+                due.extend(slot)
+                slot.clear()
+        return due
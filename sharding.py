@@ -0,0 +1,50 @@
+import bisect
+import hashlib
+
+
+def ring_hash(key):
+
+    # Stable 64-bit position on the ring (the built-in hash() is salted per process)
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+
+    # Consistent hashing of client ids onto servers. Each server owns many virtual
+    # points, so adding or removing one server only moves about 1/N of the keys.
+
+    def __init__(self, nodes=(), replicas=64):
+
+        self.replicas = replicas
+        self.nodes = set()
+        self.points = []  # sorted ring positions
+        self.owners = {}  # ring position: node
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = ring_hash(f"{node}#{replica}")
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+                self.owners[point] = node
+
+    def remove(self, node):
+
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self.points = [point for point in self.points if self.owners[point] != node]
+        self.owners = {point: self.owners[point] for point in self.points}
+
+    def lookup(self, key):
+
+        # First server clockwise from the key's position, or None on an empty ring
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
@@ -0,0 +1,73 @@
+import random
+
+from reliability import ReliableChannel, ACK_INTERVAL
+
+
+def run_lossy_link(frames, loss, seed, latency=0.02, send_interval=0.05):
+
+    # Two channels over a simulated link that drops `loss` of the datagrams in each
+    # direction; returns (sender, receiver, payloads delivered in order)
+    rng = random.Random(seed)
+    sender, receiver = ReliableChannel(), ReliableChannel()
+    in_transit = []  # (arrival time, channel, datagram)
+    delivered = []
+    now = 0.0
+
+    def transmit(datagrams, channel):
+        for datagram in datagrams:
+            if rng.random() >= loss:
+                in_transit.append((now + latency, channel, datagram))
+
+    sent = 0
+    next_send = next_poll = 0.0
+    while sent < frames or sender.in_flight or receiver.out_of_order or in_transit:
+        now = min(time for time in (next_send if sent < frames else None, next_poll,
+                                    *(arrival for arrival, _, _ in in_transit)) if time is not None)
+        if sent < frames and now >= next_send:
+            transmit([sender.wrap(str(sent).encode(), now)], receiver)
+            sent += 1
+            next_send = now + send_interval
+        arrived = [item for item in in_transit if item[0] <= now]
+        in_transit = [item for item in in_transit if item[0] > now]
+        for _, channel, datagram in arrived:
+            payloads = channel.on_datagram(datagram, now)
+            if channel is receiver:
+                delivered.extend(payloads)
+        if now >= next_poll:
+            outgoing, payloads = sender.poll(now)
+            transmit(outgoing, receiver)
+            outgoing, payloads = receiver.poll(now)
+            delivered.extend(payloads)
+            transmit(outgoing, sender)
+            next_poll = now + ACK_INTERVAL
+        if now > 3600:
+            raise AssertionError("link never drained")
+    return sender, receiver, delivered
+
+
+def test_no_gap_skipped_while_the_sender_retries():
+
+    # Under heavy loss the receiver must wait for retransmissions instead of skipping
+    # frames the sender has not given up on (the send rate keeps the window from filling)
+    for seed in range(5):
+        sender, receiver, delivered = run_lossy_link(2000, loss=0.2, seed=seed)
+        assert sender.abandoned == 0
+        assert receiver.skipped == 0
+        assert delivered == [str(seq).encode() for seq in range(2000)]
+
+
+def test_gap_skipped_once_the_sender_abandons():
+
+    # A lost frame is skipped only after the sender's last retransmission could have
+    # arrived, and the ones after it still get delivered
+    sender, receiver = ReliableChannel(), ReliableChannel()
+    sender.wrap(b"lost", 0.0)
+    assert receiver.on_datagram(sender.wrap(b"next", 0.0), 0.0) == []
+    now = 0.0
+    while not sender.abandoned:
+        now += ACK_INTERVAL
+        sender.poll(now)
+        assert receiver.poll(now)[1] == []
+    assert now < receiver.gap_timeout
+    assert receiver.poll(receiver.gap_timeout)[1] == [b"next"]
+    assert receiver.skipped == 1
@@ -0,0 +1,179 @@
+import ctypes
+import errno
+import logging
+import socket
+import struct
+import sys
+
+
+logger = logging.getLogger("chat.transport")
+
+
+class PortableTransport:
+
+    # One sendto syscall per datagram; works on every platform
+    name = "portable"
+
+    def __init__(self, sock):
+
+        self.sock = sock
+        self.syscalls = 0
+        self.datagrams = 0
+
+    def send_many(self, datagrams):
+
+        # Send a list of (payload, address) pairs and return [(index, error)]
+        failures = []
+        sendto = self.sock.sendto
+        for index, (payload, address) in enumerate(datagrams):
+            try:
+                sendto(payload, address)
+            except Exception as e:
+                failures.append((index, e))
+        self.syscalls += len(datagrams)
+        self.datagrams += len(datagrams)
+        return failures
+
+    def forget(self, address):
+
+        # Nothing is cached per address
+        pass
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.c_void_p),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+# Native layout of one mmsghdr entry: name, namelen, iov, iovlen, control, controllen, flags, len
+MMSGHDR_FORMAT = struct.Struct("@PIPNPNi4xI4x")
+IOVEC_FORMAT = struct.Struct("@PN")
+SOCKADDR_IN_SIZE = 16
+
+
+def load_sendmmsg():
+
+    # Resolve sendmmsg from libc, or None where it is unavailable
+    if not sys.platform.startswith("linux"):
+        return None
+    if MMSGHDR_FORMAT.size != ctypes.sizeof(mmsghdr) or IOVEC_FORMAT.size != ctypes.sizeof(iovec):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+class SendmmsgTransport(PortableTransport):
+
+    # Linux batched send: up to BATCH_SIZE datagrams per sendmmsg syscall
+    name = "sendmmsg"
+    BATCH_SIZE = 1024  # UIO_MAXIOV
+
+    def __init__(self, sock, sendmmsg):
+
+        super().__init__(sock)
+        self.sendmmsg = sendmmsg
+        self.sockaddrs = {}  # (ip, port): packed sockaddr_in buffer
+
+    def sockaddr_for(self, address):
+
+        # Packed sockaddr_in for an (ip, port) tuple, cached per address
+        buffer = self.sockaddrs.get(address)
+        if buffer is None:
+            ip, port = address
+            try:
+                packed_ip = socket.inet_aton(ip)
+            except OSError:
+                packed_ip = socket.inet_aton(socket.gethostbyname(ip))
+            raw = struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) + packed_ip
+            buffer = ctypes.create_string_buffer(raw, SOCKADDR_IN_SIZE)
+            self.sockaddrs[address] = buffer
+        return buffer
+
+    def forget(self, address):
+
+        self.sockaddrs.pop(address, None)
+
+    def send_many(self, datagrams):
+
+        failures = []
+        for start in range(0, len(datagrams), self.BATCH_SIZE):
+            batch = datagrams[start:start + self.BATCH_SIZE]
+            for index, e in self.send_batch(batch):
+                failures.append((start + index, e))
+        return failures
+
+    def send_batch(self, batch):
+
+        count = len(batch)
+        headers = bytearray(MMSGHDR_FORMAT.size * count)
+        payload_iovecs = {}  # id(payload): (iovec buffer, address)
+        keep_alive = []
+
+        for index, (payload, address) in enumerate(batch):
+            # Datagrams sharing one payload object share one iovec
+            entry = payload_iovecs.get(id(payload))
+            if entry is None:
+                data = ctypes.c_char_p(payload)
+                iov = ctypes.create_string_buffer(IOVEC_FORMAT.pack(
+                    ctypes.cast(data, ctypes.c_void_p).value, len(payload)), IOVEC_FORMAT.size)
+                entry = ctypes.addressof(iov)
+                payload_iovecs[id(payload)] = entry
+                keep_alive.append((payload, data, iov))
+            MMSGHDR_FORMAT.pack_into(
+                headers, index * MMSGHDR_FORMAT.size,
+                ctypes.addressof(self.sockaddr_for(address)), SOCKADDR_IN_SIZE,
+                entry, 1, 0, 0, 0, 0)
+
+        buffer = (ctypes.c_char * len(headers)).from_buffer(headers)
+        base = ctypes.addressof(buffer)
+        failures = []
+        sent = 0
+        while sent < count:
+            result = self.sendmmsg(self.sock.fileno(), base + sent * MMSGHDR_FORMAT.size,
+                                   count - sent, 0)
+            self.syscalls += 1
+            if result < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                # Report the failing datagram and carry on with the rest of the batch
+                failures.append((sent, OSError(error, errno.errorcode.get(error, str(error)))))
+                sent += 1
+                continue
+            self.datagrams += result
+            sent += result
+        del buffer
+        return failures
+
+
+def create_transport(sock, backend="auto"):
+
+    # Choose the send backend for a UDP socket: "auto", "sendmmsg" or "portable"
+    if backend in ("auto", "sendmmsg"):
+        sendmmsg = load_sendmmsg()
+        if sendmmsg is not None:
+            return SendmmsgTransport(sock, sendmmsg)
+        if backend == "sendmmsg":
+            logger.warning("⚠️  sendmmsg is not available on this platform, using portable transport")
+    return PortableTransport(sock)
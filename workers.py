@@ -0,0 +1,54 @@
+import os
+import socket
+import struct
+
+
+# Control datagrams between the worker processes of one server are JSON, except
+# datagrams forwarded unchanged to the primary, which carry this magic byte and
+# the original sender's address in front of the raw bytes
+FORWARD_MAGIC = 0xFD
+FORWARD_HEADER = struct.Struct("!B4sH")  # magic, sender IPv4 address, sender port
+
+
+def prefork_available():
+
+    # Pre-forked workers need fork() and SO_REUSEPORT (Linux, BSD, macOS)
+    return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+
+def bind_reuseport(port):
+
+    # Client-port socket the kernel load-balances with the other workers' sockets
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    return sock
+
+
+def create_control_sockets(count):
+
+    # One loopback control socket per worker, created before forking so every
+    # worker knows the addresses of all the others
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sockets.append(sock)
+    return sockets
+
+
+def is_forwarded(message):
+
+    return bool(message) and message[0] == FORWARD_MAGIC
+
+
+def pack_forward(datagram, address):
+
+    return FORWARD_HEADER.pack(FORWARD_MAGIC, socket.inet_aton(address[0]), address[1]) + datagram
+
+
+def unpack_forward(message):
+
+    # The original datagram and the address it came from
+    _, ip, port = FORWARD_HEADER.unpack_from(message)
+    return message[FORWARD_HEADER.size:], (socket.inet_ntoa(ip), port)